@@ -0,0 +1,104 @@
+import os
+import time
+
+import numpy as np
+
+
+def spherical_kmeans(embeddings, n_clusters, n_iter=20, seed=0):
+    """ K-means on unit-length vectors using cosine similarity; returns unit-length centroids. """
+    rng = np.random.default_rng(seed)
+    centroids = embeddings[rng.choice(len(embeddings), n_clusters, replace=False)].copy()
+    for _ in range(n_iter):
+        labels = np.argmax(embeddings @ centroids.T, axis=1)
+        for c in range(n_clusters):
+            members = embeddings[labels == c]
+            if len(members):
+                centroids[c] = members.sum(axis=0)
+            else:
+                # Re-seed empty lists with a random point so every list stays in use
+                centroids[c] = embeddings[rng.integers(len(embeddings))]
+        centroids /= np.linalg.norm(centroids, axis=1, keepdims=True) + 1e-12
+    return centroids.astype(np.float32)
+
+
+class IVFIndex():
+    """
+    Inverted-file (IVF) approximate nearest-neighbour index over unit-length embeddings.
+
+    Rows are bucketed by their nearest of n_lists centroids. A query probes only the n_probe
+    lists whose centroids are most similar to it, so it touches roughly n_probe / n_lists of
+    the rows. n_probe is the recall-vs-latency knob: n_probe == n_lists is exhaustive.
+    Candidates are rescored exactly against the stored embeddings by the caller.
+    """
+    FILES = ["ivf_centroids.npy", "ivf_order.npy", "ivf_offsets.npy"]
+
+    def __init__(self, centroids, order, offsets):
+        self.centroids = centroids
+        self.order = order
+        self.offsets = offsets
+        self.n_lists = len(centroids)
+
+
+    @classmethod
+    def build(cls, embeddings, n_lists=None, n_iter=20, train_size=100000, seed=0):
+        """
+        Trains centroids on a sample of embeddings, then assigns every row to its nearest list.
+        Returns None for an empty matrix, which leaves its callers on exhaustive search.
+        """
+        start = time.perf_counter()
+        n = len(embeddings)
+        if n == 0:
+            print("Not building an IVF index over 0 rows")
+            return None
+        if n_lists is None:
+            n_lists = max(1, int(4 * np.sqrt(n)))
+        n_lists = min(n_lists, n)
+        rng = np.random.default_rng(seed)
+        sample = np.sort(rng.choice(n, min(n, train_size), replace=False))
+        centroids = spherical_kmeans(np.asarray(embeddings[sample], dtype=np.float32), n_lists, n_iter, seed)
+
+        labels = np.empty(n, dtype=np.int32)
+        for begin in range(0, n, 50000):
+            labels[begin:begin + 50000] = np.argmax(np.asarray(embeddings[begin:begin + 50000]) @ centroids.T, axis=1)
+        order = np.argsort(labels, kind="stable").astype(np.int64)
+        offsets = np.concatenate([[0], np.cumsum(np.bincount(labels, minlength=n_lists))]).astype(np.int64)
+        print(f"Built IVF index with {n_lists} lists over {n} rows in {time.perf_counter() - start:.1f}s")
+        return cls(centroids, order, offsets)
+
+
+    def save(self, path):
+        for filename, array in zip(self.FILES, [self.centroids, self.order, self.offsets]):
+            np.save(os.path.join(path, filename), array)
+
+
+    @classmethod
+    def load(cls, path):
+        """ Returns the IVFIndex saved in path, or None if there is none. """
+        if not all(os.path.exists(os.path.join(path, filename)) for filename in cls.FILES):
+            return None
+        return cls(*(np.load(os.path.join(path, filename), mmap_mode="r") for filename in cls.FILES))
+
+
+    def candidates(self, query, n_probe=8, lo=None, hi=None):
+        """ Sorted row positions in the n_probe lists nearest to query, optionally restricted to [lo, hi). """
+        n_probe = min(max(1, n_probe), self.n_lists)
+        probes = np.argpartition(-(self.centroids @ query), n_probe - 1)[:n_probe]
+        positions = np.sort(np.concatenate([self.order[self.offsets[p]:self.offsets[p + 1]] for p in probes]))
+        if lo is not None:
+            positions = positions[np.searchsorted(positions, lo, side="left"):]
+        if hi is not None:
+            positions = positions[:np.searchsorted(positions, hi, side="left")]
+        return positions
+
+
+def search(embeddings, ivf, query, n_probe=8, threshold=None, lo=None, hi=None):
+    """
+    Threshold query against embeddings through ivf, with exact rescoring so the returned
+    similarities equal brute-force cosine similarity. Returns (positions, similarities) sorted by position.
+    """
+    positions = ivf.candidates(query, n_probe, lo, hi)
+    sims = np.asarray(embeddings[positions] @ query, dtype=np.float32)
+    if threshold is not None:
+        keep = sims >= threshold
+        positions, sims = positions[keep], sims[keep]
+    return positions, sims
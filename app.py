@@ -1,26 +1,31 @@
-from flask import Flask, Blueprint, request, jsonify
+from flask import Flask, Blueprint, request, jsonify, stream_with_context
 from flask_cors import CORS
 from generate_narratives import Narrative_Generator
-from impact_analysis import PolarityTester
+from impact_analysis import PolarityTester, combine_polarity_stats
+from polarity_engine import make_polarity_engine
+from polarity_cache import PolarityCache
+from polarity_cascade import PolarityCascade
+from jobs import JobQueue
+from model_registry import ModelRegistry, ModelUnavailable
 import pandas as pd
-from sentence_transformers import SentenceTransformer
-from mlx_lm import load
-from preprocess import read_media
-from graph_sims import trace_over_time
+from encoder_service import load_sentence_model, RemoteEncoder, BatchingEncoder
+from preprocess import read_media, read_media_chunks, model_name_of, read_upload_chunks, upload_format, encoding_stats
+from graph_sims import trace_over_time, trace_over_time_chunks
+from embedding_cache import EmbeddingCache
+from embedding_index import find_index, INDEX_DIR
+from storage import partitioned_path, is_fresh, PARQUET_DIR, write_parquet, read_parquet
+from result_store import ResultStore
 import os
 import numpy as np
 import datetime
-import mlx.core as mx
 import gc
-import torch
+import json
+import time
+import threading
 from functools import wraps
-from firebase_admin import auth, credentials
-import firebase_admin
 import dotenv
 dotenv.load_dotenv()
 
-cred = credentials.Certificate(os.getenv("FIREBASE_ADMIN_SDK_KEY"))
-firebase_admin.initialize_app(cred)
 if os.getenv('FLASK_ENV') == 'development':
     allowed_origins = [
         "http://localhost:3000",
@@ -34,29 +39,126 @@ else:
         "https://www.narrativedashboard.xyz",
     ]
 
-# Set MLX to use GPU
-mx.set_default_device(mx.gpu)
+tweets_dir = 'tweets'
+# Built offline with `python embedding_index.py`; datasets without a fresh index are embedded per request
+index_dir = os.getenv("EMBEDDING_INDEX_DIR", INDEX_DIR)
+# Built offline with `python storage.py`; lets unindexed datasets read only the requested days
+parquet_dir = os.getenv("PARQUET_DIR", PARQUET_DIR)
 
-# Verify GPU is being used
-print(f"MLX is using device: {mx.default_device()}")
+SUMMARY_MODEL = "mlx-community/Mistral-Nemo-Instruct-2407-4bit"
+# SUMMARY_MODEL = "mlx-community/Mistral-Small-24B-Instruct-2501-4bit"
+POLARITY_MLX_MODEL = "mlx-community/Mistral-Small-24B-Instruct-2501-4bit"
+# POLARITY_BACKEND: "mlx" (default), "transformers" (POLARITY_MODEL names a Hugging Face model) or "stub"
+polarity_backend = os.getenv("POLARITY_BACKEND", "mlx")
+# The polarity engine's name, which keys the polarity cache, without loading the model
+polarity_model_name = {"mlx": POLARITY_MLX_MODEL, "transformers": os.getenv("POLARITY_MODEL")}.get(polarity_backend, polarity_backend)
+# APP_PROFILE "full" (default) serves every endpoint; "embeddings" never loads the LLMs, so it boots in
+# seconds and polarity and narrative generation answer 503
+app_profile = os.getenv("APP_PROFILE", "full")
+# LLMs unused for MODEL_IDLE_TTL seconds are unloaded and loaded again on their next use (0 keeps them)
+model_idle_ttl = float(os.getenv("MODEL_IDLE_TTL", "1800")) or None
+# Encode calls from concurrent requests are pooled into batches of up to ENCODER_MAX_BATCH texts,
+# waiting at most ENCODER_MAX_WAIT_MS for a batch to fill
+encoder_max_batch = int(os.getenv("ENCODER_MAX_BATCH", "64"))
+encoder_max_wait_ms = float(os.getenv("ENCODER_MAX_WAIT_MS", "5"))
+# ENCODER_BACKEND: "torch" (default), "int8" or "onnx" (ENCODER_ONNX_FILE picks a quantized export); see load_sentence_model
+encoder_backend = os.getenv("ENCODER_BACKEND", "torch")
 
-tweets_dir = 'tweets'
 
-# Load models using MLX with explicit GPU configuration
-summary_model, tokenizer = load("mlx-community/Mistral-Nemo-Instruct-2407-4bit")
-# summary_model, tokenizer = load("mlx-community/Mistral-Small-24B-Instruct-2501-4bit")
-sent_model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
-polarity_model, pol_tokenizer = load("mlx-community/Mistral-Small-24B-Instruct-2501-4bit")
-
-# Configure SentenceTransformer to use MPS (Metal Performance Shaders)
-# This enables GPU acceleration for PyTorch-based models on Mac
-if torch.backends.mps.is_available():
-    sent_model = sent_model.to('mps')
-    print("SentenceTransformer using MPS (GPU)")
-else:
-    print("MPS not available, SentenceTransformer using CPU")
+def load_mlx(name):
+    """ Loads an MLX model and tokenizer on the GPU. """
+    import mlx.core as mx
+    from mlx_lm import load
+
+    # Set MLX to use GPU
+    mx.set_default_device(mx.gpu)
+    # Verify GPU is being used
+    print(f"MLX is using device: {mx.default_device()}")
+    return load(name)
+
+
+def load_sent_model():
+    # Set by serve.py: its workers share one encoder process (which does the batching) instead of each loading a copy
+    if os.getenv("ENCODER_ADDRESS"):
+        return RemoteEncoder(os.getenv("ENCODER_ADDRESS"), bytes.fromhex(os.getenv("ENCODER_AUTHKEY", "")))
+    return BatchingEncoder(load_sentence_model(backend=encoder_backend, onnx_file=os.getenv("ENCODER_ONNX_FILE")),
+                           encoder_max_batch, encoder_max_wait_ms)
+
+
+def load_polarity_engine():
+    # One engine for all requests, so the prompt prefix of a narrative is only prefilled once.
+    # MLX runs the tweets one at a time on that prefix; POLARITY_BATCH_SIZE batches them on transformers
+    if polarity_backend == "mlx":
+        polarity_model, pol_tokenizer = load_mlx(POLARITY_MLX_MODEL)
+        return make_polarity_engine("mlx", polarity_model, pol_tokenizer, name=POLARITY_MLX_MODEL)
+    if polarity_backend == "transformers":
+        return make_polarity_engine("transformers", os.getenv("POLARITY_MODEL"),
+                                    batch_size=int(os.getenv("POLARITY_BATCH_SIZE", "16")))
+    return make_polarity_engine(polarity_backend)
+
+
+def load_polarity_cascade():
+    # Logistic regression trained on the cached LLM labels; decides confident tweets so only the rest reach the LLM
+    # Trained only on labels from the default labels-mode prompt, not json-mode or older prompts' results
+    version = PolarityTester(None, None, None, None, mode="labels").prompt_version()
+    cascade = PolarityCascade(models.get("sentence"), confidence=float(os.getenv("POLARITY_CASCADE_CONFIDENCE", "0.9")),
+                              cache=embedding_cache, prompt_version=version)
+    cascade.maybe_refit(polarity_cache, polarity_model_name)
+    return cascade
+
+
+# Content-addressed embedding store so repeat traces over the same tweets skip the encoder
+embedding_cache = EmbeddingCache(
+    os.getenv("EMBEDDING_CACHE_PATH", "embedding_cache/embeddings.sqlite"),
+    max_bytes=int(os.getenv("EMBEDDING_CACHE_MAX_MB", "2048")) * 1024 ** 2,
+    dtype=os.getenv("EMBEDDING_CACHE_DTYPE", "float32"),
+)
+# Polarity results keyed by model, prompt version, narrative and canonical tweet, so repeat queries skip the LLM
+polarity_cache = PolarityCache(os.getenv("POLARITY_CACHE_PATH", "polarity_cache/polarity.sqlite"))
+# Trace results kept under a handle that generate-narratives accepts instead of the rows
+result_store = ResultStore(os.getenv("TRACE_RESULTS_DIR", "trace_results"),
+                           max_age_hours=float(os.getenv("TRACE_RESULTS_MAX_AGE_HOURS", "24")))
+
+# Models are loaded on first use; requests get() them rather than holding module globals, so idle LLMs can be freed
+models = ModelRegistry()
+models.register("sentence", load_sent_model)
+models.register("summary", lambda: load_mlx(SUMMARY_MODEL), ttl=model_idle_ttl)
+models.register("polarity", load_polarity_engine, ttl=model_idle_ttl)
+models.register("polarity_cascade", load_polarity_cascade)
+if app_profile == "embeddings":
+    for name in ("summary", "polarity", "polarity_cascade"):
+        models.disable(name, "embeddings profile")
+elif app_profile != "full":
+    raise ValueError(f"Error: Unknown APP_PROFILE '{app_profile}'. Use 'full' or 'embeddings'.")
+# MODEL_PRELOAD: comma-separated models to load at startup rather than on the first request
+for name in os.getenv("MODEL_PRELOAD", "sentence").split(","):
+    if name.strip():
+        models.get(name.strip())
+models.start_reaper()
+# The LLMs and the cascade are shared; their work from request threads and the job worker takes turns.
+# The sentence encoder is thread-safe (its batcher or the encoder process runs one batch at a time),
+# so traces don't take the lock and their encode calls can share batches.
+model_lock = threading.RLock()
+
+_firebase_lock = threading.Lock()
+
+
+def firebase_auth():
+    """ Firebase Admin auth, initialized on the first authenticated request rather than at import. """
+    import firebase_admin
+    from firebase_admin import auth, credentials
+
+    with _firebase_lock:
+        if not firebase_admin._apps:
+            firebase_admin.initialize_app(credentials.Certificate(os.getenv("FIREBASE_ADMIN_SDK_KEY")))
+    return auth
+
 
 app = Flask(__name__)
+# Bigger requests are refused with a 413 before they are read
+app.config['MAX_CONTENT_LENGTH'] = int(os.getenv("UPLOAD_MAX_MB", "512")) * 1024 ** 2
+# Rows parsed from one uploaded file (gzip can hide a lot of rows in a small request)
+upload_max_rows = int(os.getenv("UPLOAD_MAX_ROWS", "5000000"))
 api = Blueprint("api", __name__, url_prefix="/api")
 
 def verify_firebase_token(f):
@@ -77,7 +179,7 @@ def verify_firebase_token(f):
         
         try:
             # Verify the token with Firebase Admin SDK
-            decoded_token = auth.verify_id_token(token)
+            decoded_token = firebase_auth().verify_id_token(token)
             # Add user info to request context for use in the route
             request.user = decoded_token
             return f(*args, **kwargs)
@@ -88,6 +190,11 @@ def verify_firebase_token(f):
     return decorated_function
 
 
+@app.errorhandler(413)
+def request_too_large(e):
+    return jsonify({'error': f"Request larger than {app.config['MAX_CONTENT_LENGTH'] // 1024 ** 2} MB"}), 413
+
+
 @api.before_request
 def reject_unknown_preflights():
     if request.headers.get("Origin") not in allowed_origins:
@@ -97,13 +204,13 @@ def reject_unknown_preflights():
 @api.route('/post-datasets', methods=['POST'])
 @verify_firebase_token
 def api_post_datasets():
-    """ Assumes every csv file in tweets_dir is compatible w analysis 
+    """ Assumes every csv or parquet file in tweets_dir is compatible w analysis 
     (has Tweet, Datetime cols). Returns these in a jsonified list."""
     files = [
         os.path.relpath(os.path.join(root, f), tweets_dir)
         for root, _, filenames in os.walk(tweets_dir)
         for f in filenames
-        if f.endswith('.csv')
+        if f.endswith('.csv') or f.endswith('.parquet')
     ]
     result = {
         'success': True,
@@ -112,59 +219,375 @@ def api_post_datasets():
     
     return jsonify(result)
 
-@api.route('/trace-over-time-upload', methods=['POST'])
-@verify_firebase_token
-def api_trace_over_time_upload():
-    """Process uploaded CSV data (sent as JSON) instead of server files"""
-    gc.collect()
+class RequestError(ValueError):
+    """ Invalid request parameters; returned as a 400 (or recorded as the job's error). """
+    pass
+
+
+def trace_uploaded_data(data, progress=None, owner=None):
+    """ Trace over CSV data uploaded as JSON rows instead of a server file. """
+    sent_model = models.get("sentence")
+    uploaded_data = data.get('uploadedData')
+    if not uploaded_data:
+        raise RequestError('No uploaded data provided')
+
+    # Convert uploaded JSON data to DataFrame
+    df = pd.DataFrame(uploaded_data)
+
+    # Add the required preprocessing that read_media does
     try:
-        # Get parameters from request
-        data = request.json
-        uploaded_data = data.get('uploadedData')
-        
-        if not uploaded_data:
-            return jsonify({'error': 'No uploaded data provided'}), 400
-            
-        # Convert uploaded JSON data to DataFrame
-        df = pd.DataFrame(uploaded_data)
-        
-        # Add the required preprocessing that read_media does
+        df["AuthorTweet"] = "Author: " + df["ChannelName"] + "\nTweet: " + df["Tweet"]
+    except KeyError:
+        df["AuthorTweet"] = "Tweet: " + df["Tweet"]
+
+    # Convert datetime strings to datetime objects for filtering
+    df['Datetime'] = pd.to_datetime(df['Datetime'])
+
+    start_date = data.get('startDate')
+    end_date = data.get('endDate')
+    target_narrative = data.get('targetNarrative')
+    threshold = data.get('threshold', 0.5)
+    # Which text is embedded: "Tweet" (default) or "AuthorTweet"
+    text_column = data.get('textField', 'Tweet')
+    if text_column not in ('Tweet', 'AuthorTweet'):
+        raise RequestError(f'Unsupported textField {text_column}')
+
+    # Call your trace_over_time function
+    if progress:
+        progress.update(message="Embedding tweets")
+    filtered_df, embeddings = trace_over_time(df, sent_model, target_narrative, [start_date, end_date], sim_threshold=threshold, cache=embedding_cache, text_column=text_column,
+                                              return_embeddings=True)
+    embedding_cache.log_stats()
+    encoding_stats.log_stats()
+
+    # Replace NaN values with None (which becomes null in JSON)
+    filtered_df = filtered_df.replace({np.nan: None})
+    result_handle = store_result(data, filtered_df, embeddings, owner, text_column)
+    gc.collect()
+
+    # Convert DataFrame to records
+    records = filtered_df.to_dict('records')
+
+    # Return the filtered data
+    return {
+        'success': True,
+        'filteredData': records,
+        'resultHandle': result_handle,
+        'summary': {
+            'totalTweets': len(filtered_df),
+            'dateRange': f"{start_date} to {end_date}",
+            'threshold': threshold,
+            'targetNarrative': target_narrative
+        }
+    }
+
+
+def store_result(data, filtered_df, embeddings, owner, text_column):
+    """ Keeps the trace result with its embeddings so generate-narratives can take its handle (unless keepResult is false). """
+    if not data.get('keepResult', True):
+        return None
+    return result_store.save(filtered_df, embeddings, owner=owner, text_column=text_column, model=model_name_of(models.get("sentence")))
+
+
+def parsed_chunks(chunks, stats, max_rows):
+    """ Passes the chunks of an upload through, timing the parse and enforcing max_rows. """
+    while True:
+        start = time.perf_counter()
         try:
-            df["AuthorTweet"] = "Author: " + df["ChannelName"] + "\nTweet: " + df["Tweet"]
-        except KeyError:
-            df["AuthorTweet"] = "Tweet: " + df["Tweet"]
-        
-        # Convert datetime strings to datetime objects for filtering
-        df['Datetime'] = pd.to_datetime(df['Datetime'])
-        
-        start_date = data.get('startDate')
-        end_date = data.get('endDate')
-        target_narrative = data.get('targetNarrative')
-        threshold = data.get('threshold', 0.5)
-        
-        # Call your trace_over_time function
-        filtered_df = trace_over_time(df, sent_model, target_narrative, [start_date, end_date], sim_threshold=threshold)
-        
-        # Replace NaN values with None (which becomes null in JSON)
+            chunk = next(chunks, None)
+        except (ValueError, KeyError) as e:
+            raise RequestError(f'Could not parse the uploaded file: {e}')
+        stats['parseSeconds'] += time.perf_counter() - start
+        if chunk is None:
+            return
+        stats['rows'] += len(chunk)
+        if stats['rows'] > max_rows:
+            raise RequestError(f'The uploaded file has more than {max_rows} rows')
+        yield chunk
+
+
+def trace_upload_file(upload, data, owner=None):
+    """
+    Trace over an uploaded CSV, gzipped CSV or Parquet file (multipart 'file' field). The file is
+    parsed chunk by chunk with only the columns the trace needs (plus 'columns'), and each chunk is
+    scored as it is parsed, so the upload is never held as one frame or as JSON rows.
+    """
+    sent_model = models.get("sentence")
+    start_date = data.get('startDate')
+    end_date = data.get('endDate')
+    target_narrative = data.get('targetNarrative')
+    threshold = data.get('threshold', 0.5)
+    text_column = data.get('textField', 'Tweet')
+    if text_column not in ('Tweet', 'AuthorTweet'):
+        raise RequestError(f'Unsupported textField {text_column}')
+
+    stream = upload.stream
+    stream.seek(0, os.SEEK_END)
+    n_bytes = stream.tell()
+    stream.seek(0)
+    fmt = data.get('format') or upload_format(stream)
+    if fmt not in ('csv', 'gzip', 'parquet'):
+        raise RequestError(f"Unsupported format {fmt}; use 'csv', 'gzip' or 'parquet'")
+    stats = {'format': fmt, 'bytes': n_bytes, 'rows': 0, 'parseSeconds': 0.0}
+    chunks = parsed_chunks(read_upload_chunks(stream, fmt, chunksize=int(data.get('chunkSize', 50000)),
+                                              columns=data.get('columns')), stats, upload_max_rows)
+
+    parts, embeddings = [], []
+    for matched, embeds in trace_over_time_chunks(chunks, sent_model, target_narrative, [start_date, end_date],
+                                                  sim_threshold=threshold, cache=embedding_cache,
+                                                  text_column=text_column, return_embeddings=True):
+        parts.append(matched)
+        embeddings.append(embeds)
+    embedding_cache.log_stats()
+    encoding_stats.log_stats()
+    stats['rowsPerSec'] = stats['rows'] / stats['parseSeconds'] if stats['parseSeconds'] > 0 else 0.0
+    stats['mbPerSec'] = n_bytes / 1024 ** 2 / stats['parseSeconds'] if stats['parseSeconds'] > 0 else 0.0
+    print(f"Parsed {stats['rows']} rows from a {n_bytes / 1024 ** 2:.1f} MB {fmt} upload in {stats['parseSeconds']:.2f}s "
+          f"({stats['rowsPerSec']:.0f} rows/sec, {stats['mbPerSec']:.1f} MB/sec)")
+
+    filtered_df = pd.concat(parts, ignore_index=True) if parts else pd.DataFrame()
+    embeddings = np.concatenate(embeddings) if embeddings else np.empty((0, sent_model.get_sentence_embedding_dimension()), dtype=np.float32)
+    # Replace NaN values with None (which becomes null in JSON)
+    filtered_df = filtered_df.replace({np.nan: None})
+    result_handle = store_result(data, filtered_df, embeddings, owner, text_column)
+    gc.collect()
+
+    return {
+        'success': True,
+        'filteredData': filtered_df.to_dict('records'),
+        'resultHandle': result_handle,
+        'summary': {
+            'totalTweets': len(filtered_df),
+            'dateRange': f"{start_date} to {end_date}",
+            'threshold': threshold,
+            'targetNarrative': target_narrative,
+            'upload': stats
+        }
+    }
+
+
+def trace_settings(data):
+    """ The dataset path and trace parameters of a trace-over-time request. """
+    file = os.path.join(tweets_dir, data.get('file1'))
+    # Which text is embedded: "Tweet" (default) or "AuthorTweet"
+    text_column = data.get('textField', 'Tweet')
+    if text_column not in ('Tweet', 'AuthorTweet'):
+        raise RequestError(f'Unsupported textField {text_column}')
+    return file, data.get('startDate'), data.get('endDate'), data.get('targetNarrative'), data.get('threshold', 0.5), text_column
+
+
+def add_polarity(filtered_df, data, target_narrative, progress=None):
+    """ Runs the polarity check over filtered_df; returns the frame with the polarity columns and the stats. """
+    # polarityMode "labels" (default) scores the four labels in one forward pass; "json" generates the JSON object
+    # Held for the whole check, so the reaper doesn't unload it under a long polarity run
+    with models.using("polarity") as engine:
+        p = PolarityTester(None, None, filtered_df, target_narrative, engine=engine,
+                           mode=data.get('polarityMode', 'labels'), cache=polarity_cache,
+                           # cascadeConfidence trades accuracy for LLM calls; cascade: false sends every tweet to the LLM
+                           cascade=models.get("polarity_cascade") if data.get('cascade', True) else None,
+                           cascade_confidence=data.get('cascadeConfidence'))
+        with model_lock:
+            p.check_polarity(progress)
+            p.multiply_similarity_and_polarity()
+    return p.df, p.stats
+
+
+def trace_file(data, progress=None, owner=None):
+    """ Trace (and optionally polarity) over a dataset in tweets_dir. """
+    file, start_date, end_date, target_narrative, threshold, text_column = trace_settings(data)
+    sent_model = models.get("sentence")
+
+    if progress:
+        progress.update(message="Scoring tweets")
+    # Score the precomputed embeddings for the date range if the dataset is indexed (indexes embed Tweet)
+    index = find_index(file, tweets_dir, index_dir, sent_model) if text_column == 'Tweet' else None
+    if index is not None:
+        # annProbes trades recall for latency when the dataset has an IVF index; 0 scores every row
+        n_probe = int(data.get('annProbes', os.getenv("ANN_PROBES", "0")))
+        filtered_df, embeddings = index.trace(sent_model, target_narrative, [start_date, end_date], sim_threshold=threshold, cache=embedding_cache, n_probe=n_probe,
+                                              return_embeddings=True)
+    else:
+        partitioned = partitioned_path(file, tweets_dir, parquet_dir)
+        if file.endswith('.parquet'):
+            # Row groups outside the date range are skipped
+            df = read_media(file, timeframe=[start_date, end_date])
+        elif is_fresh(partitioned, file):
+            df = read_media(partitioned, timeframe=[start_date, end_date])
+        else:
+            df = read_media(file)
+        filtered_df, embeddings = trace_over_time(df, sent_model, target_narrative, [start_date, end_date], sim_threshold=threshold, cache=embedding_cache, text_column=text_column,
+                                                  return_embeddings=True)
+    embedding_cache.log_stats()
+    encoding_stats.log_stats()
+
+    # Replace NaN values with None (which becomes null in JSON)
+    filtered_df = filtered_df.replace({np.nan: None})
+    # Polarity is opt-in per request: it runs an LLM over every matched tweet
+    polarity_stats = None
+    if data.get('polarity', False) and len(filtered_df):
+        if progress:
+            progress.update(message="Polarity")
+        filtered_df, polarity_stats = add_polarity(filtered_df, data, target_narrative, progress)
+        # Retrain once enough new LLM labels have accumulated, off the request path
+        models.get("polarity_cascade").refit_in_background(polarity_cache, polarity_model_name)
+        polarity_cache.log_stats()
+    result_handle = store_result(data, filtered_df, embeddings, owner, text_column)
+    gc.collect()
+
+    # Convert DataFrame to records
+    records = filtered_df.to_dict('records')
+
+    # Return the filtered data
+    return {
+        'success': True,
+        'filteredData': records,
+        'resultHandle': result_handle,
+        'summary': {
+            'totalTweets': len(filtered_df),
+            'dateRange': f"{start_date} to {end_date}",
+            'threshold': threshold,
+            'targetNarrative': target_narrative,
+            'polarity': polarity_stats
+        }
+    }
+
+
+def trace_file_chunks(data, chunk_size=10000):
+    """ Streaming trace_file: yields the matching rows (with polarity, if asked for) and their embeddings chunk by chunk. """
+    file, start_date, end_date, target_narrative, threshold, text_column = trace_settings(data)
+    timeframe = [start_date, end_date]
+    sent_model = models.get("sentence")
+    index = find_index(file, tweets_dir, index_dir, sent_model) if text_column == 'Tweet' else None
+    if index is not None:
+        n_probe = int(data.get('annProbes', os.getenv("ANN_PROBES", "0")))
+        matched = index.trace_chunks(sent_model, target_narrative, timeframe, sim_threshold=threshold, cache=embedding_cache,
+                                     n_probe=n_probe, chunksize=chunk_size, return_embeddings=True)
+    else:
+        partitioned = partitioned_path(file, tweets_dir, parquet_dir)
+        if file.endswith('.csv') and not is_fresh(partitioned, file):
+            # Never holds more than one chunk of the CSV
+            chunks = read_media_chunks(file, chunksize=chunk_size, compact_dtypes=False)
+        else:
+            df = read_media(file if file.endswith('.parquet') else partitioned, timeframe=timeframe)
+            chunks = (df.iloc[start:start + chunk_size] for start in range(0, len(df), chunk_size))
+        matched = trace_over_time_chunks(chunks, sent_model, target_narrative, timeframe, sim_threshold=threshold,
+                                         cache=embedding_cache, text_column=text_column, return_embeddings=True)
+    for filtered_df, embeddings in matched:
         filtered_df = filtered_df.replace({np.nan: None})
-        gc.collect()
-        
-        # Convert DataFrame to records
-        records = filtered_df.to_dict('records')
-        
-        # Return the filtered data
-        result = {
-            'success': True,
-            'filteredData': records,
-            'summary': {
-                'totalTweets': len(filtered_df),
+        polarity_stats = None
+        if data.get('polarity', False) and len(filtered_df):
+            filtered_df, polarity_stats = add_polarity(filtered_df, data, target_narrative)
+        yield filtered_df, embeddings, polarity_stats
+
+
+def stream_trace(data, fmt, owner=None):
+    """
+    Streams a trace as newline-delimited JSON (fmt "ndjson") or server-sent events ("sse"): one
+    'rows' frame with the matching rows of each scored chunk, then a final 'summary' frame with the
+    same summary as the non-streaming response (or an 'error' frame if the trace fails part way).
+    """
+    file, start_date, end_date, target_narrative, threshold, text_column = trace_settings(data)
+    chunk_size = int(data.get('chunkSize', 10000))
+    if data.get('polarity', False):
+        # Fails (or loads the model) before the response starts rather than in the middle of the stream
+        models.get("polarity")
+
+    def frame(kind, payload):
+        body = app.json.dumps({'type': kind, **payload})
+        return f"event: {kind}\ndata: {body}\n\n" if fmt == 'sse' else body + "\n"
+
+    def frames():
+        total = 0
+        polarity_stats = []
+        writer = None
+        if data.get('keepResult', True):
+            writer = result_store.writer(owner, text_column, model_name_of(models.get("sentence")))
+        try:
+            for filtered_df, embeddings, stats in trace_file_chunks(data, chunk_size):
+                total += len(filtered_df)
+                polarity_stats.append(stats)
+                if len(filtered_df):
+                    if writer is not None:
+                        writer.add(filtered_df, embeddings)
+                    yield frame('rows', {'rows': filtered_df.to_dict('records'), 'totalSoFar': total})
+            embedding_cache.log_stats()
+            encoding_stats.log_stats()
+            if data.get('polarity', False):
+                polarity_cache.log_stats()
+                models.get("polarity_cascade").refit_in_background(polarity_cache, polarity_model_name)
+            gc.collect()
+            yield frame('summary', {'success': True, 'resultHandle': writer.close() if writer is not None else None, 'summary': {
+                'totalTweets': total,
                 'dateRange': f"{start_date} to {end_date}",
                 'threshold': threshold,
-                'targetNarrative': target_narrative
-            }
-        }
-        
-        return jsonify(result)
+                'targetNarrative': target_narrative,
+                'polarity': combine_polarity_stats(polarity_stats)
+            }})
+        except Exception as e:
+            import traceback
+            print(traceback.format_exc())
+            yield frame('error', {'error': str(e)})
+
+    mimetype = 'text/event-stream' if fmt == 'sse' else 'application/x-ndjson'
+    return app.response_class(stream_with_context(frames()), mimetype=mimetype, headers={'Cache-Control': 'no-cache'})
+
+
+def narratives_for(data, progress=None, owner=None):
+    """ Narrative summaries of the clusters in filteredData, or in a stored trace result (resultHandle). """
+    sent_model = models.get("sentence")
+    # Fails (or loads the model) before the rows are read
+    models.get("summary")
+    embeddings = None
+    if data.get('resultHandle'):
+        # The rows and their embeddings are already on the server, so nothing is uploaded or re-embedded
+        try:
+            filtered_df, embeddings, manifest = result_store.load(data['resultHandle'], owner)
+        except (KeyError, ValueError):
+            raise RequestError(f"Unknown or expired resultHandle {data['resultHandle']}")
+        if manifest['text_column'] != 'Tweet' or manifest['model'] != model_name_of(sent_model):
+            # Clustering embeds Tweet with sent_model; other vectors cannot be reused
+            embeddings = None
+    elif 'filteredData' in data:
+        filtered_df = pd.DataFrame(data['filteredData'])
+    else:
+        raise RequestError('Provide resultHandle or filteredData')
+    # Get number of narratives to generate
+    num_narratives = data.get('numNarratives', 3)
+
+    # Use your Narrative_Generator
+    # Optional clustering settings for large datasets: 'auto', 'kmeans' or 'minibatch', and PCA dimensions
+    cluster_method = data.get('clusterMethod', 'auto')
+    if cluster_method not in ('auto', 'kmeans', 'minibatch'):
+        raise RequestError("clusterMethod must be 'auto', 'kmeans' or 'minibatch'")
+    # Held for the whole run: a hierarchical run can outlast the summary model's idle ttl
+    with models.using("summary") as (summary_model, tokenizer):
+        narrative_generator = Narrative_Generator(summary_model, tokenizer, sent_model, filtered_df, num_narratives, cache=embedding_cache,
+                                                  cluster_method=cluster_method, reduce_dim=data.get('reduceDim'), embeddings=embeddings,
+                                                  model_name=SUMMARY_MODEL)
+        with model_lock:
+            if data.get('hierarchical') or data.get('window'):
+                # Map-reduce over time windows ('D', 'W', 'MS', ...) or fixed-size batches, checkpointed per batch
+                narratives_obj, _ = narrative_generator.generate_hierarchical_narratives(
+                    window=data.get('window'), batch_size=data.get('batchSize', 50000), progress=progress)
+            else:
+                narratives_obj, *_ = narrative_generator.generate_narratives(progress)
+    embedding_cache.log_stats()
+    encoding_stats.log_stats()
+
+    # Return the results as an array
+    return {'success': True, 'narratives': narratives_obj, 'timings': narrative_generator.timings,
+            'clusterStats': narrative_generator.cluster_stats}
+
+
+def run_request(fn, data=None):
+    """ Runs fn on the request body (or data) synchronously, mapping bad parameters to 400 and failures to 500. """
+    gc.collect()
+    try:
+        return jsonify(fn(request.json if data is None else data, owner=request.user.get('uid')))
+    except RequestError as e:
+        return jsonify({'error': str(e)}), 400
+    except ModelUnavailable as e:
+        return jsonify({'error': str(e)}), 503
     except Exception as e:
         import traceback
         print(traceback.format_exc())
@@ -172,71 +595,127 @@ def api_trace_over_time_upload():
             'error': str(e)
         }), 500
 
+
+@api.route('/trace-over-time-upload', methods=['POST'])
+@verify_firebase_token
+def api_trace_over_time_upload():
+    """Process uploaded CSV data (sent as JSON) instead of server files.
+    A multipart request with a 'file' (CSV, gzipped CSV or Parquet) and the other parameters as a
+    JSON 'params' field skips the JSON rows entirely."""
+    if 'file' in request.files:
+        try:
+            params = json.loads(request.form.get('params', '{}'))
+        except ValueError:
+            return jsonify({'error': "params must be a JSON object"}), 400
+        upload = request.files['file']
+        return run_request(lambda data, owner: trace_upload_file(upload, data, owner), params)
+    return run_request(trace_uploaded_data)
+
 @api.route('/trace-over-time', methods=['POST'])
 @verify_firebase_token
 def api_trace_over_time():
-    gc.collect()
-    try:
-        # Get parameters from request
-        data = request.json
-        file = os.path.join(tweets_dir, data.get('file1'))
-        df = read_media(file)
-        
-        start_date = data.get('startDate')
-        end_date = data.get('endDate')
-        target_narrative = data.get('targetNarrative')
-        threshold = data.get('threshold', 0.5)
-        
-        # Call your trace_over_time function
-        filtered_df = trace_over_time(df, sent_model, target_narrative, [start_date, end_date], sim_threshold=threshold)
-        
-        # Replace NaN values with None (which becomes null in JSON)
-        filtered_df = filtered_df.replace({np.nan: None})
-        # Use a context manager to ensure proper cleanup
-        # p = PolarityTester(polarity_model, pol_tokenizer, filtered_df, target_narrative)
-        # p.check_polarity()
-        # p.multiply_similarity_and_polarity()
-        # filtered_df = p.df
-        gc.collect()
-        
-        # Convert DataFrame to records
-        records = filtered_df.to_dict('records')
-        
-        # Return the filtered data
-        result = {
-            'success': True,
-            'filteredData': records,
-            'summary': {
-                'totalTweets': len(filtered_df),
-                'dateRange': f"{start_date} to {end_date}",
-                'threshold': threshold,
-                'targetNarrative': target_narrative
-            }
-        }
-        
-        return jsonify(result)
-    except Exception as e:
-        import traceback
-        print(traceback.format_exc())
-        return jsonify({
-            'error': str(e)
-        }), 500
+    """ stream: "ndjson" or "sse" streams the rows as they are scored instead of returning one JSON object. """
+    fmt = request.json.get('stream')
+    if fmt:
+        if fmt not in ('ndjson', 'sse'):
+            return jsonify({'error': "stream must be 'ndjson' or 'sse'"}), 400
+        try:
+            return stream_trace(request.json, fmt, owner=request.user.get('uid'))
+        except RequestError as e:
+            return jsonify({'error': str(e)}), 400
+        except ModelUnavailable as e:
+            return jsonify({'error': str(e)}), 503
+    return run_request(trace_file)
 
 @api.route('/generate-narratives', methods=['POST'])
 @verify_firebase_token
 def api_generate_narratives():
-    data = request.json
-    
-    filtered_df = pd.DataFrame(data['filteredData'])
-    # Get number of narratives to generate
-    num_narratives = data.get('numNarratives', 3)
-    
-    # Use your Narrative_Generator
-    narrative_generator = Narrative_Generator(summary_model, tokenizer, sent_model, filtered_df, num_narratives)
-    narratives_obj, *_ = narrative_generator.generate_narratives()
-    
-    # Return the results as an array
-    return jsonify({'success': True, 'narratives': narratives_obj})
+    return run_request(narratives_for)
+
+
+# Asynchronous versions of the endpoints above: POST returns a job id straight away, and the
+# work runs on the job worker against the already loaded models
+# Under serve.py every worker submits to the shared table but only the one started with JOBS_WORKER=1
+# runs jobs, so there is one job at a time and one copy of the LLMs for them. The parent requeues
+# interrupted jobs once before forking (JOBS_RECOVER=0), and a dead job worker's jobs when it replaces it
+job_queue = JobQueue(os.getenv("JOBS_PATH", "jobs/jobs.sqlite"), max_age_days=int(os.getenv("JOBS_MAX_AGE_DAYS", "7")),
+                     encoder=app.json.dumps, recover=os.getenv("JOBS_RECOVER", "1") == "1")
+job_queue.register('trace-over-time', trace_file)
+job_queue.register('trace-over-time-upload', trace_uploaded_data)
+job_queue.register('generate-narratives', narratives_for)
+if os.getenv("JOBS_WORKER", "1") == "1":
+    job_queue.start()
+
+
+@api.route('/models', methods=['GET'])
+@verify_firebase_token
+def api_models():
+    """ Which models are loaded, their load times and resident memory, the server profile, and the encoder's
+    batching and dedup/padding stats. """
+    sent_model = models.peek("sentence")
+    return jsonify(dict(models.report(), profile=app_profile, encoding=encoding_stats.report(),
+                        encoder=sent_model.stats() if sent_model is not None else None))
+
+
+@api.route('/results/<handle>', methods=['DELETE'])
+@verify_firebase_token
+def api_delete_result(handle):
+    """ Drops a stored trace result before it expires. """
+    try:
+        deleted = result_store.delete(handle, owner=request.user.get('uid'))
+    except ValueError:
+        deleted = False
+    if not deleted:
+        return jsonify({'error': f'Result {handle} not found'}), 404
+    return jsonify({'success': True})
+
+
+@api.route('/jobs/<kind>', methods=['POST'])
+@verify_firebase_token
+def api_submit_job(kind):
+    """ Queues a trace-over-time, trace-over-time-upload or generate-narratives request; takes the same body. """
+    if kind not in job_queue.handlers:
+        return jsonify({'error': f'Unknown job kind {kind}'}), 404
+    job_id = job_queue.submit(kind, request.json, owner=request.user.get('uid'))
+    return jsonify({'success': True, 'job': job_queue.get(job_id)}), 202
+
+
+@api.route('/jobs', methods=['GET'])
+@verify_firebase_token
+def api_list_jobs():
+    return jsonify({'jobs': job_queue.list(owner=request.user.get('uid'))})
+
+
+@api.route('/jobs/<job_id>', methods=['GET'])
+@verify_firebase_token
+def api_job_status(job_id):
+    """ Status and progress (current/total items of the current stage, in message) of a job. """
+    job = job_queue.get(job_id, owner=request.user.get('uid'))
+    if job is None:
+        return jsonify({'error': f'Job {job_id} not found'}), 404
+    return jsonify({'job': job})
+
+
+@api.route('/jobs/<job_id>/result', methods=['GET'])
+@verify_firebase_token
+def api_job_result(job_id):
+    """ The job's response, identical to the synchronous endpoint's; 202 while it is still queued or running. """
+    job = job_queue.get(job_id, owner=request.user.get('uid'))
+    if job is None:
+        return jsonify({'error': f'Job {job_id} not found'}), 404
+    if job['status'] in ('queued', 'running'):
+        return jsonify({'job': job}), 202
+    if job['status'] != 'done':
+        return jsonify({'error': job['error'] or f"Job {job_id} was {job['status']}", 'job': job}), 409
+    return app.response_class(job_queue.result(job_id), mimetype='application/json')
+
+
+@api.route('/jobs/<job_id>', methods=['DELETE'])
+@verify_firebase_token
+def api_cancel_job(job_id):
+    if not job_queue.cancel(job_id, owner=request.user.get('uid')):
+        return jsonify({'error': f'Job {job_id} not found or already finished'}), 404
+    return jsonify({'success': True, 'job': job_queue.get(job_id)})
 
 
 @api.route('/save-filtered-data', methods=['POST'])
@@ -260,11 +739,13 @@ def save_filtered_data():
         
         # Generate unique filename based on timestamp
         timestamp = datetime.datetime.now().strftime("%Y%m%d_%H%M%S")
-        filename = f"filtered_data_{timestamp}.pkl"
-        filepath = os.path.join(save_dir, filename)
-        
-        # Save as pickle
-        df.to_pickle(filepath)
+        # Parquet by default; pickle is still available as an export format
+        if data.get('format', 'parquet') == 'pickle':
+            filename = f"filtered_data_{timestamp}.pkl"
+            df.to_pickle(os.path.join(save_dir, filename))
+        else:
+            filename = f"filtered_data_{timestamp}.parquet"
+            write_parquet(df, os.path.join(save_dir, filename), sort_by=None)
         
         # Also save as CSV for easier access if needed
         csv_filepath = os.path.join(save_dir, f"filtered_data_{timestamp}.csv")
@@ -294,7 +775,7 @@ def list_saved_data():
         if not os.path.exists(save_dir):
             return jsonify({'datasets': []})
             
-        files = [f for f in os.listdir(save_dir) if f.endswith('.pkl')]
+        files = [f for f in os.listdir(save_dir) if f.endswith('.parquet') or f.endswith('.pkl')]
         files.sort(reverse=True)  # Most recent first
         
         return jsonify({'datasets': files})
@@ -324,8 +805,11 @@ def load_saved_data():
         if not os.path.exists(filepath):
             return jsonify({'error': f'File {filename} not found'}), 404
         
-        # Load pickle file
-        df = pd.read_pickle(filepath)
+        # Load the saved analysis (memory-mapped Parquet, or a legacy pickle)
+        if filename.endswith('.parquet'):
+            df = read_parquet(filepath)
+        else:
+            df = pd.read_pickle(filepath)
         
         # Replace NaN values with None for JSON serialization
         df = df.replace({np.nan: None})
@@ -353,7 +837,7 @@ CORS(
     app,
     resources={r"/api/*": {
         "origins": allowed_origins,
-        "methods": ["GET", "POST", "OPTIONS"],
+        "methods": ["GET", "POST", "DELETE", "OPTIONS"],
         "allow_headers": ["Content-Type", "Authorization"],
         "supports_credentials": True
     }}
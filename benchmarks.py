@@ -0,0 +1,329 @@
+import argparse
+import time
+
+from preprocess import read_media
+from model_registry import rss_mb
+
+
+def load_sent_model(name, backend="torch"):
+    from encoder_service import load_sentence_model
+    return load_sentence_model(name, backend)
+
+
+def timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return result, time.perf_counter() - start
+
+
+def _encode_in_child(model_name, backend, encoder, texts, batch_size, barrier, queue):
+    """ One serving worker: encodes texts with its own model copy, or through the shared encoder at
+    encoder=(address, authkey). Reports (seconds, RSS added by the model, RSS after encoding). """
+    from encoder_service import RemoteEncoder
+
+    baseline, _ = rss_mb()
+    model = RemoteEncoder(*encoder) if encoder else load_sent_model(model_name, backend)
+    model.encode(texts[:batch_size], batch_size=batch_size)
+    loaded, _ = rss_mb()
+    barrier.wait()
+    start = time.perf_counter()
+    model.encode(texts, batch_size=batch_size, normalize_embeddings=True)
+    elapsed = time.perf_counter() - start
+    current, _ = rss_mb()
+    queue.put((elapsed, loaded - baseline, current))
+
+
+def bench_workers(file, model_name, worker_counts=(1, 2, 4), n_texts=2000, batch_size=64, backend="torch"):
+    """ Encoding throughput and total RSS as serving workers scale: every worker loading its own
+    encoder vs. all of them sharing one encoder process (serve.py). The n_texts are split evenly
+    across the workers, which start together. """
+    import multiprocessing
+    import os
+    import secrets
+    import shutil
+    import tempfile
+    from encoder_service import run_encoder, RemoteEncoder
+
+    texts = read_media(file)["Tweet"].astype(str).tolist()[:n_texts]
+    context = multiprocessing.get_context("spawn")
+    address = os.path.join(tempfile.mkdtemp(prefix="encoder-"), "encoder.sock")
+    authkey = secrets.token_bytes(16)
+    ready = context.Event()
+    encoder = context.Process(target=run_encoder, args=(address, authkey, model_name, ready, batch_size, 5, backend),
+                              daemon=True)
+    encoder.start()
+    ready.wait()
+    try:
+        print(f"{len(texts)} texts, {os.cpu_count()} CPUs")
+        for mode in ["own model", "shared encoder"]:
+            for n_workers in worker_counts:
+                barrier = context.Barrier(n_workers)
+                queue = context.Queue()
+                shares = [texts[i::n_workers] for i in range(n_workers)]
+                processes = [context.Process(target=_encode_in_child,
+                                             args=(model_name, backend, (address, authkey) if mode == "shared encoder" else None,
+                                                   share, batch_size, barrier, queue))
+                             for share in shares]
+                for process in processes:
+                    process.start()
+                runs = [queue.get() for _ in processes]
+                for process in processes:
+                    process.join()
+                wall = max(run[0] for run in runs)
+                rss = sum(run[2] for run in runs)
+                if mode == "shared encoder":
+                    rss += RemoteEncoder(address, authkey).stats()["rss_mb"]
+                print(f"{mode:>14}, {n_workers:2d} workers: {len(texts) / wall:8.1f} texts/sec, "
+                      f"model RSS per worker +{sum(run[1] for run in runs) / len(runs):.0f} MB, total RSS {rss:.0f} MB")
+    finally:
+        encoder.terminate()
+        shutil.rmtree(os.path.dirname(address), ignore_errors=True)
+
+
+def bench_batching(file, sent_model, n_clients=16, n_requests=200, texts_per_request=4, max_batch_size=64,
+                   max_wait_ms=(0, 2, 5, 10)):
+    """ Many request threads making small encode calls (the dashboard's pattern): direct calls on a shared
+    model under a lock vs. a BatchingEncoder with different max waits. """
+    import threading
+    from concurrent.futures import ThreadPoolExecutor
+    from encoder_service import BatchingEncoder
+
+    texts = read_media(file)["Tweet"].astype(str).tolist()
+    requests = [texts[(i * texts_per_request) % len(texts):][:texts_per_request] for i in range(n_requests)]
+    lock = threading.Lock()
+
+    def locked(batch):
+        with lock:
+            return sent_model.encode(batch, normalize_embeddings=True)
+
+    encoders = [("direct, locked", locked, None)]
+    for wait in max_wait_ms:
+        batcher = BatchingEncoder(sent_model, max_batch_size, wait)
+        encoders.append((f"batched, {wait:g} ms", lambda batch, batcher=batcher: batcher.encode(batch, normalize_embeddings=True),
+                         batcher))
+    for name, encode, batcher in encoders:
+        latencies = []
+
+        def request(batch):
+            start = time.perf_counter()
+            encode(batch)
+            latencies.append(time.perf_counter() - start)
+
+        with ThreadPoolExecutor(n_clients) as pool:
+            _, elapsed = timed(lambda: list(pool.map(request, requests)))
+        latencies.sort()
+        print(f"{name:>16}: {n_requests * texts_per_request / elapsed:8.1f} texts/sec, "
+              f"p50 {latencies[len(latencies) // 2] * 1000:.1f} ms, p95 {latencies[int(len(latencies) * 0.95)] * 1000:.1f} ms")
+        if batcher is not None:
+            stats = batcher.stats()
+            print(f"{'':>18}mean batch {stats['mean_batch_size']:.1f}, batch sizes {stats['batch_size_histogram']}, "
+                  f"queue depths {stats['queue_depth_histogram']}")
+
+
+def bench_time_to_first_result(file, sent_model, target_narrative, timeframe, threshold=0.4, repeats=3,
+                               tweets_dir="tweets"):
+    """ Time from request to filtered frame: full CSV parse + trace vs. day-partitioned read + trace. """
+    from graph_sims import trace_over_time
+    from storage import partitioned_path, is_fresh, write_day_partitioned
+
+    partitioned = partitioned_path(file, tweets_dir)
+    if not is_fresh(partitioned, file):
+        write_day_partitioned(read_media(file), partitioned, source=file)
+
+    def csv_path():
+        return trace_over_time(read_media(file), sent_model, target_narrative, timeframe, sim_threshold=threshold)
+
+    def parquet_path():
+        df = read_media(partitioned, timeframe=timeframe)
+        return trace_over_time(df, sent_model, target_narrative, timeframe, sim_threshold=threshold)
+
+    for name, fn in [("csv", csv_path), ("day-partitioned parquet", parquet_path)]:
+        times = []
+        for _ in range(repeats):
+            result, elapsed = timed(fn)
+            times.append(elapsed)
+        print(f"{name:>24}: best {min(times):.3f}s, mean {sum(times) / len(times):.3f}s, {len(result)} matches")
+
+
+def load_polarity_engine(backend, model_name=None, batch_size=16):
+    from polarity_engine import make_polarity_engine
+    if backend == "mlx":
+        from mlx_lm import load
+        model, tokenizer = load(model_name)
+        return make_polarity_engine("mlx", model, tokenizer, batch_size=batch_size)
+    if backend == "transformers":
+        return make_polarity_engine("transformers", model_name, batch_size=batch_size)
+    return make_polarity_engine(backend, batch_size=batch_size)
+
+
+def bench_polarity(file, engine, target_narrative, n_tweets=200):
+    """ Throughput of JSON generation vs. single-token label scoring, and how often the two agree. """
+    from impact_analysis import PolarityTester
+
+    df = read_media(file).head(n_tweets)
+    polarities = {}
+    for mode in ["json", "labels"]:
+        tester = PolarityTester(None, None, df.copy(), target_narrative, engine=engine, mode=mode)
+        _, elapsed = timed(tester.check_polarity)
+        polarities[mode] = tester.df["polarity"]
+        print(f"{mode:>8}: {elapsed:.2f}s, {len(df) / elapsed:.1f} tweets/sec, "
+              f"{dict(tester.df['polarity'].value_counts())}")
+
+    agree = (polarities["json"] == polarities["labels"]).mean()
+    sure = (polarities["json"] != "unsure") & (polarities["labels"] != "unsure")
+    print(f"Agreement: {agree:.1%} overall")
+    if sure.any():
+        print(f"Agreement where neither is unsure: {(polarities['json'][sure] == polarities['labels'][sure]).mean():.1%} "
+              f"({sure.sum()} tweets)")
+
+
+def bench_upload(file, repeats=3):
+    """ Parse throughput of an upload as JSON rows (uploadedData) vs. a CSV, gzipped CSV or Parquet file. """
+    import gzip
+    import io
+    import json
+    import pandas as pd
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+    from preprocess import read_upload_chunks
+    from storage import arrow_safe
+
+    df = read_media(file)
+    payloads = {"json rows": json.dumps(df.to_dict("records"), default=str).encode("utf-8"),
+                "csv": df.to_csv(index=False).encode("utf-8")}
+    payloads["gzip"] = gzip.compress(payloads["csv"])
+    buffer = io.BytesIO()
+    pq.write_table(pa.Table.from_pandas(arrow_safe(df), preserve_index=False), buffer, compression="zstd")
+    payloads["parquet"] = buffer.getvalue()
+
+    def parse(name, payload):
+        if name == "json rows":
+            return len(pd.DataFrame(json.loads(payload)))
+        return sum(len(chunk) for chunk in read_upload_chunks(io.BytesIO(payload)))
+
+    for name, payload in payloads.items():
+        times = []
+        for _ in range(repeats):
+            n_rows, elapsed = timed(parse, name, payload)
+            times.append(elapsed)
+        size_mb = len(payload) / 1024 ** 2
+        print(f"{name:>10}: {size_mb:8.1f} MB, parse best {min(times):.3f}s, {n_rows / min(times):,.0f} rows/sec, "
+              f"{size_mb / min(times):.1f} MB/sec")
+
+
+def _load_in_child(kind, path, columns, queue):
+    """ Loads path in a fresh process and reports (seconds, MB of RSS added by the load, rows). """
+    import pandas as pd
+    from storage import read_parquet
+
+    baseline, _ = rss_mb()
+    start = time.perf_counter()
+    if kind == "pickle":
+        df = pd.read_pickle(path)
+        if columns:
+            df = df[columns]
+    elif kind == "csv":
+        df = pd.read_csv(path, usecols=columns)
+    else:
+        df = read_parquet(path, columns=columns)
+    elapsed = time.perf_counter() - start
+    _, peak = rss_mb()
+    queue.put((elapsed, peak - baseline, len(df)))
+
+
+def bench_storage(file, out_dir="benchmark_output", columns=None, repeats=3):
+    """ Load time and peak RSS of the pickle round-trip vs. CSV vs. memory-mapped Parquet for one dataset. """
+    import multiprocessing
+    import os
+    import pandas as pd
+    from storage import write_parquet
+
+    os.makedirs(out_dir, exist_ok=True)
+    df = read_media(file)
+    name = os.path.splitext(os.path.basename(file))[0]
+    paths = {"pickle": os.path.join(out_dir, name + ".pkl"), "csv": os.path.join(out_dir, name + ".csv"),
+             "parquet": os.path.join(out_dir, name + ".parquet")}
+    df.to_pickle(paths["pickle"])
+    df.to_csv(paths["csv"], index=False)
+    write_parquet(df, paths["parquet"])
+
+    context = multiprocessing.get_context("spawn")
+    for kind, path in paths.items():
+        runs = []
+        for _ in range(repeats):
+            queue = context.Queue()
+            process = context.Process(target=_load_in_child, args=(kind, path, columns, queue))
+            process.start()
+            runs.append(queue.get())
+            process.join()
+        best = min(runs)
+        size_mb = os.path.getsize(path) / 1024 ** 2
+        print(f"{kind:>8}: {size_mb:8.1f} MB on disk, load best {best[0]:.3f}s, "
+              f"peak RSS +{max(run[1] for run in runs):.0f} MB, {best[2]} rows")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Benchmarks for the tracing and storage paths.")
+    parser.add_argument("--model", default="sentence-transformers/all-MiniLM-L6-v2", help="Sentence encoder for benchmarks that embed")
+    parser.add_argument("--encoder-backend", dest="encoder_backend", default="torch", choices=["torch", "int8", "onnx"],
+                        help="Encoder backend (see encoder_service.py)")
+    subparsers = parser.add_subparsers(dest="benchmark", required=True)
+
+    ttfr = subparsers.add_parser("ttfr", help="Time to first result for a date range query")
+    ttfr.add_argument("file")
+    ttfr.add_argument("--start", required=True)
+    ttfr.add_argument("--end", required=True)
+    ttfr.add_argument("--narrative", default="The 2020 election was stolen")
+    ttfr.add_argument("--threshold", type=float, default=0.4)
+    ttfr.add_argument("--repeats", type=int, default=3)
+    ttfr.add_argument("--tweets-dir", default="tweets")
+
+    storage = subparsers.add_parser("storage", help="Load time and RSS of pickle vs. CSV vs. Parquet")
+    storage.add_argument("file")
+    storage.add_argument("--columns", nargs="*", default=None, help="Only load these columns")
+    storage.add_argument("--repeats", type=int, default=3)
+
+    polarity = subparsers.add_parser("polarity", help="JSON generation vs. label-logit polarity: throughput and agreement")
+    polarity.add_argument("file")
+    polarity.add_argument("--narrative", default="The 2020 election was stolen")
+    polarity.add_argument("--n", type=int, default=200, help="Number of tweets to classify")
+    polarity.add_argument("--backend", default="mlx", choices=["mlx", "transformers", "stub"])
+    polarity.add_argument("--polarity-model", default="mlx-community/Mistral-Small-24B-Instruct-2501-4bit")
+    polarity.add_argument("--batch-size", type=int, default=16)
+
+    workers = subparsers.add_parser("workers", help="Encoding throughput and RSS per worker count: own model vs. shared encoder")
+    workers.add_argument("file")
+    workers.add_argument("--workers", type=int, nargs="+", default=[1, 2, 4])
+    workers.add_argument("--n", type=int, default=2000, help="Number of tweets to encode, split across the workers")
+    workers.add_argument("--batch-size", type=int, default=64)
+
+    batching = subparsers.add_parser("batching", help="Concurrent small encode calls: locked direct calls vs. micro-batching")
+    batching.add_argument("file")
+    batching.add_argument("--clients", type=int, default=16)
+    batching.add_argument("--requests", type=int, default=200)
+    batching.add_argument("--texts-per-request", type=int, default=4)
+    batching.add_argument("--max-batch-size", type=int, default=64)
+    batching.add_argument("--max-wait-ms", type=float, nargs="+", default=[0, 2, 5, 10])
+
+    upload = subparsers.add_parser("upload", help="Parse throughput of JSON rows vs. CSV, gzip and Parquet uploads")
+    upload.add_argument("file")
+    upload.add_argument("--repeats", type=int, default=3)
+
+    args = parser.parse_args()
+    if args.benchmark == "ttfr":
+        bench_time_to_first_result(args.file, load_sent_model(args.model, args.encoder_backend), args.narrative, [args.start, args.end],
+                                   threshold=args.threshold, repeats=args.repeats,
+                                   tweets_dir=args.tweets_dir)
+    elif args.benchmark == "storage":
+        bench_storage(args.file, columns=args.columns, repeats=args.repeats)
+    elif args.benchmark == "polarity":
+        bench_polarity(args.file, load_polarity_engine(args.backend, args.polarity_model, args.batch_size),
+                       args.narrative, n_tweets=args.n)
+    elif args.benchmark == "workers":
+        bench_workers(args.file, args.model, args.workers, n_texts=args.n, batch_size=args.batch_size, backend=args.encoder_backend)
+    elif args.benchmark == "batching":
+        bench_batching(args.file, load_sent_model(args.model, args.encoder_backend), n_clients=args.clients, n_requests=args.requests,
+                       texts_per_request=args.texts_per_request, max_batch_size=args.max_batch_size,
+                       max_wait_ms=args.max_wait_ms)
+    elif args.benchmark == "upload":
+        bench_upload(args.file, repeats=args.repeats)
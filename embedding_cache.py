@@ -0,0 +1,138 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+
+import numpy as np
+from preprocess import normalize_text
+
+
+class EmbeddingCache():
+    """
+    Content-addressed on-disk store of sentence embeddings.
+
+    Entries are keyed by sha1(model name + normalized text) and stored as raw float16 or float32
+    bytes in a single SQLite file. When the stored vectors exceed max_bytes the least recently
+    used entries are evicted. Hit, miss and eviction counts are kept for logging.
+    """
+    def __init__(self, path="embedding_cache/embeddings.sqlite", max_bytes=2 * 1024 ** 3, dtype="float32"):
+        if dtype not in ("float16", "float32"):
+            raise ValueError(f"Error: Unsupported cache dtype '{dtype}'. Use 'float16' or 'float32'.")
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_bytes = max_bytes
+        self.dtype = np.dtype(dtype)
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS embeddings ("
+            "key TEXT PRIMARY KEY, model TEXT, dtype TEXT, vector BLOB, nbytes INTEGER, last_used REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS embeddings_last_used ON embeddings (last_used)")
+        self._conn.commit()
+        self.total_bytes = self._conn.execute("SELECT COALESCE(SUM(nbytes), 0) FROM embeddings").fetchone()[0]
+
+
+    @staticmethod
+    def make_key(model_name, text):
+        return hashlib.sha1((model_name + "\0" + normalize_text(text)).encode("utf-8")).hexdigest()
+
+
+    def lookup(self, model_name, texts):
+        """ Returns a list with the cached float32 embedding of each text, or None where it is not cached. """
+        keys = [self.make_key(model_name, text) for text in texts]
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                batch = list(set(keys[start:start + 500]))
+                rows = self._conn.execute(
+                    f"SELECT key, dtype, vector FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                for key, dtype, vector in rows:
+                    found[key] = np.frombuffer(vector, dtype=dtype).astype(np.float32)
+            if found:
+                now = time.time()
+                self._conn.executemany("UPDATE embeddings SET last_used = ? WHERE key = ?",
+                                       [(now, key) for key in found])
+                self._conn.commit()
+            embeddings = [found.get(key) for key in keys]
+            n_hits = sum(embedding is not None for embedding in embeddings)
+            self.hits += n_hits
+            self.misses += len(keys) - n_hits
+        return embeddings
+
+
+    def store(self, model_name, texts, embeddings):
+        """ Adds the embeddings of texts to the cache, evicting least recently used entries if over max_bytes. """
+        now = time.time()
+        rows = {}
+        for text, embedding in zip(texts, embeddings):
+            vector = np.asarray(embedding, dtype=self.dtype).tobytes()
+            rows[self.make_key(model_name, text)] = (model_name, self.dtype.name, vector, len(vector), now)
+        keys = list(rows)
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                existing = self._conn.execute(
+                    f"SELECT COALESCE(SUM(nbytes), 0) FROM embeddings WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchone()[0]
+                self.total_bytes -= existing
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO embeddings (key, model, dtype, vector, nbytes, last_used) VALUES (?, ?, ?, ?, ?, ?)",
+                [(key, *row) for key, row in rows.items()],
+            )
+            self.total_bytes += sum(row[3] for row in rows.values())
+            self._evict()
+            self._conn.commit()
+
+
+    def _evict(self):
+        """ Deletes the least recently used entries until the cache is back under max_bytes. Caller holds the lock. """
+        while self.total_bytes > self.max_bytes:
+            oldest = self._conn.execute(
+                "SELECT key, nbytes FROM embeddings ORDER BY last_used ASC LIMIT 1000"
+            ).fetchall()
+            if not oldest:
+                self.total_bytes = 0
+                break
+            evicted = []
+            for key, nbytes in oldest:
+                if self.total_bytes <= self.max_bytes:
+                    break
+                evicted.append((key,))
+                self.total_bytes -= nbytes
+            self._conn.executemany("DELETE FROM embeddings WHERE key = ?", evicted)
+            self.evictions += len(evicted)
+
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "total_bytes": self.total_bytes,
+            "max_bytes": self.max_bytes,
+        }
+
+
+    def log_stats(self):
+        stats = self.stats()
+        print("Embedding cache: {hits} hits, {misses} misses ({rate:.1%} hit rate), {evictions} evictions, "
+              "{mb:.1f}/{max_mb:.1f} MB".format(hits=stats["hits"], misses=stats["misses"], rate=stats["hit_rate"],
+                                                evictions=stats["evictions"], mb=stats["total_bytes"] / 1024 ** 2,
+                                                max_mb=stats["max_bytes"] / 1024 ** 2))
+        return stats
+
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,343 @@
+import argparse
+import json
+import os
+import shutil
+import time
+
+import numpy as np
+import pandas as pd
+import pyarrow.parquet as pq
+from preprocess import read_media_chunks, embed_texts, embed_narratives, model_name_of, to_naive_utc, dataset_datetimes, \
+    source_signature, add_datetime_column
+from storage import write_parquet, read_parquet
+from ann_index import IVFIndex, search
+
+
+INDEX_DIR = "embedding_index"
+ID_COLUMNS = ["id", "PostId", "Tweetid"]
+
+
+def index_path(index_dir, tweets_dir, file):
+    """ Index directory for a dataset, mirroring its path relative to tweets_dir. """
+    relpath = os.path.relpath(file, tweets_dir)
+    return os.path.join(index_dir, os.path.splitext(relpath)[0])
+
+
+class DatasetIndex():
+    """
+    Precomputed embeddings for one dataset under tweets/.
+
+    The index directory holds embeddings.npy, an (n, dim) float32 matrix of unit-length Tweet
+    embeddings sorted by Datetime, plus one .npy file per sidecar column (ids, datetimes,
+    channels, and rows, the row position in the source CSV). Everything is memory-mapped so
+    a date range query only pages in the rows it scores. An optional IVF index (ann_index.py)
+    stored alongside lets threshold queries probe only part of the matrix.
+
+    The source rows are also kept as Parquet parts of rows_chunk rows each, in file order, so a
+    trace reads only the parts holding its matches instead of the CSV. When the source file is
+    already in (or in reverse) chronological order, the manifest's file_order says so and a row's
+    position among the rows of a date range is its offset from the range's first (or last) row, with no sort.
+    Indexes built before either existed fall back to reading the CSV and sorting the range.
+    """
+    COLUMNS = ["ids", "datetimes", "channels", "rows"]
+
+    def __init__(self, path):
+        with open(os.path.join(path, "manifest.json")) as f:
+            self.manifest = json.load(f)
+        self.path = path
+        self.embeddings = np.load(os.path.join(path, "embeddings.npy"), mmap_mode="r")
+        for column in self.COLUMNS:
+            setattr(self, column, np.load(os.path.join(path, f"{column}.npy"), mmap_mode="r", allow_pickle=False))
+        self.ann = IVFIndex.load(path)
+
+
+    def build_ann(self, n_lists=None):
+        """ Trains and saves an IVF index over this dataset's embeddings (none for an empty dataset). """
+        self.ann = IVFIndex.build(self.embeddings, n_lists=n_lists)
+        if self.ann is not None:
+            self.ann.save(self.path)
+        return self.ann
+
+
+    @staticmethod
+    def exists(path):
+        return os.path.exists(os.path.join(path, "manifest.json"))
+
+
+    def is_fresh(self, model_name=None):
+        """ Whether the index still matches its source file (and model, if given). """
+        source = self.manifest["source"]
+        if not os.path.exists(source) or source_signature(source) != {
+                "source_size": self.manifest["source_size"], "source_mtime": self.manifest["source_mtime"]}:
+            return False
+        return model_name is None or model_name == self.manifest["model"]
+
+
+    def date_range(self, start, end):
+        """ Returns the [lo, hi) positions of rows with start <= Datetime <= end. """
+        lo = 0 if start is None else np.searchsorted(self.datetimes, np.datetime64(to_naive_utc([start])[0]), side="left")
+        hi = len(self.datetimes) if end is None else np.searchsorted(self.datetimes, np.datetime64(to_naive_utc([end])[0]), side="right")
+        return int(lo), int(hi)
+
+
+    def score(self, narrative_embed, start=None, end=None):
+        """ Cosine similarity of every row in the date range to a unit-length narrative embedding, in one matmul. """
+        lo, hi = self.date_range(start, end)
+        return lo, hi, np.asarray(self.embeddings[lo:hi] @ narrative_embed, dtype=np.float32)
+
+
+    def matches(self, sent_model, target_narrative, timeframe, sim_threshold=0.4, cache=None, n_probe=None):
+        """
+        Source row numbers (in file order) of the rows in the timeframe whose similarity to
+        target_narrative is at least sim_threshold, with their similarities, their positions
+        among the rows in the timeframe and their positions in the embedding matrix.
+        If n_probe is given and the dataset has an IVF index, only the n_probe nearest lists are
+        scored; candidates are rescored exactly, so Similarity matches the brute-force path.
+        """
+        narrative_embed = embed_narratives(sent_model, [target_narrative], cache=cache)[0]
+        lo, hi = self.date_range(timeframe[0], timeframe[1])
+        if n_probe and self.ann is not None:
+            positions, matched_sims = search(self.embeddings, self.ann, narrative_embed, n_probe=n_probe,
+                                             threshold=sim_threshold, lo=lo, hi=hi)
+        else:
+            _, _, sims = self.score(narrative_embed, timeframe[0], timeframe[1])
+            positions = lo + np.nonzero(sims >= sim_threshold)[0]
+            matched_sims = sims[positions - lo]
+        positions = np.asarray(positions, dtype=np.int64)
+        file_order = self.manifest.get("file_order")
+        if file_order == "ascending":
+            # rows is the identity: the rows in the range are source rows lo..hi-1
+            order = np.argsort(positions, kind="stable")
+            return positions[order], matched_sims[order], positions[order] - lo, positions[order]
+        if file_order == "descending":
+            order = np.argsort(-positions, kind="stable")
+            return np.asarray(self.rows[positions[order]]), matched_sims[order], hi - 1 - positions[order], positions[order]
+        in_range_rows = np.asarray(self.rows[lo:hi])
+        matched_rows = np.asarray(self.rows[positions])
+        order = np.argsort(matched_rows)
+        matched_rows, matched_sims = matched_rows[order], matched_sims[order]
+        return matched_rows, matched_sims, np.searchsorted(np.sort(in_range_rows), matched_rows), positions[order]
+
+
+    def part_path(self, part):
+        return os.path.join(self.path, "rows", f"rows-{part:05d}.parquet")
+
+
+    def iter_rows(self, rows, chunksize=50000):
+        """ Yields the given sorted source rows, one Parquet part at a time (CSV chunks for older indexes). """
+        rows_chunk = self.manifest.get("rows_chunk")
+        if not rows_chunk:
+            yield from iter_rows(self.manifest["source"], rows, chunksize)
+            return
+        rows = np.asarray(rows, dtype=np.int64)
+        parts = rows // rows_chunk
+        for group in np.split(rows, np.flatnonzero(np.diff(parts)) + 1):
+            if len(group):
+                part = int(group[0] // rows_chunk)
+                yield read_parquet(self.part_path(part)).iloc[group - part * rows_chunk]
+
+
+    def read_rows(self, rows):
+        """ The given sorted source rows as one frame. """
+        if not self.manifest.get("rows_chunk"):
+            return read_rows(self.manifest["source"], rows)
+        parts = list(self.iter_rows(rows))
+        if parts:
+            return pd.concat(parts)
+        if os.path.exists(self.part_path(0)):
+            return pq.read_schema(self.part_path(0)).empty_table().to_pandas()
+        return pd.DataFrame()
+
+
+    @staticmethod
+    def matched_frame(rows_df, sims, positions):
+        filtered_df = add_datetime_column(rows_df, sort=False)
+        filtered_df["Similarity"] = sims.astype(np.float64)
+        # 'index' is the row's position among the rows in the timeframe, as in trace_over_time
+        filtered_df.index = positions
+        filtered_df.reset_index(drop=False, inplace=True)
+        return filtered_df
+
+
+    def trace(self, sent_model, target_narrative, timeframe, sim_threshold=0.4, cache=None, n_probe=None,
+              return_embeddings=False):
+        """
+        Index-backed equivalent of graph_sims.trace_over_time: returns the source rows in the
+        timeframe whose similarity to target_narrative is at least sim_threshold, in file order,
+        with the same 'index' and 'Similarity' columns (and their embeddings, with return_embeddings).
+        """
+        rows, sims, positions, embedding_rows = self.matches(sent_model, target_narrative, timeframe, sim_threshold, cache, n_probe)
+        filtered_df = self.matched_frame(self.read_rows(rows), sims, positions)
+        if return_embeddings:
+            return filtered_df, np.asarray(self.embeddings[embedding_rows], dtype=np.float32)
+        return filtered_df
+
+
+    def trace_chunks(self, sent_model, target_narrative, timeframe, sim_threshold=0.4, cache=None, n_probe=None,
+                     chunksize=50000, return_embeddings=False):
+        """ Streaming trace: yields the matching rows one stored part (or CSV chunk) at a time instead of one frame. """
+        rows, sims, positions, embedding_rows = self.matches(sent_model, target_narrative, timeframe, sim_threshold, cache, n_probe)
+        done = 0
+        for part in self.iter_rows(rows, chunksize):
+            if len(part):
+                matched = self.matched_frame(part, sims[done:done + len(part)], positions[done:done + len(part)])
+                if return_embeddings:
+                    yield matched, np.asarray(self.embeddings[embedding_rows[done:done + len(part)]], dtype=np.float32)
+                else:
+                    yield matched
+                done += len(part)
+
+
+def iter_rows(file, rows, chunksize=50000):
+    """ Yields the given sorted row positions of a CSV chunk by chunk (an empty frame for chunks without any). """
+    header = list(pd.read_csv(file, nrows=0, encoding="utf-8", encoding_errors="ignore").columns)
+    offset = 0
+    for chunk in read_media_chunks(file, chunksize=chunksize, columns=header, compact_dtypes=False):
+        lo, hi = np.searchsorted(rows, [offset, offset + len(chunk)])
+        yield chunk.iloc[rows[lo:hi] - offset]
+        offset += len(chunk)
+        if hi == len(rows):
+            break
+
+
+def read_rows(file, rows, chunksize=50000):
+    """ Reads only the given sorted row positions of a CSV, streaming it so the full frame is never held. """
+    parts = [part for i, part in enumerate(iter_rows(file, rows, chunksize)) if len(part) or i == 0]
+    if not parts:
+        return pd.DataFrame(columns=list(pd.read_csv(file, nrows=0, encoding="utf-8", encoding_errors="ignore").columns))
+    return pd.concat(parts)
+
+
+def build_index(file, sent_model, out_path, batch_size=64, chunk_size=10000, cache=None):
+    """ Embeds every Tweet of a dataset and writes its DatasetIndex to out_path.
+    The CSV is streamed chunk by chunk, so only the sidecar columns of the whole file are held in memory;
+    each chunk's rows are written out as one Parquet part. """
+    start_time = time.perf_counter()
+    tmp_path = out_path + ".tmp"
+    shutil.rmtree(tmp_path, ignore_errors=True)
+    os.makedirs(tmp_path)
+    dim = sent_model.get_sentence_embedding_dimension()
+    # Read the way iter_rows reads the CSV, so stored rows match what older indexes return
+    header = list(pd.read_csv(file, nrows=0, encoding="utf-8", encoding_errors="ignore").columns)
+
+    # Embeddings are appended in file order, then gathered into Datetime order below
+    unsorted_file = os.path.join(tmp_path, "embeddings.f32")
+    ids, datetimes, channels = [], [], []
+    with open(unsorted_file, "wb") as f:
+        for part, chunk in enumerate(read_media_chunks(file, chunksize=chunk_size, columns=header, compact_dtypes=False)):
+            embeddings = embed_texts(sent_model, chunk["Tweet"], batch_size=batch_size, cache=cache)
+            embeddings.tofile(f)
+            write_parquet(chunk, os.path.join(tmp_path, "rows", f"rows-{part:05d}.parquet"), sort_by=None)
+            datetimes.append(dataset_datetimes(chunk).to_numpy(dtype="datetime64[ns]"))
+            id_column = next((column for column in ID_COLUMNS if column in chunk.columns), None)
+            ids.append(chunk[id_column].astype(str).to_numpy() if id_column
+                       else np.arange(len(chunk)).astype(str))
+            channels.append(chunk["ChannelName"].astype(object).fillna("").astype(str).to_numpy()
+                            if "ChannelName" in chunk.columns else np.full(len(chunk), ""))
+    datetimes = np.concatenate(datetimes) if datetimes else np.empty(0, dtype="datetime64[ns]")
+    n_rows = len(datetimes)
+    # Sort chronologically so any date range is one contiguous slice; NaT sorts last
+    order = np.argsort(datetimes, kind="stable")
+    file_order = None
+    if np.array_equal(order, np.arange(n_rows)):
+        file_order = "ascending"
+    else:
+        # Newest-first exports: break ties by descending row too, so rows comes out exactly reversed
+        reverse = np.lexsort((-np.arange(n_rows), datetimes))
+        if np.array_equal(reverse, np.arange(n_rows)[::-1]):
+            order, file_order = reverse, "descending"
+
+    embeddings = np.lib.format.open_memmap(os.path.join(tmp_path, "embeddings.npy"), mode="w+",
+                                           dtype=np.float32, shape=(n_rows, dim))
+    if n_rows:
+        unsorted = np.memmap(unsorted_file, dtype=np.float32, mode="r", shape=(n_rows, dim))
+        for begin in range(0, n_rows, chunk_size):
+            embeddings[begin:begin + chunk_size] = unsorted[order[begin:begin + chunk_size]]
+        del unsorted
+    embeddings.flush()
+    del embeddings
+    os.remove(unsorted_file)
+
+    np.save(os.path.join(tmp_path, "ids.npy"), np.concatenate(ids)[order].astype(str) if ids else np.empty(0, dtype=str))
+    np.save(os.path.join(tmp_path, "datetimes.npy"), datetimes[order])
+    np.save(os.path.join(tmp_path, "channels.npy"), np.concatenate(channels)[order].astype(str) if channels else np.empty(0, dtype=str))
+    np.save(os.path.join(tmp_path, "rows.npy"), order.astype(np.int64))
+    manifest = {
+        "source": file,
+        **source_signature(file),
+        "model": model_name_of(sent_model),
+        "n_rows": int(n_rows),
+        "dim": int(dim),
+        "rows_chunk": int(chunk_size),
+        "file_order": file_order,
+        "built_at": time.time(),
+    }
+    with open(os.path.join(tmp_path, "manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=4)
+
+    shutil.rmtree(out_path, ignore_errors=True)
+    os.replace(tmp_path, out_path)
+    elapsed = time.perf_counter() - start_time
+    print(f"Indexed {n_rows} tweets from {file} in {elapsed:.1f}s -> {out_path}")
+    return DatasetIndex(out_path)
+
+
+def find_index(file, tweets_dir="tweets", index_dir=INDEX_DIR, sent_model=None):
+    """ Returns the DatasetIndex for file if one exists and is up to date, otherwise None. """
+    path = index_path(index_dir, tweets_dir, file)
+    if not DatasetIndex.exists(path):
+        return None
+    index = DatasetIndex(path)
+    return index if index.is_fresh(model_name_of(sent_model) if sent_model is not None else None) else None
+
+
+def build_indexes(sent_model, tweets_dir="tweets", index_dir=INDEX_DIR, batch_size=64, rebuild=False, cache=None,
+                  ann=False, n_lists=None):
+    """
+    Builds indexes for every CSV under tweets_dir that has no up-to-date index yet.
+    Existing fresh indexes are left untouched, so new files are indexed incrementally.
+    With ann=True an IVF index is also built for every index that lacks one.
+    Returns a dict mapping each dataset to its index path.
+    """
+    indexes = {}
+    model_name = model_name_of(sent_model)
+    for root, _, filenames in os.walk(tweets_dir):
+        for filename in sorted(filenames):
+            if not filename.endswith(".csv"):
+                continue
+            file = os.path.join(root, filename)
+            path = index_path(index_dir, tweets_dir, file)
+            if not rebuild and DatasetIndex.exists(path) and DatasetIndex(path).is_fresh(model_name):
+                print(f"Index for {file} is up to date")
+                index = DatasetIndex(path)
+                if ann and index.ann is None:
+                    index.build_ann(n_lists)
+                indexes[file] = path
+                continue
+            try:
+                index = build_index(file, sent_model, path, batch_size=batch_size, cache=cache)
+                if ann:
+                    index.build_ann(n_lists)
+                indexes[file] = path
+            except (ValueError, KeyError) as e:
+                # Raw exports without a Tweet column need preprocess.process_full_tweets first
+                print(f"Skipping {file}: {e}")
+    return indexes
+
+
+if __name__ == "__main__":
+    from sentence_transformers import SentenceTransformer
+
+    parser = argparse.ArgumentParser(description="Precompute embedding indexes for the datasets under tweets/.")
+    parser.add_argument("--tweets-dir", default="tweets")
+    parser.add_argument("--index-dir", default=INDEX_DIR)
+    parser.add_argument("--model", default="sentence-transformers/all-MiniLM-L6-v2")
+    parser.add_argument("--batch-size", type=int, default=64)
+    parser.add_argument("--rebuild", action="store_true", help="Rebuild every index, not just new or stale ones")
+    parser.add_argument("--ann", action="store_true", help="Also build an IVF index for approximate search")
+    parser.add_argument("--n-lists", type=int, default=None, help="IVF lists per dataset (default 4 * sqrt(rows))")
+    args = parser.parse_args()
+
+    sent_model = SentenceTransformer(args.model)
+    build_indexes(sent_model, args.tweets_dir, args.index_dir, batch_size=args.batch_size, rebuild=args.rebuild,
+                  ann=args.ann, n_lists=args.n_lists)
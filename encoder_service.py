@@ -0,0 +1,300 @@
+import collections
+import os
+import threading
+import time
+from concurrent.futures import Future
+from multiprocessing.connection import Listener, Client
+from types import SimpleNamespace
+
+import numpy as np
+from model_registry import rss_mb
+from preprocess import model_name_of, encode_unique, encoding_stats
+
+SENTENCE_MODEL = "sentence-transformers/all-MiniLM-L6-v2"
+
+
+# torch: fp32 PyTorch (on MPS when available); int8: PyTorch with dynamically quantized int8 Linear
+# layers, CPU only; onnx: ONNX Runtime on CPU (needs optimum[onnxruntime])
+ENCODER_BACKENDS = ("torch", "int8", "onnx")
+
+
+def load_sentence_model(name=SENTENCE_MODEL, backend="torch", onnx_file=None):
+    """
+    Loads the sentence encoder with one of ENCODER_BACKENDS. onnx_file picks one of the exported
+    files in the model's repo, e.g. "onnx/model_qint8_avx512_vnni.onnx" for a quantized ONNX model.
+    Check a backend with `python glue_eval.py --compare torch <backend>` before switching to it.
+    """
+    from sentence_transformers import SentenceTransformer
+    import torch
+
+    if backend not in ENCODER_BACKENDS:
+        raise ValueError(f"Error: Unknown encoder backend '{backend}'. Use one of {ENCODER_BACKENDS}.")
+    if backend == "onnx":
+        sent_model = SentenceTransformer(name, backend="onnx", model_kwargs={"file_name": onnx_file} if onnx_file else None)
+        print(f"SentenceTransformer using ONNX Runtime{f' ({onnx_file})' if onnx_file else ''}")
+    elif backend == "int8":
+        sent_model = torch.ao.quantization.quantize_dynamic(SentenceTransformer(name, device="cpu"), {torch.nn.Linear},
+                                                            dtype=torch.qint8)
+        print("SentenceTransformer using dynamic int8 quantization on CPU")
+    else:
+        sent_model = SentenceTransformer(name)
+        # Configure SentenceTransformer to use MPS (Metal Performance Shaders)
+        # This enables GPU acceleration for PyTorch-based models on Mac
+        if torch.backends.mps.is_available():
+            sent_model = sent_model.to('mps')
+            print("SentenceTransformer using MPS (GPU)")
+        else:
+            print("MPS not available, SentenceTransformer using CPU")
+        return sent_model
+    # Their embeddings are close to, not equal to, fp32 ones: keep them apart in the embedding cache and indexes.
+    # Each ONNX export (fp32, or one of the quantized files) gives its own vectors, so the file is part of the key
+    suffix = f"{backend}:{onnx_file}" if backend == "onnx" and onnx_file else backend
+    sent_model.model_card_data.base_model = f"{model_name_of(sent_model)}:{suffix}"
+    return sent_model
+
+
+def histogram_bucket(n):
+    """ Smallest power of two >= n, the bucket n is counted under in the histograms. """
+    return 1 << max(int(n) - 1, 0).bit_length()
+
+
+class BatchingEncoder():
+    """
+    Thread-safe front for a SentenceTransformer that pools the encode calls of concurrent requests.
+    Calls are split into pieces of at most max_batch_size texts and queued; a single thread takes
+    queued pieces until it has max_batch_size texts or the oldest piece has waited max_wait_ms,
+    encodes them as one padded batch and hands every caller back its rows. The wrapped model's
+    tokenizer and max_seq_length are exposed, so encode_unique truncates and length-sorts texts
+    before they get here and each piece holds texts of similar length. A long call keeps at most two pieces queued, so the short calls of other requests get into the
+    next batch rather than waiting behind a whole trace. Queue depth (texts waiting when a batch is
+    formed) and batch sizes are kept as power-of-two histograms for stats().
+    """
+    def __init__(self, model, max_batch_size=64, max_wait_ms=5):
+        self.model = model
+        self.max_batch_size = max_batch_size
+        self.max_wait = max_wait_ms / 1000
+        self.dim = model.get_sentence_embedding_dimension()
+        # truncate_to_model reads these, so callers sort and truncate as they would for the model itself
+        self.tokenizer = getattr(model, "tokenizer", None)
+        self.max_seq_length = getattr(model, "max_seq_length", None)
+        # model_name_of reads this, so batching doesn't change which cached embeddings are used
+        self.model_card_data = SimpleNamespace(base_model=model_name_of(model))
+        self._pending = collections.deque()
+        self._pending_texts = 0
+        self._cond = threading.Condition()
+        self._worker = None
+        self._stats = {"batches": 0, "texts": 0, "wait_seconds": 0.0, "encode_seconds": 0.0}
+        self._batch_sizes = collections.Counter()
+        self._queue_depths = collections.Counter()
+
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+
+    def encode(self, texts, batch_size=None, convert_to_numpy=True, normalize_embeddings=False,
+               show_progress_bar=False, **kwargs):
+        """ Same call as SentenceTransformer.encode; batch_size is replaced by max_batch_size. """
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        parts, queued = [], collections.deque()
+        for start in range(0, len(texts), self.max_batch_size):
+            if len(queued) == 2:
+                parts.append(queued.popleft().result())
+            queued.append(self.submit(texts[start:start + self.max_batch_size]))
+        parts.extend(future.result() for future in queued)
+        embeddings = np.concatenate(parts) if parts else np.empty((0, self.dim), dtype=np.float32)
+        if normalize_embeddings:
+            norms = np.linalg.norm(embeddings, axis=1, keepdims=True)
+            embeddings = embeddings / np.maximum(norms, 1e-12)
+        return embeddings[0] if single else embeddings
+
+
+    def submit(self, texts):
+        """ Queues at most max_batch_size texts; the Future resolves to their (n, dim) embeddings. """
+        future = Future()
+        with self._cond:
+            if self._worker is None:
+                self._worker = threading.Thread(target=self._run, name="encoder-batcher", daemon=True)
+                self._worker.start()
+            self._pending.append((texts, future, time.monotonic()))
+            self._pending_texts += len(texts)
+            self._cond.notify()
+        return future
+
+
+    def _next_batch(self):
+        with self._cond:
+            while not self._pending:
+                self._cond.wait()
+            deadline = self._pending[0][2] + self.max_wait
+            while self._pending_texts < self.max_batch_size:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    break
+                self._cond.wait(remaining)
+            depth = self._pending_texts
+            batch, n_texts = [], 0
+            while self._pending and n_texts + len(self._pending[0][0]) <= self.max_batch_size:
+                batch.append(self._pending.popleft())
+                n_texts += len(batch[-1][0])
+            self._pending_texts -= n_texts
+        return batch, depth
+
+
+    def _run(self):
+        while True:
+            batch, depth = self._next_batch()
+            texts = [text for piece, _, _ in batch for text in piece]
+            start = time.monotonic()
+            try:
+                # Callers already deduplicated, truncated and sorted their texts (and counted them in encoding_stats)
+                embeddings = np.asarray(self.model.encode(texts, batch_size=len(texts), convert_to_numpy=True,
+                                                          normalize_embeddings=False, show_progress_bar=False),
+                                        dtype=np.float32)
+            except Exception as e:
+                for _, future, _ in batch:
+                    future.set_exception(e)
+                continue
+            self._stats["batches"] += 1
+            self._stats["texts"] += len(texts)
+            self._stats["wait_seconds"] += sum(start - queued_at for _, _, queued_at in batch)
+            self._stats["encode_seconds"] += time.monotonic() - start
+            self._batch_sizes[histogram_bucket(len(texts))] += 1
+            self._queue_depths[histogram_bucket(depth)] += 1
+            offset = 0
+            for piece, future, _ in batch:
+                future.set_result(embeddings[offset:offset + len(piece)])
+                offset += len(piece)
+
+
+    def stats(self):
+        stats = dict(self._stats)
+        batches = stats["batches"] or 1
+        return dict(stats, max_batch_size=self.max_batch_size, max_wait_ms=self.max_wait * 1000,
+                    mean_batch_size=stats["texts"] / batches, queued=self._pending_texts,
+                    batch_size_histogram=dict(sorted(self._batch_sizes.items())),
+                    queue_depth_histogram=dict(sorted(self._queue_depths.items())))
+
+
+class EncoderServer():
+    """
+    Owns the one copy of the sentence encoder for a pool of server processes (see serve.py).
+    Workers connect with a RemoteEncoder over a local socket; every connection gets a thread, and
+    their texts are pooled by a BatchingEncoder, so the workers share the model's memory and fill
+    its batches together.
+    """
+    def __init__(self, model, address, authkey, max_batch_size=64, max_wait_ms=5):
+        self.model = BatchingEncoder(model, max_batch_size, max_wait_ms)
+        self.model_name = self.model.model_card_data.base_model
+        self.dim = self.model.dim
+        self.listener = Listener(address, authkey=authkey)
+        self.address = self.listener.address
+        self.requests = 0
+
+
+    def serve_forever(self):
+        print(f"Encoder {self.model_name} listening on {self.address}")
+        while True:
+            try:
+                conn = self.listener.accept()
+            except Exception as e:
+                # A client that fails the handshake should not take the encoder down
+                print(f"Encoder connection refused: {e}")
+                continue
+            threading.Thread(target=self.handle, args=(conn,), daemon=True).start()
+
+
+    def handle(self, conn):
+        with conn:
+            while True:
+                try:
+                    request = conn.recv()
+                except (EOFError, OSError):
+                    return
+                try:
+                    conn.send(("ok", self.dispatch(*request)))
+                except Exception as e:
+                    conn.send(("error", f"{type(e).__name__}: {e}"))
+
+
+    def dispatch(self, command, *args):
+        if command == "info":
+            return {"model_name": self.model_name, "dim": self.dim, "pid": os.getpid()}
+        if command == "stats":
+            return dict(self.model.stats(), requests=self.requests, rss_mb=rss_mb()[0], encoding=encoding_stats.report())
+        if command == "encode":
+            texts, batch_size, normalize = args
+            self.requests += 1
+            # Workers have no tokenizer: dedup, truncation and length sorting happen here, once per request
+            return encode_unique(self.model, texts, normalize_embeddings=normalize)
+        raise ValueError(f"Error: Unknown encoder command '{command}'.")
+
+
+def run_encoder(address, authkey, model_name=SENTENCE_MODEL, ready=None, max_batch_size=64, max_wait_ms=5,
+                backend="torch", onnx_file=None):
+    """ Process target: loads the model and serves it; ready (an Event) is set once it accepts connections. """
+    server = EncoderServer(load_sentence_model(model_name, backend, onnx_file), address, authkey, max_batch_size, max_wait_ms)
+    if ready is not None:
+        ready.set()
+    server.serve_forever()
+
+
+class RemoteEncoder():
+    """
+    Stands in for a SentenceTransformer in embed_texts and friends (encode,
+    get_sentence_embedding_dimension, and the model name that keys the embedding cache), but sends
+    the texts to an EncoderServer. Each thread keeps its own connection. Requests are split into
+    max_texts slices so a long trace doesn't hold the encoder while other workers wait.
+    """
+    def __init__(self, address, authkey, max_texts=2048):
+        self.address = address
+        self.authkey = authkey
+        self.max_texts = max_texts
+        self._local = threading.local()
+        info = self.call("info")
+        self.dim = info["dim"]
+        # model_name_of reads this, so a remote and a local copy of a model share cached embeddings
+        self.model_card_data = SimpleNamespace(base_model=info["model_name"])
+
+
+    def connection(self):
+        conn = getattr(self._local, "conn", None)
+        if conn is None:
+            conn = self._local.conn = Client(self.address, authkey=self.authkey)
+        return conn
+
+
+    def call(self, command, *args):
+        for attempt in range(2):
+            conn = self.connection()
+            try:
+                conn.send((command, *args))
+                status, result = conn.recv()
+                break
+            except (EOFError, OSError):
+                # The encoder was restarted (serve.py replaces it) or the connection broke: reconnect once
+                self._local.conn = None
+                if attempt:
+                    raise
+        if status == "error":
+            raise RuntimeError(f"Error: Encoder failed: {result}")
+        return result
+
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+
+    def encode(self, texts, batch_size=64, convert_to_numpy=True, normalize_embeddings=False,
+               show_progress_bar=False, **kwargs):
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        parts = [self.call("encode", texts[start:start + self.max_texts], batch_size, normalize_embeddings)
+                 for start in range(0, len(texts), self.max_texts)]
+        embeddings = np.concatenate(parts) if parts else np.empty((0, self.dim), dtype=np.float32)
+        return embeddings[0] if single else embeddings
+
+
+    def stats(self):
+        return self.call("stats")
@@ -1,27 +1,64 @@
 import numpy as np
 # from mlx_lm import generate
-from sklearn.cluster import KMeans
+from sklearn.cluster import KMeans, MiniBatchKMeans
+from sklearn.decomposition import PCA
+from sklearn.random_projection import GaussianRandomProjection
+from preprocess import embed_texts, embed_narratives, preprocess_context_window, model_name_of
 
 from langchain_core.output_parsers import JsonOutputParser
 from langchain_core.prompts import PromptTemplate
 from pydantic import BaseModel, Field
-from langchain_community.llms.mlx_pipeline import MLXPipeline
 
+import hashlib
 import json
+import os
 import re
+import tempfile
+import time
 from tqdm import tqdm
 
 # Simple prompt
 SYS_PROMPT = "You should find the top two dominant narratives in the following batch of tweets. Do not cite which tweets correspond to the narratives, just supply the narrative summaries. You must always return valid JSON fenced by a markdown code block. Do not return any additional text. "
 
 class Narrative_Generator():
-    def __init__(self, summary_model, tokenizer, embedding_model, data, num_narratives):
+    def __init__(self, summary_model, tokenizer, embedding_model, data, num_narratives, cache=None,
+                 cluster_method="auto", reduce_dim=None, reduction="pca", chunk_size=10000, batch_size=64,
+                 minibatch_threshold=20000, n_epochs=3, seed=0, max_prompt_tokens=3000, max_samples=40,
+                 n_candidates=200, mmr_lambda=0.7, embeddings=None, model_name=None):
         self.summary_model = summary_model
         self.tokenizer = tokenizer
+        # Identifies the summary model in checkpoint keys; mlx_lm models don't carry their repo name
+        self.model_name = model_name or getattr(tokenizer, "name_or_path", None)
         self.embedding_model = embedding_model
         self.num_narratives = num_narratives
         self.df = data
-        # You could use preprocess_context_window here instead if data is too big...
+        self.cache = cache
+        # Optional precomputed embeddings of data["Tweet"], row-aligned (e.g. a stored trace result);
+        # clustering then skips the encoder
+        self.embeddings = embeddings
+        if embeddings is not None and len(embeddings) != len(data):
+            raise ValueError(f"Error: {len(embeddings)} embeddings given for {len(data)} tweets.")
+        # Clustering: "kmeans" holds every embedding in memory, "minibatch" streams them from disk in
+        # chunks of chunk_size, "auto" switches to "minibatch" above minibatch_threshold tweets.
+        self.cluster_method = cluster_method
+        # Optional reduction ("pca" or "random" projection) to reduce_dim dimensions before clustering
+        self.reduce_dim = reduce_dim
+        self.reduction = reduction
+        self.chunk_size = chunk_size
+        self.batch_size = batch_size
+        self.minibatch_threshold = minibatch_threshold
+        self.n_epochs = n_epochs
+        self.seed = seed
+        self.timings = {}
+        # Prompting: each cluster is summarized from at most max_samples representative tweets that fit in
+        # max_prompt_tokens, chosen by maximal marginal relevance (mmr_lambda trades centrality for diversity)
+        # among the n_candidates tweets nearest its centroid.
+        self.max_prompt_tokens = max_prompt_tokens
+        self.max_samples = max_samples
+        self.n_candidates = n_candidates
+        self.mmr_lambda = mmr_lambda
+        self.cluster_stats = []
+        # Datasets too big for one pass can use generate_hierarchical_narratives instead
 
 
     def create_format_prompt(self, parser):
@@ -33,47 +70,361 @@ class Narrative_Generator():
         return prompt
 
 
-    def cluster_embedded_tweets(self, tweets):
-        embeddings = []
-        for tweet in tweets:
-            embeddings.append(self.embedding_model.encode(tweet, convert_to_numpy=True))
-        clusters = KMeans(n_clusters=self.num_narratives).fit(embeddings)
-        unique_labels = np.unique(clusters.labels_)
+    def make_reducer(self, dim):
+        """ Unfitted PCA or random projection down to reduce_dim, or None if no reduction is wanted. """
+        if not self.reduce_dim or self.reduce_dim >= dim:
+            return None
+        if self.reduction == "pca":
+            return PCA(n_components=self.reduce_dim, random_state=self.seed)
+        if self.reduction == "random":
+            return GaussianRandomProjection(n_components=self.reduce_dim, random_state=self.seed)
+        raise ValueError(f"Error: Unknown reduction '{self.reduction}'. Use 'pca' or 'random'.")
+
+
+    def reduce(self, reducer, embeddings):
+        if reducer is None:
+            return embeddings
+        return np.ascontiguousarray(reducer.transform(embeddings), dtype=np.float32)
+
+
+    def count_tokens(self, text):
+        if self.tokenizer is None:
+            return len(text.split())
+        return len(self.tokenizer.encode(text))
+
+
+    def collect_candidates(self, positions, embeddings, labels, distances):
+        """
+        Keeps, per cluster, the n_candidates tweets nearest its centroid (positions and unit-length
+        embeddings) and the running sum of member embeddings. Called once per chunk of labelled tweets,
+        so the pools stay bounded however large the clusters are.
+        """
+        for label in np.unique(labels):
+            members = labels == label
+            pool_positions, pool_distances, pool_embeddings = self.candidates.get(
+                label, (np.empty(0, dtype=np.int64), np.empty(0, dtype=np.float32), np.empty((0, embeddings.shape[1]), dtype=np.float32)))
+            pool_positions = np.concatenate([pool_positions, positions[members]])
+            pool_distances = np.concatenate([pool_distances, distances[members]])
+            pool_embeddings = np.concatenate([pool_embeddings, embeddings[members]])
+            nearest = np.argsort(pool_distances, kind="stable")[:self.n_candidates]
+            self.candidates[label] = (pool_positions[nearest], pool_distances[nearest], pool_embeddings[nearest])
+            self.embedding_sums[label] = self.embedding_sums.get(label, 0) + embeddings[members].sum(axis=0)
+
+
+    def representative_positions(self, label):
+        """
+        Up to max_samples positions of the tweets of cluster label, in the order they should be added to the
+        prompt: the tweet nearest the centroid first, then maximal marginal relevance picks that are close to
+        the cluster's mean embedding but dissimilar to the tweets already picked.
+        """
+        positions, _, embeddings = self.candidates[label]
+        center = self.embedding_sums[label] / (np.linalg.norm(self.embedding_sums[label]) + 1e-12)
+        relevance = embeddings @ center
+        redundancy = np.zeros(len(positions), dtype=np.float32)
+        available = np.ones(len(positions), dtype=bool)
+        picked = []
+        for _ in range(min(self.max_samples, len(positions))):
+            if not picked:
+                # Candidates are sorted by distance to the clustering centroid
+                best = 0
+            else:
+                scores = self.mmr_lambda * relevance - (1 - self.mmr_lambda) * redundancy
+                best = int(np.argmax(np.where(available, scores, -np.inf)))
+            picked.append(best)
+            available[best] = False
+            redundancy = np.maximum(redundancy, embeddings @ embeddings[best])
+        return positions[picked]
+
+
+    def build_query(self, tweets, label, prompt):
+        """ Representative tweets of cluster label as a bulleted list, as many as fit in max_prompt_tokens.
+        Returns the query and the number of tweets in it. """
+        budget = self.max_prompt_tokens - self.count_tokens(prompt.format(query=""))
+        lines = []
+        for position in self.representative_positions(label):
+            line = "- " + " ".join(str(tweets.iloc[position]).split())
+            tokens = self.count_tokens(line + "\n")
+            if tokens > budget and lines:
+                break
+            lines.append(line)
+            budget -= tokens
+        return "\n".join(lines), len(lines)
+
+
+    def cluster_embedded_tweets(self, tweets, embeddings=None):
+        """ Splits tweets into num_narratives clusters of similar tweets (embedding them unless their
+        embeddings are given). Per-stage timings go to self.timings. """
+        self.timings = {}
+        self.candidates, self.embedding_sums = {}, {}
+        method = self.cluster_method
+        if method == "auto":
+            method = "minibatch" if len(tweets) > self.minibatch_threshold else "kmeans"
+        if method == "kmeans":
+            labels = self.kmeans_labels(tweets, embeddings)
+        elif method == "minibatch":
+            labels = self.minibatch_labels(tweets, embeddings)
+        else:
+            raise ValueError(f"Error: Unknown cluster method '{self.cluster_method}'. Use 'auto', 'kmeans' or 'minibatch'.")
+        stages = ", ".join(f"{stage} {seconds:.2f}s" for stage, seconds in self.timings.items())
+        print(f"Clustered {len(tweets)} tweets with {method}: {stages}")
+
+        self.labels = labels
+        unique_labels = np.unique(labels)
         # Chunk tweets by cluster labels
-        clustered_tweets = [tweets[clusters.labels_ == label] for label in unique_labels]
+        clustered_tweets = [tweets[labels == label] for label in unique_labels]
         return clustered_tweets
 
 
-    def generate_narratives(self, progress=None):
+    def kmeans_labels(self, tweets, embeddings=None):
+        """ Full KMeans over all embeddings in memory; fine up to a few tens of thousands of tweets. """
+        start = time.perf_counter()
+        if embeddings is None:
+            embeddings = embed_texts(self.embedding_model, tweets, batch_size=self.batch_size, cache=self.cache)
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        self.timings["encode"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        reducer = self.make_reducer(embeddings.shape[1])
+        features = embeddings
+        if reducer is not None:
+            features = np.ascontiguousarray(reducer.fit_transform(embeddings), dtype=np.float32)
+        self.timings["reduce"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        # A small time window can hold fewer tweets than num_narratives; one or two tweets are one narrative
+        n_clusters = min(self.num_narratives, len(features)) if len(features) > 2 else 1
+        clusters = KMeans(n_clusters=n_clusters, random_state=self.seed).fit(features)
+        self.timings["cluster"] = time.perf_counter() - start
+
+        start = time.perf_counter()
+        distances = np.linalg.norm(features - clusters.cluster_centers_[clusters.labels_], axis=1)
+        self.collect_candidates(np.arange(len(embeddings)), embeddings, clusters.labels_, distances)
+        self.timings["candidates"] = time.perf_counter() - start
+        self.reducer, self.centroids = reducer, clusters.cluster_centers_.astype(np.float32)
+        return clusters.labels_
+
+
+    def minibatch_labels(self, tweets, embeddings=None):
+        """
+        Bounded-memory clustering: tweets are encoded chunk by chunk into a float32 memmap on disk,
+        the reducer is fit on a sample, MiniBatchKMeans is fit incrementally with partial_fit over
+        shuffled chunks, and a final pass assigns labels. Only one chunk of embeddings is in memory.
+        Given embeddings (e.g. a memory-mapped stored result) are used in place of the memmap.
+        """
+        texts = list(tweets)
+        n = len(texts)
+        dim = self.embedding_model.get_sentence_embedding_dimension() if embeddings is None else embeddings.shape[1]
+        rng = np.random.default_rng(self.seed)
+        with tempfile.TemporaryDirectory() as tmp_dir:
+            start = time.perf_counter()
+            if embeddings is None:
+                embeddings = np.lib.format.open_memmap(os.path.join(tmp_dir, "embeddings.npy"), mode="w+",
+                                                       dtype=np.float32, shape=(n, dim))
+                for begin in tqdm(range(0, n, self.chunk_size), desc="Encoding"):
+                    embeddings[begin:begin + self.chunk_size] = embed_texts(
+                        self.embedding_model, texts[begin:begin + self.chunk_size], batch_size=self.batch_size, cache=self.cache)
+                embeddings.flush()
+            self.timings["encode"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            reducer = self.make_reducer(dim)
+            if reducer is not None:
+                sample = np.sort(rng.choice(n, min(n, self.chunk_size), replace=False))
+                reducer.fit(embeddings[sample])
+            self.timings["reduce"] = time.perf_counter() - start
+
+            start = time.perf_counter()
+            # partial_fit seeds the centers from the first chunk it sees (n_init does not apply to it)
+            clusters = MiniBatchKMeans(n_clusters=self.num_narratives, random_state=self.seed,
+                                       batch_size=min(self.chunk_size, 4096))
+            # Chunks are contiguous runs of (usually time-sorted) rows, so visit them in random order
+            begins = np.arange(0, n, self.chunk_size)
+            for _ in range(self.n_epochs):
+                for begin in rng.permutation(begins):
+                    chunk = self.reduce(reducer, embeddings[begin:begin + self.chunk_size])
+                    if len(chunk) < self.num_narratives:
+                        continue
+                    clusters.partial_fit(chunk)
+            self.timings["cluster"] = time.perf_counter() - start
+            if not hasattr(clusters, "cluster_centers_"):
+                # No chunk had num_narratives rows (a small input): cluster it in memory instead
+                return self.kmeans_labels(tweets, np.asarray(embeddings, dtype=np.float32))
+
+            start = time.perf_counter()
+            labels = np.empty(n, dtype=np.int32)
+            for begin in begins:
+                chunk = np.asarray(embeddings[begin:begin + self.chunk_size], dtype=np.float32)
+                features = self.reduce(reducer, chunk)
+                chunk_labels = clusters.predict(features)
+                labels[begin:begin + self.chunk_size] = chunk_labels
+                distances = np.linalg.norm(features - clusters.cluster_centers_[chunk_labels], axis=1)
+                self.collect_candidates(np.arange(begin, begin + len(chunk)), chunk, chunk_labels, distances)
+            self.timings["assign"] = time.perf_counter() - start
+            del embeddings
+        self.reducer, self.centroids = reducer, clusters.cluster_centers_.astype(np.float32)
+        return labels
+
+
+    def make_chain(self):
         # Set up a parser + inject instructions into the prompt template.
         parser = JsonOutputParser(pydantic_object=self.NarrativeSummary)
+        # Imported here so modules that only embed (app.py's embeddings profile) don't pull in mlx
+        from langchain_community.llms.mlx_pipeline import MLXPipeline
         llm = MLXPipeline(model=self.summary_model, tokenizer=self.tokenizer, pipeline_kwargs={
             "temp": 0.9,
           })
         prompt = self.create_format_prompt(parser)
         chain = prompt | llm | self.parse_json_objects 
+        return prompt, chain
 
-        # What happens when we have way more than 300 tweets? Can we still cluster 50,000 or do we chunk it by time and regen narratives?
-        clustered_tweets = self.cluster_embedded_tweets(self.df["Tweet"])
-        responses = []
-        if progress:
-            for chunk in progress.tqdm(clustered_tweets):
-                resp = chain.invoke({"query": chunk})
-                # TODO remove print
-                print(resp)
-                if not resp:
-                    continue
-                responses.append(resp[0])
-        else:
-            for chunk in tqdm(clustered_tweets):
-                resp = chain.invoke({"query": chunk})
-                if not resp:
-                    continue
-                responses.append(resp[0])
- 
+
+    def summarize_clusters(self, tweets, prompt, chain, progress=None, embeddings=None):
+        """ Clusters tweets and asks the LLM for the narratives of each cluster.
+        Returns the parsed responses, the size of the cluster behind each response, and the clusters. """
+        # Large datasets are clustered in bounded memory by minibatch_labels
+        clustered_tweets = self.cluster_embedded_tweets(tweets, embeddings)
+        # Each cluster is summarized from a bounded sample of representative tweets rather than all of it,
+        # so prompt size (and prefill latency) no longer grows with cluster size
+        self.cluster_stats = []
+        responses, sizes = [], []
+        labels = np.unique(self.labels)
+        for label in (progress.tqdm(labels) if progress else tqdm(labels)):
+            query, n_samples = self.build_query(tweets, label, prompt)
+            start = time.perf_counter()
+            resp = chain.invoke({"query": query})
+            stats = {
+                "cluster": int(label),
+                "cluster_size": int(np.sum(self.labels == label)),
+                "n_samples": n_samples,
+                "prompt_tokens": self.count_tokens(prompt.format(query=query)),
+                "seconds": time.perf_counter() - start,
+            }
+            self.cluster_stats.append(stats)
+            print(f"Cluster {stats['cluster']}: {stats['n_samples']} of {stats['cluster_size']} tweets, "
+                  f"{stats['prompt_tokens']} prompt tokens, {stats['seconds']:.2f}s")
+            if not resp:
+                continue
+            responses.append(resp[0])
+            sizes.append(stats["cluster_size"])
+        return responses, sizes, clustered_tweets
+
+
+    def generate_narratives(self, progress=None):
+        prompt, chain = self.make_chain()
+        responses, _, clustered_tweets = self.summarize_clusters(self.df["Tweet"], prompt, chain, progress, self.embeddings)
         return responses, prompt, clustered_tweets
 
 
+    def checkpoint_path(self, checkpoint_dir, key, tweets):
+        """ Checkpoint file of one batch. The name hashes the batch's tweets, the summary and embedding
+        models and the generation settings, so a batch whose data, models or settings changed is
+        regenerated rather than read back. """
+        digest = hashlib.sha1(json.dumps([SYS_PROMPT, self.model_name, model_name_of(self.embedding_model), self.num_narratives,
+                                          self.max_samples, self.max_prompt_tokens, self.n_candidates,
+                                          self.mmr_lambda]).encode("utf-8"))
+        for tweet in tweets:
+            digest.update(str(tweet).encode("utf-8", errors="ignore") + b"\0")
+        return os.path.join(checkpoint_dir, f"{key}_{digest.hexdigest()[:16]}.json")
+
+
+    def generate_hierarchical_narratives(self, window=None, batch_size=50000, merge_threshold=0.85,
+                                         checkpoint_dir="narrative_checkpoints", progress=None):
+        """
+        Map-reduce narrative generation for datasets too big to summarize at once.
+        Map: the data is split into batches of at most batch_size tweets (per Datetime window when window,
+        a pandas frequency like "W", is given; see preprocess.preprocess_context_window) and narratives are
+        generated for each batch as in generate_narratives. Finished batches are checkpointed in
+        checkpoint_dir, so a rerun only generates narratives for new or changed batches.
+        Reduce: the narratives of all batches are embedded and merge_narratives merges them down to
+        num_narratives. Returns the merged narratives and the per-batch narratives.
+        """
+        prompt, chain = self.make_chain()
+        df = self.df
+        if self.embeddings is not None:
+            # Lets each batch pick out its rows' embeddings after windowing
+            df = df.assign(_position=np.arange(len(df)))
+        batches = preprocess_context_window(df, batch_size, window=window)
+        os.makedirs(checkpoint_dir, exist_ok=True)
+
+        batch_results = []
+        n_generated = 0
+        for key, batch in (progress.tqdm(batches) if progress else tqdm(batches, desc="Batches")):
+            path = self.checkpoint_path(checkpoint_dir, key, batch["Tweet"])
+            if os.path.exists(path):
+                with open(path) as f:
+                    batch_results.append(json.load(f))
+                continue
+            embeddings = None if self.embeddings is None else self.embeddings[batch["_position"].to_numpy()]
+            responses, sizes, _ = self.summarize_clusters(batch["Tweet"], prompt, chain, embeddings=embeddings)
+            result = {
+                "batch": key,
+                "n_tweets": len(batch),
+                # One entry per narrative, weighted by the size of the cluster it summarizes
+                "narratives": [{"narrative": str(text), "support": size}
+                               for response, size in zip(responses, sizes) for text in response.values()],
+            }
+            with open(path + ".tmp", "w") as f:
+                json.dump(result, f, indent=4)
+            os.replace(path + ".tmp", path)
+            batch_results.append(result)
+            n_generated += 1
+        print(f"Generated narratives for {n_generated} of {len(batches)} batches "
+              f"({len(batches) - n_generated} read from {checkpoint_dir})")
+
+        merged = self.merge_narratives(
+            [dict(narrative, batch=result["batch"]) for result in batch_results for narrative in result["narratives"]],
+            merge_threshold)
+        return merged, batch_results
+
+
+    def merge_narratives(self, narratives, merge_threshold=0.85):
+        """
+        Agglomerative merge of narratives (dicts with narrative, support and batch) by embedding similarity.
+        The most similar pair of groups is merged while it is a near-duplicate (cosine >= merge_threshold) or
+        while there are more than num_narratives groups. Each merged narrative is worded by the variant
+        nearest the group's support-weighted mean embedding.
+        """
+        if not narratives:
+            return []
+        embeddings = embed_narratives(self.embedding_model, [n["narrative"] for n in narratives], cache=self.cache)
+        support = np.array([max(n["support"], 1) for n in narratives], dtype=np.float64)
+        sums = embeddings * support[:, None]
+        members = [[i] for i in range(len(narratives))]
+        alive = np.ones(len(narratives), dtype=bool)
+
+        centers = sums / np.linalg.norm(sums, axis=1, keepdims=True)
+        sims = centers @ centers.T
+        np.fill_diagonal(sims, -np.inf)
+        while alive.sum() > 1:
+            i, j = np.unravel_index(np.argmax(sims), sims.shape)
+            if sims[i, j] < merge_threshold and alive.sum() <= self.num_narratives:
+                break
+            sums[i] += sums[j]
+            members[i] += members[j]
+            alive[j] = False
+            sims[j, :] = sims[:, j] = -np.inf
+            # Only the merged group's similarities change
+            center = sums[i] / np.linalg.norm(sums[i])
+            row = np.where(alive, (sums / np.linalg.norm(sums, axis=1, keepdims=True)) @ center, -np.inf)
+            row[i] = -np.inf
+            sims[i, :] = sims[:, i] = row
+
+        merged = []
+        for i in np.nonzero(alive)[0]:
+            group = members[i]
+            center = sums[i] / np.linalg.norm(sums[i])
+            representative = group[int(np.argmax(embeddings[group] @ center))]
+            merged.append({
+                "narrative": narratives[representative]["narrative"],
+                "support": int(support[group].sum()),
+                "variants": len(group),
+                "batches": sorted({narratives[k]["batch"] for k in group}),
+            })
+        merged.sort(key=lambda n: -n["support"])
+        print(f"Merged {len(narratives)} narratives into {len(merged)}")
+        return merged
+
+
     def format(self, raw_narratives):
         # Formats to markdown for direct display as a string.
         formatted_output = ""
@@ -1,8 +1,10 @@
+import argparse
 import numpy as np
 import os
+import time
 import base64
 from io import BytesIO
-from sentence_transformers import SentenceTransformer, util
+from encoder_service import load_sentence_model, SENTENCE_MODEL, ENCODER_BACKENDS
 from datasets import load_dataset
 import matplotlib.pyplot as plt
 from sklearn.metrics import mean_squared_error, mean_absolute_error
@@ -16,38 +18,82 @@ from scipy.stats import linregress
 # Create the results directory if it doesn't exist
 os.makedirs('glue_results', exist_ok=True)
 
-# Load the embedding model
-embedding_model = SentenceTransformer('sentence-transformers/all-MiniLM-L6-v2')
+parser = argparse.ArgumentParser(description="STS-B evaluation of the sentence encoder, optionally comparing backends.")
+parser.add_argument("--model", default=SENTENCE_MODEL)
+parser.add_argument("--backend", default=os.getenv("ENCODER_BACKEND", "torch"), choices=ENCODER_BACKENDS,
+                    help="Backend the report is written for")
+parser.add_argument("--onnx-file", default=os.getenv("ENCODER_ONNX_FILE"), help="ONNX export for the onnx backend")
+parser.add_argument("--compare", nargs="*", default=[], choices=ENCODER_BACKENDS,
+                    help="Also score these backends and print their Pearson/MAE and speed next to each other")
+args = parser.parse_args()
 
 # Load STS-B validation set
 dataset = load_dataset("glue", "stsb", split="validation")
 
-# Process the dataset
-results = []
-for example in dataset:
-    sentence1 = example['sentence1']
-    sentence2 = example['sentence2']
-    gold_score = example['label'] / 5.0  # Normalize: human scores are [0, 5]
-    
-    # Encode both sentences
-    emb1 = embedding_model.encode(sentence1, convert_to_tensor=True)
-    emb2 = embedding_model.encode(sentence2, convert_to_tensor=True)
-    
+
+def evaluate_backend(backend):
+    """ Scores STS-B with the encoder on backend and returns (per-pair results, seconds spent encoding). """
+    embedding_model = load_sentence_model(args.model, backend, args.onnx_file)
+    sentences1, sentences2 = list(dataset['sentence1']), list(dataset['sentence2'])
+    # Warm up, so the first backend doesn't pay for one-off initialization
+    embedding_model.encode(sentences1[:64], batch_size=64)
+    start = time.perf_counter()
+    emb1 = embedding_model.encode(sentences1, batch_size=64, convert_to_numpy=True, normalize_embeddings=True)
+    emb2 = embedding_model.encode(sentences2, batch_size=64, convert_to_numpy=True, normalize_embeddings=True)
+    seconds = time.perf_counter() - start
     # Cosine similarity
-    cosine_score = util.pytorch_cos_sim(emb1, emb2).item()
-    
-    # Store all information
-    results.append({
-        'sentence1': sentence1,
-        'sentence2': sentence2,
-        'gold_score': gold_score,
-        'predicted_score': cosine_score,
-        'error': abs(gold_score - cosine_score),
-        'signed_error': cosine_score - gold_score  # Positive means overestimation
-    })
+    cosine_scores = np.sum(emb1 * emb2, axis=1)
+
+    results = []
+    for example, cosine_score in zip(dataset, cosine_scores.tolist()):
+        gold_score = example['label'] / 5.0  # Normalize: human scores are [0, 5]
+        # Store all information
+        results.append({
+            'sentence1': example['sentence1'],
+            'sentence2': example['sentence2'],
+            'gold_score': gold_score,
+            'predicted_score': cosine_score,
+            'error': abs(gold_score - cosine_score),
+            'signed_error': cosine_score - gold_score  # Positive means overestimation
+        })
+    return pd.DataFrame(results), seconds
+
+
+backend_results = {}
+for backend in dict.fromkeys(args.compare + [args.backend]):
+    backend_results[backend] = evaluate_backend(backend)
+
+if args.compare:
+    # Speedup and accuracy change of every backend relative to the first one compared
+    baseline = args.compare[0]
+    base_df, base_seconds = backend_results[baseline]
+    base_pearson = pearsonr(base_df['gold_score'], base_df['predicted_score'])[0]
+    base_mae = mean_absolute_error(base_df['gold_score'], base_df['predicted_score'])
+    comparison = []
+    for backend in args.compare:
+        backend_df, seconds = backend_results[backend]
+        pearson = pearsonr(backend_df['gold_score'], backend_df['predicted_score'])[0]
+        mae = mean_absolute_error(backend_df['gold_score'], backend_df['predicted_score'])
+        comparison.append({
+            'backend': backend,
+            'pearson': pearson,
+            'pearson_delta': pearson - base_pearson,
+            'mae': mae,
+            'mae_delta': mae - base_mae,
+            'encode_seconds': seconds,
+            'sentences_per_sec': 2 * len(backend_df) / seconds,
+            'speedup': base_seconds / seconds,
+            # How far this backend's scores move from the baseline's, pair by pair
+            'max_score_change': (backend_df['predicted_score'] - base_df['predicted_score']).abs().max(),
+        })
+    comparison = pd.DataFrame(comparison)
+    print(f"Backends compared against {baseline}:")
+    print(comparison.to_string(index=False, float_format=lambda x: f"{x:.4f}"))
+    comparison.to_csv('glue_results/backend_comparison.csv', index=False)
+    print("Backend comparison saved to 'glue_results/backend_comparison.csv'")
 
 # Convert to DataFrame for easier analysis
-df = pd.DataFrame(results)
+df, encode_seconds = backend_results[args.backend]
 
 # Calculate evaluation metrics
 pearson_corr, p_value_pearson = pearsonr(df['gold_score'], df['predicted_score'])
@@ -58,6 +104,7 @@ mae = mean_absolute_error(df['gold_score'], df['predicted_score'])
 print(f"Pearson correlation: {pearson_corr:.4f} (p={p_value_pearson:.4e})")
 print(f"Mean Squared Error: {mse:.4f}")
 print(f"Mean Absolute Error: {mae:.4f}")
+print(f"Encoding with the {args.backend} backend: {encode_seconds:.2f}s ({2 * len(df) / encode_seconds:.1f} sentences/sec)")
 
 # Calculate error metrics for specific human score ranges
 score_ranges = [0.0, 0.25, 0.5, 0.75, 1.0]
@@ -374,7 +421,7 @@ def create_html_report():
         <h1>Embedding Model Evaluation Report</h1>
         
         <div class="metrics">
-            <p><strong>Model:</strong> sentence-transformers/all-MiniLM-L6-v2</p>
+            <p><strong>Model:</strong> {args.model} ({args.backend} backend)</p>
             <p><strong>Dataset:</strong> GLUE STS-B (validation split)</p>
             <p><strong>Pearson Correlation:</strong> {pearson_corr:.4f} (p={p_value_pearson:.4e})</p>
             <p><strong>Mean Squared Error:</strong> {mse:.4f}</p>
@@ -530,11 +577,12 @@ print("Full results saved to 'glue_results/embedding_evaluation_results.csv'")
 
 # Create a summary results file
 with open('glue_results/summary_metrics.txt', 'w') as f:
-    f.write(f"Model: sentence-transformers/all-MiniLM-L6-v2\n")
+    f.write(f"Model: {args.model} ({args.backend} backend)\n")
     f.write(f"Dataset: GLUE STS-B (validation split)\n")
     f.write(f"Pearson correlation: {pearson_corr:.4f} (p={p_value_pearson:.4e})\n")
     f.write(f"Mean Squared Error: {mse:.4f}\n")
     f.write(f"Mean Absolute Error: {mae:.4f}\n")
+    f.write(f"Encoding: {encode_seconds:.2f}s ({2 * len(df) / encode_seconds:.1f} sentences/sec)\n")
     f.write(f"Number of examples: {len(df)}\n\n")
     
     f.write("Error metrics by human score range:\n")
@@ -1,6 +1,5 @@
 from sim_scores import Results
 from sentence_transformers import SentenceTransformer, util
-from mlx_lm import load
 from preprocess import *
 import matplotlib.pyplot as plt
 import matplotlib.dates as mdates
@@ -8,16 +7,11 @@ from tqdm import tqdm
 
 # get narrative to graph similarity to
 # get sim_scores for each tweet over time
-def get_sim_timeseries(target_narrative, model, df):
-    narrative_embed = model.encode(target_narrative, convert_to_tensor=True)
-    timeseries = []
-
-    for tweet in tqdm(df["AuthorTweet"]):
-        tweet_embed = model.encode(tweet, convert_to_tensor=True)
-        sim = util.pytorch_cos_sim(tweet_embed, narrative_embed) 
-        sim_value = sim.cpu().numpy().item()
-        timeseries.append(sim_value)
-    return np.array(timeseries)
+def get_sim_timeseries(target_narrative, model, df, cache=None, text_column="AuthorTweet"):
+    narrative_embed = embed_narratives(model, [target_narrative], cache=cache)
+    tweet_embeds = embed_texts(model, df[text_column], show_progress_bar=True, cache=cache)
+    timeseries = tweet_embeds @ narrative_embed[0]
+    return timeseries.astype(np.float64)
 
 
 # graph time on x axis and similarity on y and return the timeseries + a log of the timestamps at each point
@@ -53,29 +47,72 @@ def create_timeseries_graph(x, y, title=None):
     # plt.savefig('similarity_over_time.png', dpi=300, bbox_inches='tight')
 
 
-def graph_timeseries(df, target_narrative, sent_model, threshold="0.0"):
+def graph_timeseries(df, target_narrative, sent_model, threshold="0.0", cache=None, text_column="AuthorTweet"):
+    """ Plots similarity to target_narrative over time. Frames returned by trace_over_time already carry
+    a Similarity column from its scoring pass, which is plotted as is instead of re-embedding the tweets. """
     times = df["Datetime"].tolist()
     timeframe = "{start} to  {end}".format(start=times[0], end=times[-1])
-    timeseries = get_sim_timeseries(target_narrative, sent_model, df)
+    if "Similarity" in df.columns:
+        timeseries = df["Similarity"].to_numpy(dtype=np.float64)
+    else:
+        timeseries = get_sim_timeseries(target_narrative, sent_model, df, cache=cache, text_column=text_column)
     threshold = str(threshold)
     create_timeseries_graph(times, timeseries, title="Tracing {target} from {timeframe} above {threshold} similarity".format(target=target_narrative, timeframe=timeframe, threshold=threshold))
 
 
-def trace_over_time(df, sent_model, target_narrative, timeframe, sim_threshold=0.4):
+def trace_over_time(df, sent_model, target_narrative, timeframe, sim_threshold=0.4, batch_size=64, cache=None,
+                    text_column="Tweet", return_embeddings=False):
     """
-    Trace the tweets that have a similarity score above a certain threshold
+    Trace the tweets that have a similarity score above a certain threshold.
+    text_column chooses which text is embedded ("Tweet" or "AuthorTweet"); the Similarity column
+    of the result is the single scoring pass that graph_timeseries plots.
+    With return_embeddings, returns (filtered_df, embeddings of its rows) instead.
     """
     # Filter the dataframe based on the timeframe and similarity threshold
-    filtered_df = df[(df["Datetime"] >= timeframe[0]) & (df["Datetime"] <= timeframe[1])].reset_index(drop=True)
-    results = Results(sent_model, filtered_df, 1000000, [target_narrative])
-    filtered_df = filtered_df[results.similarities >= sim_threshold]
+    df = add_datetime_column(df.copy(), sort=False)
+    start, end = to_naive_utc(list(timeframe))
+    filtered_df = df[(df["Datetime"] >= start) & (df["Datetime"] <= end)].reset_index(drop=True)
+    results = Results(sent_model, filtered_df, 1000000, [target_narrative], batch_size=batch_size, cache=cache,
+                      text_column=text_column)
+    filtered_df = filtered_df[results.similarities[:, 0] >= sim_threshold]
     index_list = filtered_df.index.tolist()
     # filtered_df["OriginalIndex"] = index_list
     filtered_df["Similarity"] = results.similarities[index_list, 0]
     filtered_df.reset_index(drop=False, inplace=True)
+    if return_embeddings:
+        return filtered_df, results.tweet_embeds[index_list]
     return filtered_df
 
+
+def trace_over_time_chunks(chunks, sent_model, target_narrative, timeframe, sim_threshold=0.4, batch_size=64, cache=None,
+                           text_column="Tweet", return_embeddings=False):
+    """
+    Streaming trace_over_time over an iterable of dataframe chunks (e.g. read_media_chunks): each
+    chunk is scored on its own and its matching rows are yielded with the same 'index' and
+    'Similarity' columns, so only one chunk of tweets and embeddings is held at a time.
+    With return_embeddings, yields (matched rows, their embeddings) pairs.
+    """
+    narrative_embed = embed_narratives(sent_model, [target_narrative], cache=cache)[0]
+    start, end = to_naive_utc(list(timeframe))
+    offset = 0
+    for chunk in chunks:
+        chunk = add_datetime_column(chunk, sort=False)
+        chunk = chunk[(chunk["Datetime"] >= start) & (chunk["Datetime"] <= end)].reset_index(drop=True)
+        if len(chunk) == 0:
+            continue
+        embeds = embed_texts(sent_model, chunk[text_column], batch_size=batch_size, cache=cache)
+        sims = (embeds @ narrative_embed).astype(np.float64)
+        keep = sims >= sim_threshold
+        matched = chunk[keep].copy()
+        matched["Similarity"] = sims[keep]
+        # Positions among all the rows in the timeframe, not just this chunk's
+        matched.index = matched.index + offset
+        offset += len(chunk)
+        matched = matched.reset_index(drop=False)
+        yield (matched, embeds[keep]) if return_embeddings else matched
+
 if __name__ == "__main__":
+    from mlx_lm import load
     target_narrative = "The 2020 election was stolen"
     file = "tweets/full_tweets.csv"
     summary_model, tokenizer = load("mlx-community/Mistral-Nemo-Instruct-2407-4bit")
@@ -1,34 +1,49 @@
+import hashlib
 import pandas as pd
-from preprocess import read_media
-from tqdm import tqdm
+from preprocess import read_media, canonical_tweet
 
 from langchain_core.output_parsers import JsonOutputParser
 from langchain_core.prompts import PromptTemplate
 from pydantic import BaseModel, Field
-from langchain_community.llms.mlx_pipeline import MLXPipeline
+from polarity_engine import MLXPolarityEngine, label_probabilities
 import re
 import json
-from mlx_lm import load 
-import mlx.core as mx
 import gc
 
 
-# Configure MLX to use GPU
-mx.set_default_device(mx.gpu)
-
 SYS_PROMPT = "You should evaluate if the following tweet is in support of (agreement with), opposition to (contradicts), or neutral to the following target narrative. Headlines that just report news or have very little detectable slant are neutral. Opposition must directly challenge / oppose the target narrative otherwise it is considered neutral, supportive, or unsure. If you are unsure you may mark that instead, which is preferable to being wrong." 
+# Single-token classification: the label is read off the next-token logits after "Answer:"
+LABELS = ["support", "opposition", "neutral", "unsure"]
+LABEL_CUE = "Answer:"
+LABEL_PROMPT = SYS_PROMPT + "\nAnswer with exactly one word: support, opposition, neutral or unsure.\n\n Target narrative: {target_narrative}\n\n Tweet: {tweet}\n " + LABEL_CUE
+
 class PolarityTester():
-    def __init__(self, summary_model, tokenizer, data, target_narrative):
+    def __init__(self, summary_model, tokenizer, data, target_narrative, engine=None, mode="json", calibrate=True,
+                 temperature=1.0, cache=None, cascade=None, cascade_confidence=None):
         self.summary_model = summary_model
         self.tokenizer = tokenizer
         self.df = data
         self.target_narrative = target_narrative
+        # Generation over a cached prompt prefix (batched on the transformers backend; see polarity_engine.py);
+        # pass an engine to reuse its prefix cache across requests or to run on another backend
+        self.engine = engine if engine is not None else MLXPolarityEngine(summary_model, tokenizer)
+        # "json" generates a TweetPolarity object per tweet; "labels" scores the four labels in one forward pass
+        if mode not in ("json", "labels"):
+            raise ValueError(f"Error: Unknown polarity mode '{mode}'. Use 'json' or 'labels'.")
+        self.mode = mode
+        # Label mode: divide out the model's label prior measured on a content-free tweet, then apply temperature
+        self.calibrate = calibrate
+        self.temperature = temperature
         parser = JsonOutputParser(pydantic_object=self.TweetPolarity)
-        llm = MLXPipeline(model=self.summary_model, tokenizer=self.tokenizer, pipeline_kwargs={
-            "temp": 1.0,
-          })
-        prompt = self.create_prompt(parser)
-        self.chain = prompt | llm | self.parse_json_objects 
+        self.prompt = self.create_prompt(parser)
+        self.label_prompt = PromptTemplate(template=LABEL_PROMPT, input_variables=["target_narrative", "tweet"])
+        # Optional PolarityCache shared across requests
+        self.cache = cache
+        # Optional trained PolarityCascade; tweets it is confident about (>= cascade_confidence, or its own
+        # default) skip the LLM
+        self.cascade = cascade
+        self.cascade_confidence = cascade_confidence
+        self.stats = {}
 
     def create_prompt(self, parser):
         prompt = PromptTemplate(
@@ -77,40 +92,143 @@ class PolarityTester():
         return parsed_json_list
     
 
-    def check_polarity(self):
+    def split_prompt(self, prompt):
+        """ The prompt as (prefix shared by every tweet, per-tweet suffix template). """
+        marker = "\0TWEET\0"
+        prefix, suffix = prompt.format(target_narrative=self.target_narrative, tweet=marker).split(marker)
+        return prefix, "{tweet}" + suffix
+
+
+    def prompt_version(self):
+        """ Hash of everything in the prompt and scoring settings other than the narrative and tweet, so
+        cached results are only reused for the same prompt. """
+        prompt = self.label_prompt if self.mode == "labels" else self.prompt
+        settings = [self.mode, prompt.format(target_narrative="", tweet="")]
+        if self.mode == "labels":
+            settings += [str(self.calibrate), str(self.temperature)]
+        return hashlib.sha1("\0".join(settings).encode("utf-8")).hexdigest()[:16]
+
+
+    def check_polarity(self, progress=None):
+        """
+        Adds a polarity column (plus label probabilities in label mode) and polarity_source (cache, cascade
+        or llm). Rows whose tweets share a canonical form (retweets, near-identical headlines) are classified
+        once, results already in the cache are reused, the cascade decides the tweets it is confident about,
+        and only the remaining unique tweets go to the engine.
+        """
         gc.collect()
-        responses = []
-        for tweet in tqdm(self.df['Tweet']):
-            resp = self.chain.invoke({"target_narrative": self.target_narrative, "tweet": tweet})
-            if not resp:
-                print("Bad response")
-                continue
-            responses.append(resp[0])
+        tweets = list(self.df['Tweet'])
+        keys = [canonical_tweet(tweet) for tweet in tweets]
+        first_row = {}
+        for i, key in enumerate(keys):
+            first_row.setdefault(key, i)
+        unique_keys = list(first_row)
 
-        self.create_response_object(responses)
-        # Check that only only one polarity is marked as 1 and that the model is sure
-        for i, resp in enumerate(responses):
-            if resp['response_obj'] & 0b1000: # support
-                resp['polarity'] = 'support'
-            elif resp['response_obj'] & 0b0100: # opposition
-                resp['polarity'] = 'opposition'
-            elif resp['response_obj'] & 0b0010: # neutral
-                resp['polarity'] = 'neutral'
+        version = self.prompt_version()
+        if self.cache is not None:
+            results = self.cache.lookup(self.engine.name, version, self.target_narrative, unique_keys)
+        else:
+            results = [None] * len(unique_keys)
+        missing = [j for j, result in enumerate(results) if result is None]
+        sources = ['cache' if result is not None else 'llm' for result in results]
+        n_cascade = 0
+        if missing and self.cascade is not None and self.cascade.ready:
+            # classes come from the same classifier as probs; a background refit may have replaced it since
+            labels, probs, confident, classes = self.cascade.decide([unique_keys[j] for j in missing], self.target_narrative,
+                                                                    self.cascade_confidence)
+            for j, label, row, sure in zip(missing, labels, probs, confident):
+                if sure:
+                    results[j] = {'polarity': label,
+                                  'probs': [float(row[classes.index(l)]) if l in classes else 0.0 for l in LABELS]}
+                    sources[j] = 'cascade'
+            n_cascade = int(confident.sum())
+            missing = [j for j, sure in zip(missing, confident) if not sure]
+        if missing:
+            missing_tweets = [tweets[first_row[unique_keys[j]]] for j in missing]
+            classify = self.classify_labels if self.mode == "labels" else self.classify_json
+            for j, result in zip(missing, classify(missing_tweets, progress)):
+                results[j] = result
+            if self.cache is not None:
+                # Unparseable responses are not cached, so they are retried next time
+                good = [j for j in missing if not results[j].get('bad')]
+                self.cache.store(self.engine.name, version, self.target_narrative,
+                                 [unique_keys[j] for j in good], [results[j] for j in good])
+
+        # Fan the unique results back out to every row
+        by_key = dict(zip(unique_keys, zip(results, sources)))
+        rows = [by_key[key][0] for key in keys]
+        row_sources = [by_key[key][1] for key in keys]
+        self.df['polarity'] = pd.Series([row['polarity'] for row in rows], index=self.df.index, dtype=object)
+        self.df['polarity_source'] = pd.Series(row_sources, index=self.df.index, dtype=object)
+        if self.mode == "labels":
+            for i, label in enumerate(LABELS):
+                self.df[f'polarity_prob_{label}'] = [row['probs'][i] for row in rows]
+            self.df['polarity_confidence'] = [max(row['probs']) for row in rows]
+
+        self.stats = {
+            "rows": len(tweets),
+            "unique_tweets": len(unique_keys),
+            "cache_hits": sources.count('cache'),
+            "cascade_decided": n_cascade,
+            "inferred": len(missing),
+            "cache_hit_rate": sources.count('cache') / len(unique_keys) if unique_keys else 0.0,
+            # Share of rows whose polarity came from the LLM in this request
+            "llm_fraction": row_sources.count('llm') / len(tweets) if tweets else 0.0,
+            "engine": dict(self.engine.stats) if missing else None,
+        }
+        print(f"Polarity: {len(tweets)} rows, {len(unique_keys)} unique tweets, {self.stats['cache_hits']} cached, "
+              f"{n_cascade} decided by the cascade, {len(missing)} sent to the LLM ({self.stats['llm_fraction']:.1%} of rows)")
+
+
+    def classify_json(self, tweets, progress=None):
+        """ Generates a TweetPolarity object per tweet and reads the polarity off it. """
+        prefix, suffix = self.split_prompt(self.prompt)
+        texts = self.engine.generate(prefix, [suffix.format(tweet=tweet) for tweet in tweets], progress)
+
+        results = []
+        n_bad = 0
+        for text in texts:
+            resp = self.parse_json_objects(text)[:1]
+            try:
+                self.create_response_object(resp)
+                response_obj = resp[0]['response_obj']
+            except (ValueError, TypeError, IndexError):
+                print(f"Bad response: {text!r}")
+                n_bad += 1
+                results.append({'polarity': 'unsure', 'bad': True})
+                continue
+            # Check that only only one polarity is marked as 1 and that the model is sure
+            if response_obj & 0b1000: # support
+                results.append({'polarity': 'support'})
+            elif response_obj & 0b0100: # opposition
+                results.append({'polarity': 'opposition'})
+            elif response_obj & 0b0010: # neutral
+                results.append({'polarity': 'neutral'})
             else:
                 # TODO throw an error (or at least warning) if unsure?
-                resp['polarity'] = 'unsure'
-        response_df = pd.DataFrame(responses)
-        
-        # Handle potential length mismatch due to filtering None responses
-        if len(response_df) < len(self.df):
-            print(f"Warning: {len(self.df) - len(response_df)} tweets had empty responses")
-            # Pad with 'unsure' to match original length
-            padding = pd.Series(['unsure'] * (len(self.df) - len(response_df)))
-            self.df['polarity'] = pd.concat([response_df['polarity'], padding]).reset_index(drop=True)
-        else:
-            self.df['polarity'] = response_df['polarity']
+                results.append({'polarity': 'unsure'})
+
+        # Responses stay aligned with their tweets; bad ones are marked unsure in place
+        if n_bad:
+            print(f"Warning: {n_bad} tweets had empty responses")
+        return results
 
     
+    def classify_labels(self, tweets, progress=None):
+        """
+        Classifies every tweet from the next-token logits of the four labels, with no generation or parsing.
+        Each result has the most probable label and the calibrated probabilities of all four.
+        """
+        prefix, suffix = self.split_prompt(self.label_prompt)
+        token_ids = self.engine.label_token_ids(LABELS, LABEL_CUE)
+        content_free = None
+        if self.calibrate:
+            content_free = self.engine.score(prefix, [suffix.format(tweet="N/A")], token_ids)[0]
+        logits = self.engine.score(prefix, [suffix.format(tweet=tweet) for tweet in tweets], token_ids, progress)
+        probs = label_probabilities(logits, content_free, self.temperature)
+        return [{'polarity': LABELS[int(row.argmax())], 'probs': [float(p) for p in row]} for row in probs]
+
+
     def multiply_similarity_and_polarity(self):
         """
         Multiply the similarity score by the polarity score for each tweet.
@@ -135,7 +253,31 @@ class PolarityTester():
         neutral: int = Field(description="A 1 indicating the tweet is neutral to the target narrative or a 0 indicating it is not")
         unsure: int = Field(description="A 1 indicating you are unsure of the text's sentiment or a 0 indicating you are sure")
 
+
+def combine_polarity_stats(stats_list):
+    """ Sums the PolarityTester.stats of several check_polarity calls (e.g. the chunks of a streamed trace). """
+    stats_list = [stats for stats in stats_list if stats]
+    if not stats_list:
+        return None
+    combined = {key: sum(stats[key] for stats in stats_list)
+                for key in ["rows", "unique_tweets", "cache_hits", "cascade_decided", "inferred"]}
+    llm_rows = sum(stats["llm_fraction"] * stats["rows"] for stats in stats_list)
+    combined["cache_hit_rate"] = combined["cache_hits"] / combined["unique_tweets"] if combined["unique_tweets"] else 0.0
+    combined["llm_fraction"] = llm_rows / combined["rows"] if combined["rows"] else 0.0
+    engines = [stats["engine"] for stats in stats_list if stats["engine"]]
+    combined["engine"] = None
+    if engines:
+        seconds = sum(engine["seconds"] for engine in engines)
+        tweets = sum(engine["tweets"] for engine in engines)
+        combined["engine"] = {"tweets": tweets, "batches": sum(engine["batches"] for engine in engines),
+                              "prefill_seconds": sum(engine["prefill_seconds"] for engine in engines),
+                              "seconds": seconds, "tweets_per_sec": tweets / seconds if seconds > 0 else 0.0}
+    return combined
+
 if __name__ == "__main__":
+    from mlx_lm import load
+    import mlx.core as mx
+
     # Configure MLX to use GPU
     mx.set_default_device(mx.gpu)
     print(f"MLX is using device: {mx.default_device()}")
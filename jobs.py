@@ -0,0 +1,271 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import traceback
+import uuid
+
+
+class JobCancelled(Exception):
+    pass
+
+
+class JobProgress():
+    """
+    Progress reporter for one job, with the same progress.tqdm(iterable) interface the model code
+    already takes (Narrative_Generator.generate_narratives, PolarityTester.check_polarity), so a job
+    can be passed in wherever a progress object is accepted. Updates are written to the job's row at
+    most every min_interval seconds. A cancelled job stops at its next progress update.
+    """
+    def __init__(self, queue, job_id, min_interval=0.5):
+        self.queue = queue
+        self.job_id = job_id
+        self.min_interval = min_interval
+        self.message = None
+        self.current = 0
+        self.total = None
+        self._last_write = 0.0
+
+
+    def update(self, current=None, total=None, message=None, force=False):
+        if message is not None:
+            # A new stage starts counting from zero
+            self.message = message
+            self.current, self.total = 0, None
+            force = True
+        if current is not None:
+            self.current = current
+        if total is not None:
+            self.total = total
+        now = time.monotonic()
+        if force or now - self._last_write >= self.min_interval:
+            self._last_write = now
+            if self.queue.set_progress(self.job_id, self.current, self.total, self.message) == "cancelled":
+                raise JobCancelled(f"Job {self.job_id} was cancelled")
+
+
+    def tqdm(self, iterable, desc=None, total=None):
+        if total is None:
+            try:
+                total = len(iterable)
+            except TypeError:
+                total = None
+        if desc is not None:
+            self.update(message=desc)
+        self.update(0, total, force=True)
+        for i, item in enumerate(iterable):
+            yield item
+            self.update(i + 1, force=total is not None and i + 1 == total)
+
+
+class JobQueue():
+    """
+    SQLite-backed queue for the long-running API requests (traces, polarity, narrative generation).
+
+    Requests submit(kind, params) and get a job id back straight away; a single worker thread runs
+    the jobs in order with the handler registered for their kind, against the models already
+    loaded in this process, so jobs never load a model of their own. Status and progress live in
+    the jobs table and results are written to results_dir as JSON, so both survive a restart.
+    Jobs that were running when the server stopped are queued again on startup (unless recover is
+    False), and finished jobs are deleted after max_age_days. Several processes may share one
+    table (serve.py's workers): all of them submit, but serve.py starts the worker thread in just
+    one, so jobs still run one at a time against a single copy of each model. A claimed job records
+    the pid of the process running it, so recover(pid) can requeue the jobs of a process that died.
+    """
+    def __init__(self, path="jobs/jobs.sqlite", results_dir=None, max_age_days=7, encoder=json.dumps, recover=True):
+        directory = os.path.dirname(path)
+        self.results_dir = results_dir or os.path.join(directory, "results")
+        os.makedirs(self.results_dir, exist_ok=True)
+        self.path = path
+        self.max_age_days = max_age_days
+        # Serializes results; app.py passes Flask's so job results match the synchronous responses
+        self.encoder = encoder
+        self.handlers = {}
+        self._lock = threading.Lock()
+        self._wake = threading.Event()
+        self._worker = None
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS jobs ("
+            "id TEXT PRIMARY KEY, kind TEXT, owner TEXT, status TEXT, params TEXT, message TEXT, "
+            "current INTEGER, total INTEGER, error TEXT, created REAL, started REAL, finished REAL)"
+        )
+        self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, created)")
+        if "worker" not in [column[1] for column in self._conn.execute("PRAGMA table_info(jobs)")]:
+            # Tables created before jobs recorded the process running them
+            self._conn.execute("ALTER TABLE jobs ADD COLUMN worker INTEGER")
+        self._conn.commit()
+        if recover:
+            self.recover()
+        self.purge()
+
+
+    def recover(self, worker=None):
+        """ Queues the jobs that were running when the server stopped (or, given a pid, when that process died) again. """
+        with self._lock:
+            n_requeued = self._conn.execute(
+                "UPDATE jobs SET status = 'queued', started = NULL, worker = NULL WHERE status = 'running' AND (? IS NULL OR worker = ?)",
+                (worker, worker)).rowcount
+            self._conn.commit()
+        if n_requeued:
+            print(f"Requeued {n_requeued} interrupted jobs" + (f" of process {worker}" if worker is not None else ""))
+
+
+    def register(self, kind, handler):
+        """ handler(params, progress, owner) runs a job of this kind and returns its JSON-serializable result. """
+        self.handlers[kind] = handler
+
+
+    def start(self):
+        if self._worker is None:
+            self._worker = threading.Thread(target=self._run, name="job-worker", daemon=True)
+            self._worker.start()
+        self._wake.set()
+
+
+    def submit(self, kind, params, owner=None):
+        if kind not in self.handlers:
+            raise ValueError(f"Error: Unknown job kind '{kind}'. Use one of {sorted(self.handlers)}.")
+        job_id = uuid.uuid4().hex
+        with self._lock:
+            self._conn.execute(
+                "INSERT INTO jobs (id, kind, owner, status, params, current, created) VALUES (?, ?, ?, 'queued', ?, 0, ?)",
+                (job_id, kind, owner, json.dumps(params), time.time()),
+            )
+            self._conn.commit()
+        self._wake.set()
+        return job_id
+
+
+    def get(self, job_id, owner=None):
+        """ Status of a job as a dict (None if it does not exist or belongs to someone else). """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT id, kind, owner, status, message, current, total, error, created, started, finished "
+                "FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            if row is None or (owner is not None and row[2] != owner):
+                return None
+            position = None
+            if row[3] == "queued":
+                position = self._conn.execute(
+                    "SELECT COUNT(*) FROM jobs WHERE status = 'queued' AND created < ?", (row[8],)
+                ).fetchone()[0]
+        job = dict(zip(["id", "kind", "owner", "status", "message", "current", "total", "error",
+                        "created", "started", "finished"], row))
+        job["progress"] = job["current"] / job["total"] if job["total"] else None
+        job["queuePosition"] = position
+        if job["started"] is not None:
+            job["seconds"] = (job["finished"] or time.time()) - job["started"]
+        return job
+
+
+    def list(self, owner=None, limit=50):
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT id FROM jobs WHERE ? IS NULL OR owner = ? ORDER BY created DESC LIMIT ?", (owner, owner, limit)
+            ).fetchall()
+        return [self.get(job_id) for job_id, in rows]
+
+
+    def result_path(self, job_id):
+        return os.path.join(self.results_dir, f"{job_id}.json")
+
+
+    def result(self, job_id):
+        """ The serialized result of a finished job, or None. """
+        try:
+            with open(self.result_path(job_id)) as f:
+                return f.read()
+        except FileNotFoundError:
+            return None
+
+
+    def cancel(self, job_id, owner=None):
+        """ Cancels a queued job, or asks a running one to stop at its next progress update. """
+        job = self.get(job_id, owner)
+        if job is None or job["status"] not in ("queued", "running"):
+            return False
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET status = 'cancelled', finished = ? WHERE id = ? AND status IN ('queued', 'running')",
+                               (time.time(), job_id))
+            self._conn.commit()
+        return True
+
+
+    def set_progress(self, job_id, current, total, message):
+        """ Records progress and returns the job's status, so a running job notices cancellation. """
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET current = ?, total = ?, message = ? WHERE id = ? AND status = 'running'",
+                               (current, total, message, job_id))
+            self._conn.commit()
+            return self._conn.execute("SELECT status FROM jobs WHERE id = ?", (job_id,)).fetchone()[0]
+
+
+    def purge(self):
+        """ Deletes finished jobs (and their results) older than max_age_days. """
+        cutoff = time.time() - self.max_age_days * 86400
+        with self._lock:
+            old = [job_id for job_id, in self._conn.execute(
+                "SELECT id FROM jobs WHERE status IN ('done', 'failed', 'cancelled') AND finished < ?", (cutoff,))]
+            for start in range(0, len(old), 500):
+                batch = old[start:start + 500]
+                self._conn.execute(f"DELETE FROM jobs WHERE id IN ({','.join('?' * len(batch))})", batch)
+            self._conn.commit()
+        for job_id in old:
+            try:
+                os.remove(self.result_path(job_id))
+            except FileNotFoundError:
+                pass
+        if old:
+            print(f"Deleted {len(old)} jobs older than {self.max_age_days} days")
+
+
+    def _next(self):
+        with self._lock:
+            while True:
+                row = self._conn.execute(
+                    "SELECT id, kind, params, owner FROM jobs WHERE status = 'queued' ORDER BY created LIMIT 1"
+                ).fetchone()
+                if row is None:
+                    return None
+                # Another process may claim the same job between the SELECT and here; only one UPDATE matches
+                claimed = self._conn.execute("UPDATE jobs SET status = 'running', started = ?, worker = ? WHERE id = ? AND status = 'queued'",
+                                             (time.time(), os.getpid(), row[0])).rowcount
+                self._conn.commit()
+                if claimed:
+                    return row
+
+
+    def _finish(self, job_id, status, error=None):
+        with self._lock:
+            self._conn.execute("UPDATE jobs SET status = ?, error = ?, finished = ? WHERE id = ? AND status = 'running'",
+                               (status, error, time.time(), job_id))
+            self._conn.commit()
+
+
+    def _run(self):
+        while True:
+            row = self._next()
+            if row is None:
+                self._wake.wait(timeout=5)
+                self._wake.clear()
+                continue
+            job_id, kind, params, owner = row
+            start = time.perf_counter()
+            print(f"Job {job_id} ({kind}) started")
+            try:
+                result = self.handlers[kind](json.loads(params), JobProgress(self, job_id), owner)
+                tmp_path = self.result_path(job_id) + ".tmp"
+                with open(tmp_path, "w") as f:
+                    f.write(self.encoder(result))
+                os.replace(tmp_path, self.result_path(job_id))
+                self._finish(job_id, "done")
+                print(f"Job {job_id} ({kind}) done in {time.perf_counter() - start:.1f}s")
+            except JobCancelled:
+                print(f"Job {job_id} ({kind}) cancelled after {time.perf_counter() - start:.1f}s")
+            except Exception as e:
+                print(traceback.format_exc())
+                self._finish(job_id, "failed", str(e))
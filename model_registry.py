@@ -0,0 +1,161 @@
+import gc
+import threading
+import time
+from contextlib import contextmanager
+
+
+def rss_mb():
+    """ (current, peak) resident memory of this process in MB. """
+    try:
+        with open("/proc/self/status") as f:
+            status = dict(line.split(":", 1) for line in f)
+        return int(status["VmRSS"].split()[0]) / 1024, int(status["VmHWM"].split()[0]) / 1024
+    except FileNotFoundError:
+        # macOS: no /proc, and ru_maxrss is in bytes
+        import resource
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 ** 2
+        return peak, peak
+
+
+class ModelUnavailable(Exception):
+    """ The model is not part of the running profile. """
+    pass
+
+
+class ModelRegistry():
+    """
+    Loads models on first use instead of at import time.
+
+    Each model is registered with a loader (a function returning the loaded object) and an
+    optional ttl: get(name) loads it on first use, and models idle for longer than their ttl are
+    dropped by unload_idle (run periodically by start_reaper) and loaded again when next needed.
+    Callers should get() the model per request rather than keep it, so an unloaded model is
+    actually freed; work that holds a model for longer than its ttl (a long narrative run) takes
+    it with `with registry.using(name)`, and a model in use is never unloaded as idle. Load count, load seconds and the resident memory added by each load are kept
+    for report(); on Apple silicon, Metal buffers may not all show up in resident memory.
+    """
+    def __init__(self):
+        self.loaders = {}
+        self.ttls = {}
+        self.models = {}
+        self.last_used = {}
+        self.in_use = {}
+        self.stats = {}
+        self.disabled = set()
+        self._locks = {}
+        self._lock = threading.Lock()
+        self._reaper = None
+
+
+    def register(self, name, loader, ttl=None):
+        """ ttl: seconds a model may sit unused before it is unloaded (None keeps it loaded). """
+        self.loaders[name] = loader
+        self.ttls[name] = ttl
+        self._locks[name] = threading.Lock()
+        self.in_use[name] = 0
+        self.stats[name] = {"loads": 0, "load_seconds": 0.0, "last_load_seconds": None, "rss_added_mb": None}
+
+
+    def disable(self, name, reason=None):
+        """ Makes get(name) raise ModelUnavailable, e.g. for the models outside an embeddings-only profile. """
+        self.disabled.add(name)
+        self.stats[name]["disabled"] = reason or True
+
+
+    def get(self, name):
+        if name in self.disabled:
+            raise ModelUnavailable(f"Model '{name}' is not loaded in this server profile")
+        # One lock per model: concurrent first uses load it once, and other models are not blocked
+        with self._locks[name]:
+            if name not in self.models:
+                self.load(name)
+            self.last_used[name] = time.time()
+            return self.models[name]
+
+
+    @contextmanager
+    def using(self, name):
+        """ get(name) for the duration of a with block; unload_idle leaves the model alone until it exits. """
+        with self._locks[name]:
+            self.in_use[name] += 1
+        try:
+            yield self.get(name)
+        finally:
+            with self._locks[name]:
+                self.in_use[name] -= 1
+                self.last_used[name] = time.time()
+
+
+    def load(self, name):
+        before, _ = rss_mb()
+        start = time.perf_counter()
+        model = self.loaders[name]()
+        seconds = time.perf_counter() - start
+        after, _ = rss_mb()
+        with self._lock:
+            self.models[name] = model
+            stats = self.stats[name]
+            stats["loads"] += 1
+            stats["load_seconds"] += seconds
+            stats["last_load_seconds"] = seconds
+            stats["rss_added_mb"] = after - before
+        print(f"Loaded {name} in {seconds:.1f}s (+{after - before:.0f} MB resident)")
+
+
+    def is_loaded(self, name):
+        return name in self.models
+
+
+    def peek(self, name):
+        """ The model if it is loaded, without loading it or counting as a use. """
+        return self.models.get(name)
+
+
+    def unload(self, name, idle_for=None):
+        """ Frees the model; with idle_for (seconds), only if it is not in use and has been idle that long. """
+        with self._locks[name]:
+            if idle_for is not None and (self.in_use[name] or time.time() - self.last_used.get(name, 0) <= idle_for):
+                return False
+            with self._lock:
+                model = self.models.pop(name, None)
+            if model is None:
+                return False
+            del model
+            gc.collect()
+            try:
+                import mlx.core as mx
+                mx.clear_cache()
+            except (ImportError, AttributeError):
+                pass
+        print(f"Unloaded {name}")
+        return True
+
+
+    def unload_idle(self):
+        now = time.time()
+        for name in list(self.models):
+            ttl = self.ttls[name]
+            if ttl is not None and not self.in_use[name] and now - self.last_used.get(name, now) > ttl:
+                # Checked again under the model's lock, in case it was taken in the meantime
+                self.unload(name, idle_for=ttl)
+
+
+    def start_reaper(self, interval=60):
+        """ Checks for idle models every interval seconds on a background thread. """
+        def reap():
+            while True:
+                time.sleep(interval)
+                self.unload_idle()
+        if self._reaper is None and any(ttl is not None for ttl in self.ttls.values()):
+            self._reaper = threading.Thread(target=reap, name="model-reaper", daemon=True)
+            self._reaper.start()
+
+
+    def report(self):
+        now = time.time()
+        models = {}
+        for name in self.loaders:
+            models[name] = dict(self.stats[name], loaded=name in self.models, ttl=self.ttls[name], in_use=self.in_use[name],
+                                idle_seconds=now - self.last_used[name] if name in self.models else None)
+        current, peak = rss_mb()
+        return {"models": models, "rss_mb": current, "peak_rss_mb": peak}
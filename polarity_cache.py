@@ -0,0 +1,156 @@
+import hashlib
+import json
+import os
+import sqlite3
+import threading
+import time
+
+from preprocess import normalize_text
+
+
+class PolarityCache():
+    """
+    Persistent store of polarity results.
+
+    Entries are keyed by sha1(model name + prompt version + normalized narrative + tweet), where the
+    tweet is already in canonical form (preprocess.canonical_tweet), so retweets and near-identical
+    headlines share an entry. Results are small JSON objects (polarity and, in label mode, the label
+    probabilities) in a single SQLite file; past max_entries the least recently used are evicted.
+    The narrative and tweet text are kept too, so the LLM labels can train polarity_cascade.py.
+    """
+    def __init__(self, path="polarity_cache/polarity.sqlite", max_entries=5000000):
+        directory = os.path.dirname(path)
+        if directory:
+            os.makedirs(directory, exist_ok=True)
+        self.path = path
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS polarity ("
+            "key TEXT PRIMARY KEY, model TEXT, prompt_version TEXT, result TEXT, last_used REAL, narrative TEXT, tweet TEXT)"
+        )
+        # Caches written before the text columns existed
+        columns = {row[1] for row in self._conn.execute("PRAGMA table_info(polarity)")}
+        for column in ("narrative", "tweet"):
+            if column not in columns:
+                self._conn.execute(f"ALTER TABLE polarity ADD COLUMN {column} TEXT")
+        self._conn.execute("CREATE INDEX IF NOT EXISTS polarity_last_used ON polarity (last_used)")
+        self._conn.commit()
+        self.n_entries = self._conn.execute("SELECT COUNT(*) FROM polarity").fetchone()[0]
+
+
+    @staticmethod
+    def make_key(model_name, prompt_version, narrative, tweet):
+        parts = [model_name, prompt_version, normalize_text(narrative), tweet]
+        return hashlib.sha1("\0".join(parts).encode("utf-8")).hexdigest()
+
+
+    def lookup(self, model_name, prompt_version, narrative, tweets):
+        """ Returns a list with the cached result of each tweet, or None where it is not cached. """
+        keys = [self.make_key(model_name, prompt_version, narrative, tweet) for tweet in tweets]
+        found = {}
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                batch = list(set(keys[start:start + 500]))
+                rows = self._conn.execute(
+                    f"SELECT key, result FROM polarity WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchall()
+                for key, result in rows:
+                    found[key] = json.loads(result)
+            if found:
+                now = time.time()
+                self._conn.executemany("UPDATE polarity SET last_used = ? WHERE key = ?", [(now, key) for key in found])
+                self._conn.commit()
+            results = [found.get(key) for key in keys]
+            n_hits = sum(result is not None for result in results)
+            self.hits += n_hits
+            self.misses += len(keys) - n_hits
+        return results
+
+
+    def store(self, model_name, prompt_version, narrative, tweets, results):
+        """ Adds the results of tweets to the cache, evicting least recently used entries if over max_entries. """
+        now = time.time()
+        rows = {self.make_key(model_name, prompt_version, narrative, tweet):
+                (model_name, prompt_version, json.dumps(result), now, normalize_text(narrative), tweet)
+                for tweet, result in zip(tweets, results)}
+        keys = list(rows)
+        with self._lock:
+            for start in range(0, len(keys), 500):
+                batch = keys[start:start + 500]
+                self.n_entries -= self._conn.execute(
+                    f"SELECT COUNT(*) FROM polarity WHERE key IN ({','.join('?' * len(batch))})", batch
+                ).fetchone()[0]
+            self._conn.executemany(
+                "INSERT OR REPLACE INTO polarity (key, model, prompt_version, result, last_used, narrative, tweet) "
+                "VALUES (?, ?, ?, ?, ?, ?, ?)",
+                [(key, *row) for key, row in rows.items()],
+            )
+            self.n_entries += len(rows)
+            if self.n_entries > self.max_entries:
+                n_evict = self.n_entries - self.max_entries
+                self._conn.execute("DELETE FROM polarity WHERE key IN (SELECT key FROM polarity ORDER BY last_used ASC LIMIT ?)",
+                                   (n_evict,))
+                self.n_entries -= n_evict
+                self.evictions += n_evict
+            self._conn.commit()
+
+
+    def labelled_examples(self, model_name=None, limit=200000, prompt_version=None):
+        """ The most recently used (narrative, tweet, polarity) triples, optionally only those labelled by
+        model_name with prompt_version (as lookup matches them), so modes and old prompts don't mix. """
+        query = "SELECT narrative, tweet, result FROM polarity WHERE tweet IS NOT NULL"
+        params = []
+        if model_name is not None:
+            query += " AND model = ?"
+            params.append(model_name)
+        if prompt_version is not None:
+            query += " AND prompt_version = ?"
+            params.append(prompt_version)
+        query += " ORDER BY last_used DESC LIMIT ?"
+        params.append(limit)
+        with self._lock:
+            rows = self._conn.execute(query, params).fetchall()
+        return [(narrative, tweet, json.loads(result)["polarity"]) for narrative, tweet, result in rows]
+
+
+    def count(self, model_name=None, prompt_version=None):
+        """ Number of entries with text, i.e. usable as training examples. """
+        query = "SELECT COUNT(*) FROM polarity WHERE tweet IS NOT NULL"
+        params = []
+        if model_name:
+            query += " AND model = ?"
+            params.append(model_name)
+        if prompt_version is not None:
+            query += " AND prompt_version = ?"
+            params.append(prompt_version)
+        with self._lock:
+            return self._conn.execute(query, params).fetchone()[0]
+
+
+    def stats(self):
+        lookups = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "hit_rate": self.hits / lookups if lookups else 0.0,
+            "evictions": self.evictions,
+            "entries": self.n_entries,
+        }
+
+
+    def log_stats(self):
+        stats = self.stats()
+        print(f"Polarity cache: {stats['hits']} hits, {stats['misses']} misses ({stats['hit_rate']:.1%} hit rate), "
+              f"{stats['evictions']} evictions, {stats['entries']} entries")
+        return stats
+
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,137 @@
+import threading
+import time
+
+import numpy as np
+from sklearn.linear_model import LogisticRegression
+from sklearn.model_selection import train_test_split
+from preprocess import embed_texts, embed_narratives, normalize_text
+
+
+class PolarityCascade():
+    """
+    Cheap first stage in front of the LLM polarity check.
+
+    A logistic regression over the tweet embedding, the narrative embedding and their elementwise
+    product is trained on labels the LLM already produced (see PolarityCache.labelled_examples).
+    Tweets it classifies with probability >= confidence are decided here; the rest escalate to the
+    LLM. confidence is the accuracy/cost knob: raising it sends more tweets to the LLM and makes the
+    cascade's own decisions more accurate. fit reports held-out accuracy and coverage per level.
+    With prompt_version (PolarityTester.prompt_version), only labels from that prompt and mode are
+    trained on.
+    """
+    LEVELS = [0.5, 0.6, 0.7, 0.8, 0.9, 0.95, 0.99]
+
+    def __init__(self, sent_model, confidence=0.9, cache=None, min_examples=200, batch_size=64, prompt_version=None):
+        self.sent_model = sent_model
+        self.confidence = confidence
+        self.prompt_version = prompt_version
+        # Optional EmbeddingCache for the tweet and narrative embeddings
+        self.cache = cache
+        self.min_examples = min_examples
+        self.batch_size = batch_size
+        self.classifier = None
+        self.n_examples = 0
+        # Cache count at the last fit attempt, trained or not; maybe_refit waits for it to grow
+        self.attempted_count = 0
+        self.report = []
+        self._refit = None
+
+
+    @property
+    def ready(self):
+        return self.classifier is not None
+
+
+    def features(self, tweets, narrative_embeds):
+        tweet_embeds = embed_texts(self.sent_model, tweets, batch_size=self.batch_size, cache=self.cache)
+        product = tweet_embeds * narrative_embeds
+        return np.hstack([tweet_embeds, narrative_embeds, product, product.sum(axis=1, keepdims=True)])
+
+
+    def narrative_features(self, tweets, narratives):
+        unique = sorted(set(narratives))
+        embeds = embed_narratives(self.sent_model, unique, cache=self.cache)
+        index = {narrative: i for i, narrative in enumerate(unique)}
+        return self.features(tweets, embeds[[index[narrative] for narrative in narratives]])
+
+
+    def fit(self, narratives, tweets, labels, holdout=0.2, seed=0):
+        """ Trains on (narrative, tweet, LLM label) examples. Returns False if there are too few to train on. """
+        if len(tweets) < self.min_examples or len(set(labels)) < 2:
+            print(f"Polarity cascade: {len(tweets)} labelled examples, need {self.min_examples} with 2+ labels; not trained")
+            return False
+        start = time.perf_counter()
+        narratives = [normalize_text(narrative) for narrative in narratives]
+        X = self.narrative_features(list(tweets), narratives)
+        y = np.asarray(labels, dtype=object)
+
+        # Held-out accuracy and coverage at each confidence level, for choosing the knob
+        X_train, X_test, y_train, y_test = train_test_split(X, y, test_size=holdout, random_state=seed)
+        classifier = LogisticRegression(max_iter=1000).fit(X_train, y_train)
+        probs = classifier.predict_proba(X_test)
+        predicted = classifier.classes_[probs.argmax(axis=1)]
+        confidence = probs.max(axis=1)
+        self.report = []
+        for level in self.LEVELS:
+            decided = confidence >= level
+            self.report.append({
+                "confidence": level,
+                "decided": float(decided.mean()),
+                "accuracy": float((predicted[decided] == y_test[decided]).mean()) if decided.any() else None,
+            })
+
+        self.classifier = LogisticRegression(max_iter=1000).fit(X, y)
+        self.n_examples = len(y)
+        print(f"Polarity cascade trained on {len(y)} examples in {time.perf_counter() - start:.1f}s")
+        for row in self.report:
+            accuracy = f"{row['accuracy']:.1%}" if row["accuracy"] is not None else "-"
+            print(f"  confidence >= {row['confidence']:.2f}: decides {row['decided']:.1%} of tweets, {accuracy} accurate")
+        return True
+
+
+    def fit_from_cache(self, polarity_cache, model_name=None, limit=200000):
+        """ Trains on the labels in a PolarityCache (only model_name's, if given). """
+        examples = polarity_cache.labelled_examples(model_name, limit, self.prompt_version)
+        if not examples:
+            print("Polarity cascade: no labelled examples in the cache yet")
+            return False
+        narratives, tweets, labels = zip(*examples)
+        return self.fit(narratives, tweets, labels)
+
+
+    def maybe_refit(self, polarity_cache, model_name=None, growth=0.2):
+        """ Refits once the cache holds `growth` (a fraction) more labelled examples than at the last attempt. """
+        n = polarity_cache.count(model_name, self.prompt_version)
+        if n >= self.min_examples and n > self.attempted_count * (1 + growth):
+            self.attempted_count = n
+            return self.fit_from_cache(polarity_cache, model_name)
+        return False
+
+
+    def refit_in_background(self, polarity_cache, model_name=None, growth=0.2):
+        """
+        maybe_refit on a background thread, so requests don't wait for the fit. The new classifier
+        replaces the old one when it is done; decide keeps using the old one until then. Does nothing
+        while a refit is already running. Returns the thread, or None if no refit was started.
+        """
+        if self._refit is not None and self._refit.is_alive():
+            return None
+        n = polarity_cache.count(model_name, self.prompt_version)
+        if n < self.min_examples or n <= self.attempted_count * (1 + growth):
+            return None
+        self._refit = threading.Thread(target=self.maybe_refit, args=(polarity_cache, model_name, growth),
+                                       name="cascade-refit", daemon=True)
+        self._refit.start()
+        return self._refit
+
+
+    def decide(self, tweets, narrative, confidence=None):
+        """ Returns (labels, class probabilities, mask of the tweets confident enough to skip the LLM, and
+        the classes the probability columns belong to). """
+        narrative_embed = embed_narratives(self.sent_model, [normalize_text(narrative)], cache=self.cache)[0]
+        X = self.features(list(tweets), np.repeat(narrative_embed[None], len(tweets), axis=0))
+        # A background refit may swap the classifier; use one for both the probabilities and their classes
+        classifier = self.classifier
+        probs = classifier.predict_proba(X)
+        labels = classifier.classes_[probs.argmax(axis=1)]
+        return labels, probs, probs.max(axis=1) >= (self.confidence if confidence is None else confidence), list(classifier.classes_)
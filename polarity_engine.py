@@ -0,0 +1,302 @@
+import copy
+import json
+import time
+from abc import ABC, abstractmethod
+
+import numpy as np
+from tqdm import tqdm
+
+
+class PolarityEngine(ABC):
+    """
+    Generates the polarity responses for many tweets that share one prompt prefix (system prompt,
+    format instructions and target narrative). Backends implement prefill(prefix), which processes
+    the shared prefix once and keeps its KV cache, generate_batch(suffixes), which continues that
+    cache with each tweet, and score_batch(suffixes, token_ids), the next-token logits of the given
+    tokens after each tweet, used to classify with one forward pass and no generation. The prefix
+    cache is kept until the prefix changes, so repeat requests for the same narrative skip the
+    prefix entirely. Whether the tweets of a batch share forward passes is up to the backend: the
+    Transformers one pads them into one batch, the MLX one runs them one after another.
+    """
+    def __init__(self, batch_size=16, max_tokens=64, name=None):
+        self.batch_size = batch_size
+        self.max_tokens = max_tokens
+        # Identifies the model in polarity cache keys
+        self.name = name or type(self).__name__
+        self.prefix = None
+        self.stats = {}
+
+
+    def prefill(self, prefix):
+        self.prefix = prefix
+
+
+    @abstractmethod
+    def generate_batch(self, suffixes):
+        pass
+
+
+    @abstractmethod
+    def score_batch(self, suffixes, token_ids):
+        pass
+
+
+    def label_token_ids(self, labels, cue):
+        """ First token of each label when it follows cue. The labels must start with distinct tokens. """
+        cue_ids = self.tokenizer.encode(cue, add_special_tokens=False)
+        token_ids = [self.tokenizer.encode(cue + " " + label, add_special_tokens=False)[len(cue_ids)] for label in labels]
+        if len(set(token_ids)) < len(labels):
+            raise ValueError(f"Error: The labels {labels} do not start with distinct tokens for this tokenizer.")
+        return token_ids
+
+
+    def generate(self, prefix, suffixes, progress=None):
+        """ Returns the generated text for prefix + suffix for every suffix, in input order. """
+        return self.run(prefix, suffixes, self.generate_batch, progress)
+
+
+    def score(self, prefix, suffixes, token_ids, progress=None):
+        """ Returns an (n, len(token_ids)) array of next-token logits after prefix + suffix for every suffix. """
+        logits = self.run(prefix, suffixes, lambda batch: self.score_batch(batch, token_ids), progress)
+        return np.array(logits, dtype=np.float64).reshape(len(suffixes), len(token_ids))
+
+
+    def run(self, prefix, suffixes, batch_fn, progress=None):
+        start = time.perf_counter()
+        if prefix != self.prefix:
+            self.prefill(prefix)
+        prefill_seconds = time.perf_counter() - start
+
+        # Similar lengths in a batch means less padding
+        order = sorted(range(len(suffixes)), key=lambda i: len(suffixes[i]))
+        batches = [order[i:i + self.batch_size] for i in range(0, len(order), self.batch_size)]
+        outputs = [None] * len(suffixes)
+        for batch in (progress.tqdm(batches) if progress else tqdm(batches, desc="Polarity")):
+            for i, output in zip(batch, batch_fn([suffixes[i] for i in batch])):
+                outputs[i] = output
+
+        seconds = time.perf_counter() - start
+        self.stats = {
+            "tweets": len(suffixes),
+            "batches": len(batches),
+            "prefill_seconds": prefill_seconds,
+            "seconds": seconds,
+            "tweets_per_sec": len(suffixes) / seconds if seconds > 0 else 0.0,
+        }
+        print(f"Polarity for {len(suffixes)} tweets in {seconds:.2f}s ({self.stats['tweets_per_sec']:.1f} tweets/sec)")
+        return outputs
+
+
+def is_complete(text):
+    """ Whether a generated response already contains a closed JSON object, so decoding can stop. """
+    return "{" in text and "}" in text[text.index("{"):]
+
+
+class MLXPolarityEngine(PolarityEngine):
+    """
+    mlx_lm backend. The shared prefix is prefilled once into a prompt cache; each tweet is generated
+    on top of it and the cache is then trimmed back to the prefix, so only the tweet's own tokens are
+    prefilled. mlx_lm's models take no padding mask, so tweets are prefilled and decoded one after
+    another: the saving over the original per-tweet prompt is the shared prefix, not batching, and
+    batch_size only sets how often progress is reported.
+    """
+    def __init__(self, model, tokenizer, batch_size=16, max_tokens=64, temp=0.0, name=None):
+        super().__init__(batch_size, max_tokens, name)
+        self.model = model
+        self.tokenizer = tokenizer
+        self.temp = temp
+        self.cache = None
+
+
+    def prefill(self, prefix):
+        import mlx.core as mx
+        from mlx_lm.models.cache import make_prompt_cache
+
+        self.cache = make_prompt_cache(self.model)
+        self.model(mx.array(self.tokenizer.encode(prefix))[None], cache=self.cache)
+        mx.eval([c.state for c in self.cache])
+        self.prefix_length = self.cache[0].offset
+        self.prefix = prefix
+
+
+    def trim_to_prefix(self):
+        """ Drops everything after the prefix from the cache, by its offset rather than by counting tokens. """
+        from mlx_lm.models.cache import trim_prompt_cache
+
+        trim_prompt_cache(self.cache, self.cache[0].offset - self.prefix_length)
+
+
+    def generate_batch(self, suffixes):
+        import mlx.core as mx
+        from mlx_lm.sample_utils import make_sampler
+        from mlx_lm.utils import generate_step
+
+        sampler = make_sampler(self.temp)
+        outputs = []
+        for suffix in suffixes:
+            prompt = mx.array(self.tokenizer.encode(suffix, add_special_tokens=False))
+            tokens = []
+            for token, _ in generate_step(prompt, self.model, max_tokens=self.max_tokens, sampler=sampler,
+                                          prompt_cache=self.cache):
+                if token == self.tokenizer.eos_token_id:
+                    break
+                tokens.append(token)
+                if is_complete(self.tokenizer.decode(tokens)):
+                    break
+            # Drop this tweet and its generated tokens from the cache, keeping the prefix. generate_step
+            # runs one token ahead, so the cache holds more than prompt + tokens (e.g. the EOS)
+            self.trim_to_prefix()
+            outputs.append(self.tokenizer.decode(tokens))
+        return outputs
+
+
+    def score_batch(self, suffixes, token_ids):
+        import mlx.core as mx
+
+        outputs = []
+        for suffix in suffixes:
+            prompt = mx.array(self.tokenizer.encode(suffix, add_special_tokens=False))
+            logits = self.model(prompt[None], cache=self.cache)[0, -1]
+            outputs.append(np.array(logits[mx.array(token_ids)].astype(mx.float32)))
+            self.trim_to_prefix()
+        return outputs
+
+
+class TransformersPolarityEngine(PolarityEngine):
+    """
+    Hugging Face Transformers backend, usable on CPU with a small local model. The prefix KV cache is
+    computed once and repeated across the batch; each batch of tweets is left-padded (the padding sits
+    between prefix and tweet and is masked out) and decoded greedily in lockstep.
+    """
+    def __init__(self, model, tokenizer=None, batch_size=16, max_tokens=64, device=None, name=None):
+        super().__init__(batch_size, max_tokens, name or (model if isinstance(model, str) else model.config._name_or_path))
+        import torch
+        from transformers import AutoModelForCausalLM, AutoTokenizer
+
+        if isinstance(model, str):
+            tokenizer = tokenizer or AutoTokenizer.from_pretrained(model)
+            model = AutoModelForCausalLM.from_pretrained(model)
+        self.device = device or ("cuda" if torch.cuda.is_available() else "cpu")
+        self.model = model.to(self.device).eval()
+        self.tokenizer = tokenizer
+        self.pad_token_id = tokenizer.pad_token_id if tokenizer.pad_token_id is not None else tokenizer.eos_token_id
+        self.prefix_cache = None
+        self.prefix_length = 0
+
+
+    def prefill(self, prefix):
+        import torch
+
+        input_ids = torch.tensor([self.tokenizer.encode(prefix)], device=self.device)
+        with torch.no_grad():
+            self.prefix_cache = self.model(input_ids=input_ids, use_cache=True).past_key_values
+        self.prefix_length = input_ids.shape[1]
+        self.prefix = prefix
+
+
+    def forward_suffixes(self, suffixes):
+        """ Runs a left-padded batch of suffixes on top of the prefix cache; returns the model output and attention mask. """
+        import torch
+
+        encoded = [self.tokenizer.encode(suffix, add_special_tokens=False) for suffix in suffixes]
+        width = max(len(ids) for ids in encoded)
+        input_ids = torch.tensor([[self.pad_token_id] * (width - len(ids)) + ids for ids in encoded], device=self.device)
+        suffix_mask = torch.tensor([[0] * (width - len(ids)) + [1] * len(ids) for ids in encoded], device=self.device)
+        attention_mask = torch.cat([torch.ones(len(suffixes), self.prefix_length, dtype=suffix_mask.dtype, device=self.device),
+                                    suffix_mask], dim=1)
+        # Positions count only unmasked tokens, so each tweet continues right after the prefix
+        position_ids = (attention_mask.cumsum(dim=1) - 1).clamp(min=0)[:, self.prefix_length:]
+
+        cache = copy.deepcopy(self.prefix_cache)
+        cache.batch_repeat_interleave(len(suffixes))
+        with torch.no_grad():
+            out = self.model(input_ids=input_ids, attention_mask=attention_mask, position_ids=position_ids,
+                             past_key_values=cache, use_cache=True)
+        return out, attention_mask
+
+
+    def score_batch(self, suffixes, token_ids):
+        out, _ = self.forward_suffixes(suffixes)
+        return out.logits[:, -1, token_ids].float().cpu().numpy()
+
+
+    def generate_batch(self, suffixes):
+        import torch
+
+        out, attention_mask = self.forward_suffixes(suffixes)
+        tokens = [[] for _ in suffixes]
+        done = [False] * len(suffixes)
+        with torch.no_grad():
+            for _ in range(self.max_tokens):
+                next_tokens = out.logits[:, -1].argmax(dim=-1)
+                for i, token in enumerate(next_tokens.tolist()):
+                    if done[i]:
+                        continue
+                    if token == self.tokenizer.eos_token_id:
+                        done[i] = True
+                        continue
+                    tokens[i].append(token)
+                    done[i] = is_complete(self.tokenizer.decode(tokens[i]))
+                if all(done):
+                    break
+                attention_mask = torch.cat([attention_mask, torch.ones_like(attention_mask[:, :1])], dim=1)
+                out = self.model(input_ids=next_tokens[:, None], attention_mask=attention_mask,
+                                 position_ids=attention_mask.sum(dim=1, keepdim=True) - 1,
+                                 past_key_values=out.past_key_values, use_cache=True)
+        return [self.tokenizer.decode(ids) for ids in tokens]
+
+
+class StubPolarityEngine(PolarityEngine):
+    """ Model-free backend for tests: answers every tweet with rule(tweet), a polarity label (default neutral). """
+    def __init__(self, rule=None, batch_size=16, name="stub"):
+        super().__init__(batch_size, name=name)
+        self.rule = rule or (lambda tweet: "neutral")
+
+
+    def generate_batch(self, suffixes):
+        outputs = []
+        for suffix in suffixes:
+            label = self.rule(suffix)
+            outputs.append(json.dumps({key: int(key == label) for key in ["support", "opposition", "neutral", "unsure"]}))
+        return outputs
+
+
+    def label_token_ids(self, labels, cue):
+        self.labels = list(labels)
+        return list(range(len(labels)))
+
+
+    def score_batch(self, suffixes, token_ids):
+        # Logit 4 for the rule's label and 0 for the others; the content-free "N/A" tweet has no preference
+        return [[4.0 if label == self.rule(suffix) and not suffix.startswith("N/A") else 0.0 for label in self.labels]
+                for suffix in suffixes]
+
+
+def softmax(logits):
+    logits = logits - logits.max(axis=-1, keepdims=True)
+    probs = np.exp(logits)
+    return probs / probs.sum(axis=-1, keepdims=True)
+
+
+def label_probabilities(logits, content_free_logits=None, temperature=1.0):
+    """
+    Label probabilities from next-token label logits. With content_free_logits (the logits for a
+    content-free input such as "N/A" under the same prompt) the model's prior towards each label is
+    divided out (contextual calibration); temperature softens or sharpens the result.
+    """
+    probs = softmax(np.asarray(logits, dtype=np.float64) / temperature)
+    if content_free_logits is not None:
+        probs = probs / softmax(np.asarray(content_free_logits, dtype=np.float64) / temperature)
+        probs = probs / probs.sum(axis=-1, keepdims=True)
+    return probs
+
+
+def make_polarity_engine(backend, model=None, tokenizer=None, **kwargs):
+    """ Polarity engine for backend "mlx", "transformers" or "stub". """
+    if backend == "mlx":
+        return MLXPolarityEngine(model, tokenizer, **kwargs)
+    if backend == "transformers":
+        return TransformersPolarityEngine(model, tokenizer, **kwargs)
+    if backend == "stub":
+        return StubPolarityEngine(**kwargs)
+    raise ValueError(f"Error: Unknown polarity backend '{backend}'. Use 'mlx', 'transformers' or 'stub'.")
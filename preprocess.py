@@ -1,11 +1,29 @@
 import pandas as pd
 import numpy as np
 import os
+import re
+import threading
+import unicodedata
+from concurrent.futures import ThreadPoolExecutor
 
 
-def read_media(file):
-    """ Returns a pandas dataframe of the file. """
-    if file.endswith(".csv"):
+def read_media(file, timeframe=None, columns=None):
+    """ Returns a pandas dataframe of the file.
+    Parquet files and day-partitioned Parquet datasets (see storage.py) are also accepted; for those
+    only the rows in timeframe=[start, end] and the given columns are read from disk. """
+    if file.endswith(".parquet") or os.path.isdir(file):
+        from storage import read_date_range, read_parquet
+        try:
+            start, end = timeframe if timeframe is not None else (None, None)
+            if os.path.isdir(file):
+                df = read_date_range(file, start, end, columns=columns)
+            else:
+                df = read_parquet(file, columns=columns, start=start, end=end)
+        except FileNotFoundError:
+            raise ValueError(f"Error: The file '{file}' was not found.")
+        except Exception as e:
+            raise ValueError(f"Error loading file '{file}': {e}")
+    elif file.endswith(".csv"):
         try:
             df = pd.read_csv(file, encoding="utf-8", encoding_errors="ignore")
         except FileNotFoundError:
@@ -26,51 +44,362 @@ def read_media(file):
         except Exception as e:
             raise ValueError(f"Error loading file '{file}': {e}")
     else:
-        raise ValueError("Unsupported file format. Please provide a .csv or .txt file.")
-    # Assumes that "Tweet" column is in every csv read
+        raise ValueError("Unsupported file format. Please provide a .csv, .txt or .parquet file.")
+    return add_author_tweet(df)
+
+
+def add_author_tweet(df):
+    # Assumes that "Tweet" column is in every csv read. Both sides are object columns: pandas won't add an
+    # object column to an empty Arrow string one (e.g. a Parquet date range with no rows)
     try:
-        df["AuthorTweet"] = "Author: " + df["ChannelName"] + "\nTweet: " + df["Tweet"]
+        df["AuthorTweet"] = "Author: " + df["ChannelName"].astype(object) + "\nTweet: " + df["Tweet"].astype(object)
     except KeyError:
-        df["AuthorTweet"] = "Tweet: " + df["Tweet"]
+        df["AuthorTweet"] = "Tweet: " + df["Tweet"].astype(object)
+    return df
+
+
+# Columns of a Junkipedia export that the pipeline actually uses
+JUNKIPEDIA_COLUMNS = ["post_body_text", "ChannelName", "published_at", "PostId"]
+CHUNK_DTYPES = {"PostId": "Int64", "LikesCount": "Int64", "SharesCount": "Int64", "CommentsCount": "Int64",
+                "ViewsCount": "Int64"}
+
 
+def coalesce_tweets(df):
+    """ Vectorized Tweet text for Junkipedia rows: post_body_text, or the "Embedded content: " marker
+    where it is missing. process_full_tweets has always built it this way; EmbeddedContentText comes
+    after the (never null) marker, so it is never used. """
+    return df["post_body_text"].astype(object).fillna("Embedded content: ")
+
+
+def prepare_junkipedia(df):
+    """ Adds the Tweet, AuthorTweet, Datetime and id columns to (a chunk of) a raw Junkipedia export. """
+    df["Tweet"] = coalesce_tweets(df)
+    df = add_author_tweet(df)
+    # df["Datetime"] = pd.to_datetime(df["date"], format="%Y-%m-%d %H:%M:%S")
+    df["Datetime"] = pd.to_datetime(df["published_at"], format="%Y-%m-%dT%H:%M:%S.%fZ").dt.floor('s')
+    df["id"] = df["PostId"]
     return df
 
 
-def preprocess_context_window(file, smallest_batch_size):
-    if file.endswith(".txt"):
-        with open(file, "r") as f:
-            #TODO batch tweets together somehow -- append previously found narratives to the new batch of tweets? Largest batch possible? very small frequent chunks? Enough to get a general sense of thoughts? Very small then aggregate up multiple times?
-            pass
-    elif file.endswith(".csv"):
-        df = pd.read_csv(file, encoding='utf-8', encoding_errors='ignore')
-        # Create n_tweets / smallest_batch_size chunks of tweets / data
-        chunks = chunk_it(df, smallest_batch_size)
-        return chunks
+def read_media_chunks(file, chunksize=50000, columns=None, compact_dtypes=True):
+    """
+    Streams a CSV (a path or a seekable file object) as DataFrames of at most chunksize rows instead of loading it whole.
+    Raw Junkipedia exports are read with only JUNKIPEDIA_COLUMNS (plus any extra columns asked for)
+    and get their Tweet/AuthorTweet/Datetime/id columns chunk by chunk; other CSVs read the given
+    columns, or all of them. With compact_dtypes, ChannelName is stored as a category and counts
+    as nullable ints.
+    """
+    try:
+        header = pd.read_csv(file, nrows=0, encoding="utf-8", encoding_errors="ignore").columns
+    except FileNotFoundError:
+        raise ValueError(f"Error: The file '{file}' was not found.")
+    except pd.errors.EmptyDataError:
+        raise ValueError(f"Error: The file '{file}' is empty or corrupted.")
+    if hasattr(file, "seek"):
+        # A file object (e.g. an upload): read it again from the start
+        file.seek(0)
+    raw = "Tweet" not in header and "post_body_text" in header
+    if raw:
+        usecols = [c for c in header if c in JUNKIPEDIA_COLUMNS or (columns is not None and c in columns)]
+    else:
+        usecols = None if columns is None else [c for c in header if c in columns or c in ("Tweet", "ChannelName")]
+    selected = header if usecols is None else usecols
+    reader = pd.read_csv(file, usecols=usecols, chunksize=chunksize, encoding="utf-8", encoding_errors="ignore",
+                         dtype={c: t for c, t in CHUNK_DTYPES.items() if c in selected} if compact_dtypes else None)
+    for chunk in reader:
+        chunk = prepare_junkipedia(chunk) if raw else add_author_tweet(chunk)
+        if compact_dtypes and "ChannelName" in chunk.columns:
+            chunk["ChannelName"] = chunk["ChannelName"].astype("category")
+        yield chunk
+
+
+# Columns an upload is parsed with (plus any the request asks for); the rest are never materialized
+UPLOAD_COLUMNS = ["Tweet", "ChannelName", "Datetime", "Date", "published_at", "id", "PostId", "Tweetid"]
+
+
+def upload_format(fileobj):
+    """ "parquet", "gzip" (a gzipped CSV) or "csv", from an uploaded file's magic bytes. """
+    head = fileobj.read(4)
+    fileobj.seek(0)
+    if head == b"PAR1":
+        return "parquet"
+    if head[:2] == b"\x1f\x8b":
+        return "gzip"
+    return "csv"
+
+
+def read_upload_chunks(fileobj, fmt=None, chunksize=50000, columns=None):
+    """
+    Parses an uploaded CSV, gzipped CSV or Parquet file object chunk by chunk with the same
+    Tweet/AuthorTweet (and, for raw Junkipedia exports, Datetime/id) preprocessing as read_media,
+    reading only UPLOAD_COLUMNS plus the given columns.
+    """
+    fmt = fmt or upload_format(fileobj)
+    columns = UPLOAD_COLUMNS + list(columns or [])
+    if fmt == "parquet":
+        import pyarrow.parquet as pq
+        parquet = pq.ParquetFile(fileobj)
+        names = parquet.schema_arrow.names
+        raw = "Tweet" not in names and "post_body_text" in names
+        wanted = JUNKIPEDIA_COLUMNS + columns if raw else columns
+        for batch in parquet.iter_batches(batch_size=chunksize, columns=[c for c in names if c in wanted]):
+            chunk = batch.to_pandas()
+            yield prepare_junkipedia(chunk) if raw else add_author_tweet(chunk)
+    elif fmt in ("csv", "gzip"):
+        if fmt == "gzip":
+            import gzip
+            fileobj = gzip.GzipFile(fileobj=fileobj)
+        yield from read_media_chunks(fileobj, chunksize=chunksize, columns=columns, compact_dtypes=False)
+    else:
+        raise ValueError(f"Error: Unsupported upload format '{fmt}'. Use 'csv', 'gzip' or 'parquet'.")
+
+
+def embed_media_chunks(model, file, text_column="Tweet", chunksize=50000, batch_size=64, cache=None, columns=None):
+    """ Streams (chunk, embeddings) pairs for a CSV so it is embedded without materializing the full frame. """
+    for chunk in read_media_chunks(file, chunksize=chunksize, columns=columns):
+        yield chunk, embed_texts(model, chunk[text_column], batch_size=batch_size, cache=cache)
+
+
+def preprocess_context_window(data, smallest_batch_size, window=None):
+    """
+    Splits a dataset (a file read with read_media, or a dataframe) into batches small enough to
+    summarize in one pass. With window (a pandas frequency such as "D", "W" or "MS") tweets are first
+    grouped by Datetime window, and each window is then chunked into batches of about
+    smallest_batch_size rows. Returns a list of (key, dataframe) pairs in chronological order,
+    where the key ("2024-01-01" or "2024-01-01_part2", "chunk0003" without a window) is stable across reruns.
+    """
+    df = read_media(data) if isinstance(data, str) else data
+    if window is None:
+        return [(f"chunk{i:04d}", chunk) for i, chunk in enumerate(chunk_it(df, smallest_batch_size))]
+
+    df = add_datetime_column(df.copy(), sort=True)
+    batches = []
+    windows = [(start.strftime("%Y-%m-%d"), window_df)
+               for start, window_df in df.groupby(pd.Grouper(key="Datetime", freq=window)) if len(window_df)]
+    if df["Datetime"].isna().any():
+        windows.append(("undated", df[df["Datetime"].isna()]))
+    for start, window_df in windows:
+        chunks = chunk_it(window_df, smallest_batch_size)
+        for i, chunk in enumerate(chunks):
+            batches.append((start + (f"_part{i + 1}" if len(chunks) > 1 else ""), chunk))
+    return batches
 
 
 def chunk_it(array, k):
-    """ Turns an array into k chunks of roughly equal size. """
-    return np.array_split(array, np.ceil(len(array) / k).astype(int))
+    """ Turns an array into chunks of roughly equal size, with at most k items each. """
+    bounds = np.array_split(np.arange(len(array)), max(1, np.ceil(len(array) / k).astype(int)))
+    if isinstance(array, (pd.DataFrame, pd.Series)):
+        # np.array_split no longer keeps pandas objects intact
+        return [array.iloc[chunk[0]:chunk[-1] + 1] if len(chunk) else array.iloc[:0] for chunk in bounds]
+    return [array[chunk[0]:chunk[-1] + 1] if len(chunk) else array[:0] for chunk in bounds]
 
 
-def embed_narratives(model, narratives):
-    nar_embeds = []
-    for narrative in narratives:
-        nar_embeds.append(model.encode(narrative, convert_to_tensor=True))
-    return nar_embeds
+def normalize_text(text):
+    """ Canonical form of a tweet used for hashing: NFKC unicode, collapsed whitespace, no surrounding space. """
+    return re.sub(r"\s+", " ", unicodedata.normalize("NFKC", str(text))).strip()
 
 
-def process_full_tweets(file):
-    """ Processes csv files from Junkipedia Twitter data. """
-    df = read_media(file)
-    # df["Tweet"] = df["post_body_text"] +  "Embedded: " + df["EmbeddedContentText"]
-    df["embedded"] = "Embedded content: "
-    df["Tweet"] = df[["post_body_text", "embedded", "EmbeddedContentText"]].apply(lambda row: row.dropna().tolist(), axis=1).str[0]
-    df["AuthorTweet"] = "Author: " + df["ChannelName"] + "\nTweet: " + df["Tweet"]
-    # df["Datetime"] = pd.to_datetime(df["date"], format="%Y-%m-%d %H:%M:%S")
-    df["Datetime"] = pd.to_datetime(df["published_at"], format="%Y-%m-%dT%H:%M:%S.%fZ").dt.floor('s')
-    df["id"] = df["PostId"]
-    df.to_csv("tweets/full_" + os.path.basename(file))
+def canonical_tweet(text):
+    """ Looser form of normalize_text that retweets and near-identical headlines share: lowercase, without an
+    "RT @user:" prefix, links or punctuation. Falls back to normalize_text for tweets that are only a link. """
+    text = normalize_text(text)
+    canonical = re.sub(r"^rt @\w+:\s*", "", text.lower())
+    canonical = re.sub(r"https?://\S+", " ", canonical)
+    canonical = re.sub(r"[^\w\s@#]", "", canonical)
+    canonical = re.sub(r"\s+", " ", canonical).strip()
+    return canonical or text
+
+
+def model_name_of(model):
+    """ Best-effort name of a SentenceTransformer so cached embeddings from different models never mix. """
+    card = getattr(model, "model_card_data", None)
+    name = getattr(card, "base_model", None)
+    if name:
+        return name
+    try:
+        return model[0].auto_model.config._name_or_path
+    except (TypeError, IndexError, AttributeError, KeyError):
+        return type(model).__name__
+
+
+class EncodingStats():
+    """ Running totals of what encode_unique saved: rows vs. unique texts encoded, texts cut to the
+    model's max length, and the padding of the batches as run (length-sorted) vs. in row order. """
+    def __init__(self):
+        self._lock = threading.Lock()
+        self.reset()
+
+
+    def reset(self):
+        self.texts = 0
+        self.unique_texts = 0
+        self.truncated = 0
+        self.tokens = 0
+        self.padded_tokens = 0
+        self.unsorted_padded_tokens = 0
+
+
+    def add(self, n_texts, n_unique, n_truncated=0, tokens=0, padded_tokens=0, unsorted_padded_tokens=0):
+        with self._lock:
+            self.texts += n_texts
+            self.unique_texts += n_unique
+            self.truncated += n_truncated
+            self.tokens += tokens
+            self.padded_tokens += padded_tokens
+            self.unsorted_padded_tokens += unsorted_padded_tokens
+
+
+    def report(self):
+        """ unique_ratio: share of the texts that were encoded; padding_ratio: share of the batches' token slots
+        that were padding (unsorted_padding_ratio: the same for batches in row order). """
+        return {
+            "texts": self.texts, "unique_texts": self.unique_texts, "truncated": self.truncated,
+            "unique_ratio": self.unique_texts / self.texts if self.texts else None,
+            "padding_ratio": 1 - self.tokens / self.padded_tokens if self.padded_tokens else None,
+            "unsorted_padding_ratio": 1 - self.tokens / self.unsorted_padded_tokens if self.unsorted_padded_tokens else None,
+        }
+
+
+    def log_stats(self):
+        report = self.report()
+        if report["texts"]:
+            padding = f", padding {report['padding_ratio']:.1%} (unsorted {report['unsorted_padding_ratio']:.1%})" \
+                if report["padding_ratio"] is not None else ""
+            print(f"Encoding: {report['unique_texts']}/{report['texts']} texts unique ({report['unique_ratio']:.1%}), "
+                  f"{report['truncated']} truncated{padding}")
+
+
+# Totals for this process, reported by GET /api/models
+encoding_stats = EncodingStats()
+
+
+def padded_size(lengths, batch_size):
+    """ Token slots used by running lengths in batches of batch_size, each padded to its longest text. """
+    return sum(max(lengths[start:start + batch_size]) * len(lengths[start:start + batch_size])
+               for start in range(0, len(lengths), batch_size))
+
+
+def truncate_to_model(model, texts):
+    """
+    Cuts texts to what the model's tokenizer keeps (max_seq_length tokens including special tokens)
+    and returns (texts, token lengths). Returns (texts, None) for models without a fast tokenizer,
+    e.g. a RemoteEncoder, whose encoder process truncates and sorts where the model runs.
+    """
+    tokenizer = getattr(model, "tokenizer", None)
+    max_length = getattr(model, "max_seq_length", None)
+    if tokenizer is None or not max_length or not getattr(tokenizer, "is_fast", False):
+        return texts, None
+    n_special = tokenizer.num_special_tokens_to_add()
+    encoded = tokenizer(texts, add_special_tokens=False, truncation=True, max_length=max_length - n_special,
+                        return_offsets_mapping=True)
+    truncated, lengths = [], []
+    for text, offsets in zip(texts, encoded["offset_mapping"]):
+        if len(offsets) == max_length - n_special and offsets[-1][1] < len(text.rstrip()):
+            # Everything past the last kept token would be dropped by the tokenizer anyway
+            text = text[:offsets[-1][1]]
+        truncated.append(text)
+        lengths.append(len(offsets) + n_special)
+    return truncated, lengths
+
+
+def encode_unique(model, texts, batch_size=64, show_progress_bar=False, normalize_embeddings=True, stats=encoding_stats):
+    """
+    model.encode for a list of texts, with the work cut down first: texts that are equal after
+    normalize_text (repeated headlines, identical retweets) are encoded once, texts are cut to the
+    model's max sequence length, and the unique texts are run in batches sorted by token length so
+    each batch pads to similar lengths. Returns float32 embeddings in the order of texts.
+    """
+    if not texts:
+        return np.empty((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
+    positions, unique = {}, []
+    inverse = np.empty(len(texts), dtype=np.int64)
+    for i, text in enumerate(texts):
+        key = normalize_text(text)
+        if key not in positions:
+            positions[key] = len(unique)
+            unique.append(text)
+        inverse[i] = positions[key]
+
+    truncated, lengths = truncate_to_model(model, unique)
+    if lengths is None:
+        # A wrapper with its own batching: hand it all the unique texts in one call
+        embeddings = model.encode(unique, batch_size=batch_size, convert_to_numpy=True,
+                                  normalize_embeddings=normalize_embeddings, show_progress_bar=show_progress_bar)
+        stats.add(len(texts), len(unique))
+        return np.ascontiguousarray(embeddings, dtype=np.float32)[inverse]
+
+    order = np.argsort(lengths, kind="stable")
+    sorted_texts = [truncated[i] for i in order]
+    if getattr(model, "max_batch_size", None):
+        # A BatchingEncoder cuts its calls into max_batch_size pieces in order, so one call of sorted
+        # texts gives sorted batches; a call per slice would wait out max_wait_ms on every one
+        batch_size = model.max_batch_size
+        parts = [model.encode(sorted_texts, convert_to_numpy=True, normalize_embeddings=normalize_embeddings)]
+    else:
+        starts = range(0, len(sorted_texts), batch_size)
+        if show_progress_bar:
+            from tqdm import tqdm
+            starts = tqdm(starts, desc="Batches")
+        # One call per batch, so the batches are the length-sorted ones rather than re-sorted by characters
+        parts = [model.encode(sorted_texts[start:start + batch_size], batch_size=batch_size, convert_to_numpy=True,
+                              normalize_embeddings=normalize_embeddings, show_progress_bar=False)
+                 for start in starts]
+    embeddings = np.empty((len(unique), model.get_sentence_embedding_dimension()), dtype=np.float32)
+    embeddings[order] = np.concatenate(parts)
+    stats.add(len(texts), len(unique), sum(a != b for a, b in zip(truncated, unique)), sum(lengths),
+              padded_size([lengths[i] for i in order], batch_size), padded_size(lengths, batch_size))
+    return embeddings[inverse]
+
+
+def embed_texts(model, texts, batch_size=64, show_progress_bar=False, cache=None):
+    """ Encodes texts in batches of batch_size and returns an (n, dim) float32 array of unit-length embeddings,
+    so cosine similarity between two sets of embeddings is a single matrix multiply.
+    If an EmbeddingCache is given, cached texts skip the encoder and new embeddings are added to it. """
+    texts = list(texts)
+    if not texts:
+        return np.empty((0, model.get_sentence_embedding_dimension()), dtype=np.float32)
+    if cache is None:
+        return encode_unique(model, texts, batch_size=batch_size, show_progress_bar=show_progress_bar)
+
+    model_name = model_name_of(model)
+    cached = cache.lookup(model_name, texts)
+    missing = [i for i, embedding in enumerate(cached) if embedding is None]
+    if missing:
+        new_texts = [texts[i] for i in missing]
+        new_embeddings = embed_texts(model, new_texts, batch_size=batch_size, show_progress_bar=show_progress_bar)
+        cache.store(model_name, new_texts, new_embeddings)
+        for i, embedding in zip(missing, new_embeddings):
+            cached[i] = embedding
+    return np.ascontiguousarray(np.vstack(cached), dtype=np.float32)
+
+
+def embed_narratives(model, narratives, cache=None):
+    """ Returns an (n_narratives, dim) float32 array of unit-length narrative embeddings. """
+    return embed_texts(model, narratives, cache=cache)
+
+
+def process_full_tweets(file, chunksize=50000, fmt="csv"):
+    """ Processes csv files from Junkipedia Twitter data.
+    fmt="parquet" writes tweets/full_*.parquet (see storage.write_parquet) instead of a CSV. """
+    if fmt not in ("csv", "parquet"):
+        raise ValueError(f"Error: Unsupported output format '{fmt}'. Use 'csv' or 'parquet'.")
+    out_file = "tweets/full_" + os.path.basename(file)
+    chunks = []
+    offset = 0
+    header = pd.read_csv(file, nrows=0, encoding="utf-8", encoding_errors="ignore").columns
+    # Keep every column of the export in the processed file
+    for chunk in read_media_chunks(file, chunksize=chunksize, columns=list(header)):
+        # df["Tweet"] = df["post_body_text"] +  "Embedded: " + df["EmbeddedContentText"]
+        chunk.insert(chunk.columns.get_loc("Tweet"), "embedded", "Embedded content: ")
+        chunk.index = pd.RangeIndex(offset, offset + len(chunk))
+        if fmt == "csv":
+            chunk.to_csv(out_file, mode="w" if offset == 0 else "a", header=offset == 0)
+        offset += len(chunk)
+        chunks.append(chunk)
+    df = pd.concat(chunks)
+    if fmt == "parquet":
+        from storage import write_parquet
+        write_parquet(df, os.path.splitext(out_file)[0] + ".parquet")
     return df
 
 def process_trump():
@@ -78,21 +407,55 @@ def process_trump():
     df["ChannelName"] = "Donald Trump"
     df.to_csv("tweets/tweets_01-08-2021.csv")
 
-def add_datetime_column(df):
-    # arrange tweets in chronological order based on "Time" column
-    if "Datetime" not in df.columns:
-        df["Datetime"] = pd.to_datetime(df["Date"], format="%Y-%m-%d %H:%M:%S%z")
-    df = df.sort_values(by='Datetime', ascending=True) # no .reset_index(drop=True)
+def to_naive_utc(values):
+    """ Parses datetimes to tz-naive UTC so timestamps from every dataset compare the same way. """
+    times = pd.to_datetime(values, utc=True, errors="coerce")
+    if isinstance(times, pd.Series):
+        return times.dt.tz_localize(None)
+    return times.tz_localize(None)
+
+
+def dataset_datetimes(df):
+    """ Returns the Datetime of each row as tz-naive UTC, from whichever date column the dataset has. """
+    if "Datetime" in df.columns:
+        return to_naive_utc(df["Datetime"])
+    if "Date" in df.columns:
+        return to_naive_utc(df["Date"])
+    if "published_at" in df.columns:
+        return to_naive_utc(df["published_at"])
+    raise ValueError("Error: The dataset has no 'Datetime', 'Date' or 'published_at' column.")
+
+
+def source_signature(file):
+    stat = os.stat(file)
+    return {"source_size": stat.st_size, "source_mtime": stat.st_mtime}
+
+
+def add_datetime_column(df, sort=True):
+    # Parse "Datetime" (or build it from "Date" / "published_at") so date filters compare times, not strings
+    df["Datetime"] = dataset_datetimes(df)
+    # arrange tweets in chronological order based on "Datetime" column
+    if sort:
+        df = df.sort_values(by='Datetime', ascending=True, kind="stable") # no .reset_index(drop=True)
     return df
 
 
-def separate_channels(df, output_dir="channel_datasets"):
+def clean_channel_name(channel):
+    """ Channel name made safe for use as a file or directory name. """
+    return "".join(c if c.isalnum() else "_" for c in str(channel))
+
+
+def separate_channels(df, output_dir="channel_datasets", n_workers=8, fmt="csv"):
     """
     Separates a CSV file into multiple files based on unique ChannelName values.
+    Rows are split in a single groupby pass and the per-channel files are written in parallel.
     
     Args:
         file (str): Path to the CSV file.
         output_dir (str): Directory where the separated files will be saved.
+        n_workers (int): Number of threads writing channel files concurrently.
+        fmt (str): "csv" for one CSV per channel, or "parquet" for one channel-partitioned
+            Parquet dataset (output_dir/channel=<name>/) instead of thousands of small files.
     
     Returns:
         dict: A dictionary mapping channel names to their respective file paths.
@@ -104,30 +467,27 @@ def separate_channels(df, output_dir="channel_datasets"):
     # Check if ChannelName column exists
     if "ChannelName" not in df.columns:
         raise ValueError("Error: The file does not contain a 'ChannelName' column.")
+
+    if fmt == "parquet":
+        from storage import write_channel_partitioned
+        return write_channel_partitioned(df, output_dir)
+    if fmt != "csv":
+        raise ValueError(f"Error: Unsupported output format '{fmt}'. Use 'csv' or 'parquet'.")
     
-    # Get unique channel names
-    channel_names = df["ChannelName"].unique()
-    print(f"Found {len(channel_names)} unique channels")
-    
-    # Dictionary to store file paths for each channel
-    channel_files = {}
-    
-    # Create a separate file for each channel
-    for channel in channel_names:
-        # Filter rows for current channel
-        channel_df = df[df["ChannelName"] == channel]
-        
-        # Clean channel name for filename
-        clean_channel = "".join(c if c.isalnum() else "_" for c in str(channel))
-        filename = f"{clean_channel}.csv"
-        filepath = os.path.join(output_dir, filename)
-        
-        # Save to CSV
+    # One pass over the frame instead of one boolean mask per channel
+    groups = df.groupby("ChannelName", sort=False, observed=True)
+    print(f"Found {groups.ngroups} unique channels")
+
+    def write_channel(group):
+        channel, channel_df = group
+        filepath = os.path.join(output_dir, f"{clean_channel_name(channel)}.csv")
         channel_df.to_csv(filepath, index=False)
         print(f"Saved {len(channel_df)} rows for '{channel}' to {filepath}")
-        
-        # Store filepath in dictionary
-        channel_files[channel] = filepath
+        return channel, filepath
+
+    # Writing is mostly I/O, so threads overlap it without copying the partitions to other processes
+    with ThreadPoolExecutor(max_workers=n_workers) as pool:
+        channel_files = dict(pool.map(write_channel, groups))
     
     return channel_files
 
@@ -0,0 +1,123 @@
+import json
+import os
+import re
+import shutil
+import time
+import uuid
+
+import numpy as np
+import pandas as pd
+from storage import write_parquet, read_parquet
+
+
+class ResultWriter():
+    """ Writes one stored result part by part (e.g. the chunks of a streamed trace). """
+    def __init__(self, store, handle, owner=None, text_column="Tweet", model=None):
+        self.store = store
+        self.handle = handle
+        self.path = store.path(handle) + ".tmp"
+        self.manifest = {"handle": handle, "owner": owner, "text_column": text_column, "model": model,
+                         "n_rows": 0, "parts": 0, "dim": None}
+        os.makedirs(self.path, exist_ok=True)
+
+
+    def add(self, df, embeddings):
+        if len(df) != len(embeddings):
+            raise ValueError(f"Error: {len(df)} rows but {len(embeddings)} embeddings.")
+        if len(df) == 0:
+            return
+        part = self.manifest["parts"]
+        write_parquet(df, os.path.join(self.path, f"rows-{part:05d}.parquet"), sort_by=None)
+        np.save(os.path.join(self.path, f"embeddings-{part:05d}.npy"), np.asarray(embeddings, dtype=np.float32))
+        self.manifest["parts"] += 1
+        self.manifest["n_rows"] += len(df)
+        self.manifest["dim"] = int(np.shape(embeddings)[1])
+
+
+    def close(self):
+        """ Publishes the result and returns its handle. """
+        self.manifest["created"] = time.time()
+        with open(os.path.join(self.path, "manifest.json"), "w") as f:
+            json.dump(self.manifest, f, indent=4)
+        os.replace(self.path, self.store.path(self.handle))
+        print(f"Stored {self.manifest['n_rows']} rows as result {self.handle}")
+        return self.handle
+
+
+class ResultStore():
+    """
+    Trace results kept on the server under a handle, so follow-up requests (generate-narratives)
+    can refer to them instead of posting the rows back. Each result is a directory with the
+    matched rows as Parquet and the embeddings the trace already computed for them as .npy, which
+    are memory-mapped on load. Results older than max_age_hours are deleted when new ones are made.
+    """
+    def __init__(self, directory="trace_results", max_age_hours=24):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.max_age_hours = max_age_hours
+
+
+    def path(self, handle):
+        if not re.fullmatch(r"[0-9a-f]{32}", str(handle)):
+            raise ValueError(f"Error: Invalid result handle '{handle}'.")
+        return os.path.join(self.directory, handle)
+
+
+    def writer(self, owner=None, text_column="Tweet", model=None):
+        self.purge()
+        return ResultWriter(self, uuid.uuid4().hex, owner, text_column, model)
+
+
+    def save(self, df, embeddings, owner=None, text_column="Tweet", model=None):
+        """ Stores df with the embeddings of its rows (same order) and returns the handle. """
+        writer = self.writer(owner, text_column, model)
+        writer.add(df, embeddings)
+        return writer.close()
+
+
+    def manifest(self, handle, owner=None):
+        """ The result's manifest, or None if it does not exist (or belongs to someone else). """
+        try:
+            with open(os.path.join(self.path(handle), "manifest.json")) as f:
+                manifest = json.load(f)
+        except FileNotFoundError:
+            return None
+        if owner is not None and manifest["owner"] != owner:
+            return None
+        return manifest
+
+
+    def load(self, handle, owner=None):
+        """ Returns (rows, embeddings, manifest) of a stored result. """
+        manifest = self.manifest(handle, owner)
+        if manifest is None:
+            raise KeyError(handle)
+        path = self.path(handle)
+        parts = range(manifest["parts"])
+        frames = [read_parquet(os.path.join(path, f"rows-{part:05d}.parquet")) for part in parts]
+        embeddings = [np.load(os.path.join(path, f"embeddings-{part:05d}.npy"), mmap_mode="r") for part in parts]
+        if not frames:
+            return pd.DataFrame(), np.empty((0, manifest["dim"] or 0), dtype=np.float32), manifest
+        if len(frames) == 1:
+            return frames[0], embeddings[0], manifest
+        return pd.concat(frames, ignore_index=True), np.concatenate(embeddings), manifest
+
+
+    def delete(self, handle, owner=None):
+        if self.manifest(handle, owner) is None:
+            return False
+        shutil.rmtree(self.path(handle), ignore_errors=True)
+        return True
+
+
+    def purge(self):
+        """ Deletes results older than max_age_hours (and leftovers of interrupted writes). """
+        cutoff = time.time() - self.max_age_hours * 3600
+        n_deleted = 0
+        for entry in os.listdir(self.directory):
+            path = os.path.join(self.directory, entry)
+            if os.path.isdir(path) and os.path.getmtime(path) < cutoff:
+                shutil.rmtree(path, ignore_errors=True)
+                n_deleted += 1
+        if n_deleted:
+            print(f"Deleted {n_deleted} stored results older than {self.max_age_hours} hours")
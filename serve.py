@@ -0,0 +1,158 @@
+import argparse
+import multiprocessing
+import os
+import secrets
+import shutil
+import signal
+import socket
+import tempfile
+import time
+
+from encoder_service import run_encoder, SENTENCE_MODEL, ENCODER_BACKENDS
+
+
+def encoder_main(*args):
+    # A replacement encoder is forked after serve() installs its handlers; it should just exit on SIGTERM
+    signal.signal(signal.SIGTERM, signal.SIG_DFL)
+    run_encoder(*args)
+
+
+def start_encoder(address, authkey, model_name=SENTENCE_MODEL, max_batch_size=64, max_wait_ms=5, backend="torch",
+                  onnx_file=None, timeout=300):
+    """ Starts the encoder process on a local socket and returns it once it accepts connections. """
+    if os.path.exists(address):
+        os.remove(address)
+    ready = multiprocessing.Event()
+    process = multiprocessing.Process(target=encoder_main, args=(address, authkey, model_name, ready, max_batch_size, max_wait_ms, backend, onnx_file),
+                                      name="encoder", daemon=True)
+    process.start()
+    if not ready.wait(timeout):
+        process.terminate()
+        raise RuntimeError(f"Error: Encoder did not start within {timeout}s.")
+    return process
+
+
+def run_worker(sock, threaded=True):
+    """ Runs in a forked child: imports the app and serves requests from the shared socket. """
+    from werkzeug.serving import make_server
+    from app import app
+
+    server = make_server(*sock.getsockname()[:2], app, threaded=threaded, fd=sock.fileno())
+    print(f"Worker {os.getpid()} serving")
+    server.serve_forever()
+
+
+def spawn(sock, threaded=True, run_jobs=False):
+    pid = os.fork()
+    if pid == 0:
+        signal.signal(signal.SIGTERM, signal.SIG_DFL)
+        signal.signal(signal.SIGINT, signal.SIG_DFL)
+        # Read by app.py at import: only this worker starts the job thread
+        os.environ["JOBS_WORKER"] = "1" if run_jobs else "0"
+        try:
+            run_worker(sock, threaded)
+        finally:
+            os._exit(1)
+    return pid
+
+
+def serve(host="127.0.0.1", port=5000, workers=2, shared_encoder=True, model_name=SENTENCE_MODEL, threaded=True,
+          max_batch_size=64, max_wait_ms=5, backend="torch", onnx_file=None):
+    """
+    Pre-fork server for app.py. The parent binds the port, starts one encoder process that owns
+    the sentence model, then forks the workers, which all accept connections on the shared socket
+    and send their embedding work to the encoder instead of each loading a model. The encoder pools
+    the workers' texts into batches of up to max_batch_size, waiting at most max_wait_ms. Embedding
+    indexes, stored results and the SQLite caches are files every worker memory-maps or opens, so
+    they are shared through the page cache. Workers that die are replaced.
+
+    Queued jobs (/api/jobs) are run by the first worker only, one at a time, so the LLMs they use
+    are loaded once. If that worker dies, the jobs it was running are queued again and its
+    replacement takes over.
+
+    The LLMs (polarity, narrative summaries) are still loaded per worker on first use; run the
+    pool with --profile embeddings to keep them out of it.
+    """
+    sock = socket.create_server((host, port), backlog=128)
+    sock.set_inheritable(True)
+    encoder = None
+    if shared_encoder:
+        address = os.path.join(tempfile.mkdtemp(prefix="encoder-"), "encoder.sock")
+        authkey = secrets.token_bytes(16)
+        encoder = start_encoder(address, authkey, model_name, max_batch_size, max_wait_ms, backend, onnx_file)
+        os.environ["ENCODER_ADDRESS"] = address
+        os.environ["ENCODER_AUTHKEY"] = authkey.hex()
+
+    # Interrupted jobs are requeued once, here, rather than by every worker as it starts
+    from jobs import JobQueue
+    jobs = JobQueue(os.getenv("JOBS_PATH", "jobs/jobs.sqlite"), recover=True)
+    os.environ["JOBS_RECOVER"] = "0"
+
+    job_worker = spawn(sock, threaded, run_jobs=True)
+    children = {job_worker} | {spawn(sock, threaded) for _ in range(workers - 1)}
+    print(f"Serving on http://{host}:{port} with {workers} workers (jobs run by {job_worker})"
+          + (f" sharing encoder {encoder.pid}" if encoder else ""))
+
+    stopping = False
+
+    def stop(signum, frame):
+        nonlocal stopping
+        stopping = True
+        for pid in children:
+            try:
+                os.kill(pid, signal.SIGTERM)
+            except ProcessLookupError:
+                pass
+
+    signal.signal(signal.SIGTERM, stop)
+    signal.signal(signal.SIGINT, stop)
+    while children:
+        try:
+            pid, status = os.wait()
+        except ChildProcessError:
+            break
+        if encoder is not None and pid == encoder.pid and not stopping:
+            # Workers reconnect to the same address on their next encode
+            print(f"Encoder {pid} exited with status {status}, starting a new one")
+            encoder = start_encoder(address, authkey, model_name, max_batch_size, max_wait_ms, backend, onnx_file)
+            continue
+        if pid not in children:
+            continue
+        children.discard(pid)
+        if not stopping:
+            print(f"Worker {pid} exited with status {status}, starting a new one")
+            # Its running job would otherwise stay 'running' forever
+            jobs.recover(pid)
+            time.sleep(1)
+            if pid == job_worker:
+                job_worker = spawn(sock, threaded, run_jobs=True)
+                children.add(job_worker)
+            else:
+                children.add(spawn(sock, threaded))
+    if encoder is not None:
+        encoder.terminate()
+        encoder.join()
+        shutil.rmtree(os.path.dirname(address), ignore_errors=True)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Serve app.py from a pool of pre-forked worker processes.")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 2)
+    parser.add_argument("--model", default=SENTENCE_MODEL, help="Sentence encoder the encoder process loads")
+    parser.add_argument("--backend", choices=ENCODER_BACKENDS, default=os.getenv("ENCODER_BACKEND", "torch"),
+                        help="Encoder backend: fp32 torch, dynamically quantized int8, or ONNX Runtime")
+    parser.add_argument("--onnx-file", default=os.getenv("ENCODER_ONNX_FILE"),
+                        help="ONNX export to load with --backend onnx, e.g. onnx/model_qint8_avx512_vnni.onnx")
+    parser.add_argument("--max-batch-size", type=int, default=int(os.getenv("ENCODER_MAX_BATCH", "64")),
+                        help="Most texts the encoder runs in one batch")
+    parser.add_argument("--max-wait-ms", type=float, default=float(os.getenv("ENCODER_MAX_WAIT_MS", "5")),
+                        help="Longest a text waits for its batch to fill")
+    parser.add_argument("--no-shared-encoder", action="store_true", help="Each worker loads its own encoder")
+    parser.add_argument("--profile", choices=["full", "embeddings"], default=None, help="Sets APP_PROFILE for the workers")
+    args = parser.parse_args()
+    if args.profile:
+        os.environ["APP_PROFILE"] = args.profile
+    serve(args.host, args.port, args.workers, shared_encoder=not args.no_shared_encoder, model_name=args.model,
+          max_batch_size=args.max_batch_size, max_wait_ms=args.max_wait_ms, backend=args.backend, onnx_file=args.onnx_file)
@@ -4,10 +4,14 @@ from sentence_transformers import util
 from preprocess import *
 from tqdm import tqdm
 import gc
+import time
 
 class Results():
-    def __init__(self, model, tweet_df, n_tweets, narratives):
+    def __init__(self, model, tweet_df, n_tweets, narratives, batch_size=64, cache=None, text_column="Tweet"):
         self.model = model
+        self.text_column = text_column
+        self.batch_size = batch_size
+        self.cache = cache
         self.df = tweet_df
         if n_tweets > len(self.df):
             n_tweets = len(self.df)
@@ -22,16 +26,23 @@ class Results():
 
 
     def get_results(self):
+        """ Encodes the tweets in batches of self.batch_size and scores them against every narrative
+        with one (n_tweets, dim) x (dim, n_narratives) matrix multiply. """
         gc.collect()
-        nar_embeds = embed_narratives(self.model, self.narratives)
-        for i, tweet in tqdm(enumerate(self.df["Tweet"][:self.n_tweets])):
-            embedding = self.model.encode(tweet, convert_to_tensor=True)
-            tweet_sims = np.empty(len(nar_embeds))
-            for j, nar_embed in enumerate(nar_embeds):
-                sim = util.pytorch_cos_sim(embedding, nar_embed)
-                tweet_sims[j] = sim
-            self.similarities[i] = tweet_sims
-            self.tweets.loc[i] = {"Tweet" : tweet, "Sim_Index" : i}
+        start = time.perf_counter()
+        nar_embeds = embed_narratives(self.model, self.narratives, cache=self.cache)
+        tweets = self.df[self.text_column][:self.n_tweets].tolist()
+        tweet_embeds = embed_texts(self.model, tweets, batch_size=self.batch_size, show_progress_bar=True,
+                                   cache=self.cache)
+        # Embeddings are unit length so the dot product is the cosine similarity
+        self.similarities[:] = tweet_embeds @ nar_embeds.T
+        # Kept so callers can reuse them (e.g. stored with a trace result for clustering)
+        self.tweet_embeds = tweet_embeds
+        self.tweets = pd.DataFrame({"Tweet": tweets, "Sim_Index": np.arange(len(tweets))})
+        elapsed = time.perf_counter() - start
+        self.tweets_per_sec = len(tweets) / elapsed if elapsed > 0 else float("inf")
+        print("Scored {n} tweets against {k} narratives in {t:.2f}s ({rate:.1f} tweets/sec)".format(
+            n=len(tweets), k=len(self.narratives), t=elapsed, rate=self.tweets_per_sec))
         gc.collect()
 
 
@@ -0,0 +1,208 @@
+import argparse
+import json
+import os
+import shutil
+
+import numpy as np
+import pandas as pd
+import pyarrow as pa
+import pyarrow.dataset as ds
+import pyarrow.parquet as pq
+from preprocess import read_media, add_datetime_column, to_naive_utc, source_signature, clean_channel_name
+
+
+PARQUET_DIR = "tweets_parquet"
+
+
+def arrow_safe(df):
+    """ Stringifies object columns that mix types (e.g. ids parsed as both ints and strings),
+    which Arrow cannot store in a single column. Nulls are kept. """
+    df = df.copy()
+    for column in df.columns[df.dtypes == object]:
+        if pd.api.types.infer_dtype(df[column], skipna=True) not in ("string", "empty", "bytes"):
+            df[column] = df[column].map(lambda v: v if v is None or (isinstance(v, float) and np.isnan(v)) else str(v))
+    return df
+
+
+def write_parquet(df, path, row_group_size=50000, sort_by="Datetime"):
+    """
+    Writes df as one zstd-compressed Parquet file. Rows are sorted by sort_by (when present) so
+    each row group covers a narrow Datetime range and its min/max statistics let readers skip it.
+    Sorting by Datetime first parses it to tz-naive UTC, as the partitioned writers do, so
+    read_parquet's date filters compare timestamps rather than CSV strings.
+    """
+    if sort_by == "Datetime" and {"Datetime", "Date", "published_at"} & set(df.columns):
+        df = add_datetime_column(df.copy(), sort=True)
+    elif sort_by in df.columns:
+        df = df.sort_values(by=sort_by, kind="stable")
+    table = pa.Table.from_pandas(arrow_safe(df), preserve_index=False)
+    directory = os.path.dirname(path)
+    if directory:
+        os.makedirs(directory, exist_ok=True)
+    pq.write_table(table, path, compression="zstd", row_group_size=row_group_size)
+    return path
+
+
+def read_parquet(path, columns=None, start=None, end=None):
+    """
+    Reads a Parquet file through a memory map, only the given columns, and only the row groups
+    whose Datetime statistics overlap [start, end].
+    """
+    filters = []
+    if start is not None or end is not None:
+        datetime_type = pq.read_schema(path, memory_map=True).field("Datetime").type
+        if start is not None:
+            filters.append(("Datetime", ">=", pa.scalar(to_naive_utc([start])[0].to_pydatetime(), type=datetime_type)))
+        if end is not None:
+            filters.append(("Datetime", "<=", pa.scalar(to_naive_utc([end])[0].to_pydatetime(), type=datetime_type)))
+    table = pq.read_table(path, columns=columns, filters=filters or None, memory_map=True)
+    return table.to_pandas()
+
+
+def partitioned_path(file, tweets_dir="tweets", parquet_dir=PARQUET_DIR):
+    """ Directory of the day-partitioned copy of a dataset, mirroring its path relative to tweets_dir. """
+    relpath = os.path.relpath(file, tweets_dir)
+    return os.path.join(parquet_dir, os.path.splitext(relpath)[0])
+
+
+def write_day_partitioned(df, out_dir, source=None):
+    """
+    Writes df as a Parquet dataset partitioned by day (out_dir/day=YYYY-MM-DD/*.parquet), zstd
+    compressed. Readers can then skip every day outside a requested date range without opening it.
+    """
+    df = add_datetime_column(df.copy(), sort=True)
+    df["day"] = df["Datetime"].dt.strftime("%Y-%m-%d").fillna("unknown")
+    if "AuthorTweet" in df.columns:
+        # Rebuilt by read_media for just the rows that are read
+        df = df.drop(columns=["AuthorTweet"])
+    table = pa.Table.from_pandas(arrow_safe(df), preserve_index=False)
+
+    tmp_dir = out_dir + ".tmp"
+    shutil.rmtree(tmp_dir, ignore_errors=True)
+    pq.write_to_dataset(table, tmp_dir, partition_cols=["day"], compression="zstd")
+    manifest = {"source": source, **(source_signature(source) if source else {}), "n_rows": len(df)}
+    with open(os.path.join(tmp_dir, "_manifest.json"), "w") as f:
+        json.dump(manifest, f, indent=4)
+    shutil.rmtree(out_dir, ignore_errors=True)
+    os.replace(tmp_dir, out_dir)
+    print(f"Wrote {len(df)} rows over {df['day'].nunique()} days to {out_dir}")
+    return out_dir
+
+
+def write_channel_partitioned(df, out_dir):
+    """
+    Writes df as one zstd Parquet dataset partitioned by channel (out_dir/channel=<name>/*.parquet)
+    in a single multi-threaded pass, and returns the same channel -> path mapping as
+    preprocess.separate_channels. ChannelName stays in the data, so a channel directory can be
+    read on its own with read_media.
+    """
+    df = df[df["ChannelName"].notna()].copy()
+    df["channel"] = df["ChannelName"].astype(object).map(clean_channel_name)
+    channels = df.drop_duplicates("ChannelName")[["ChannelName", "channel"]]
+    # Contiguous channels let the writer finish each partition file in one go instead of
+    # keeping thousands of files open and flushing tiny row groups
+    df = df.sort_values(by="channel", kind="stable")
+    table = pa.Table.from_pandas(arrow_safe(df), preserve_index=False)
+    print(f"Found {len(channels)} unique channels")
+    ds.write_dataset(
+        table, out_dir, format="parquet",
+        partitioning=ds.partitioning(pa.schema([("channel", pa.string())]), flavor="hive"),
+        file_options=ds.ParquetFileFormat().make_write_options(compression="zstd"),
+        max_partitions=len(channels) + 1, max_open_files=len(channels) + 1,
+        existing_data_behavior="delete_matching", use_threads=True,
+    )
+    channel_files = {row.ChannelName: os.path.join(out_dir, f"channel={row.channel}")
+                     for row in channels.itertuples(index=False)}
+    print(f"Saved {len(df)} rows for {len(channel_files)} channels to {out_dir}")
+    return channel_files
+
+
+def is_fresh(out_dir, source):
+    """ Whether the partitioned dataset in out_dir was written from the current version of source. """
+    manifest_file = os.path.join(out_dir, "_manifest.json")
+    if not os.path.exists(manifest_file) or not os.path.exists(source):
+        return False
+    with open(manifest_file) as f:
+        manifest = json.load(f)
+    signature = source_signature(source)
+    return manifest.get("source_size") == signature["source_size"] and manifest.get("source_mtime") == signature["source_mtime"]
+
+
+def day_files(path, start_day=None, end_day=None):
+    """ Parquet files of the day partitions between start_day and end_day (YYYY-MM-DD, inclusive). """
+    files = []
+    for partition in sorted(os.listdir(path)):
+        if not partition.startswith("day="):
+            continue
+        day = partition[len("day="):]
+        if (start_day is not None or end_day is not None) and day == "unknown":
+            continue
+        if (start_day is not None and day < start_day) or (end_day is not None and day > end_day):
+            continue
+        partition_dir = os.path.join(path, partition)
+        files.extend(os.path.join(partition_dir, f) for f in sorted(os.listdir(partition_dir)) if f.endswith(".parquet"))
+    return files
+
+
+def read_date_range(path, start=None, end=None, columns=None):
+    """
+    Reads the rows with start <= Datetime <= end from a day-partitioned dataset (or a plain
+    directory of Parquet files). Day directories
+    outside the range are never opened, and the Datetime predicate is pushed down to the
+    Parquet row groups of the days that are, so only the requested range is read from disk.
+    """
+    start = to_naive_utc([start])[0] if start is not None else None
+    end = to_naive_utc([end])[0] if end is not None else None
+    if any(entry.startswith("day=") for entry in os.listdir(path)):
+        files = day_files(path, start.strftime("%Y-%m-%d") if start is not None else None,
+                          end.strftime("%Y-%m-%d") if end is not None else None)
+    else:
+        # A flat directory of Parquet files, e.g. one channel of write_channel_partitioned
+        files = [os.path.join(path, f) for f in sorted(os.listdir(path)) if f.endswith(".parquet")]
+    if not files:
+        # Nothing in range: an empty frame with the dataset's columns
+        all_files = day_files(path) or [os.path.join(path, f) for f in os.listdir(path) if f.endswith(".parquet")]
+        schema = pq.read_schema(all_files[0]) if all_files else pa.schema([])
+        return schema.empty_table().to_pandas()
+
+    dataset = ds.dataset(files, format="parquet")
+    datetime_type = dataset.schema.field("Datetime").type
+    expression = None
+    if start is not None:
+        expression = ds.field("Datetime") >= pa.scalar(start.to_pydatetime(), type=datetime_type)
+    if end is not None:
+        end_expression = ds.field("Datetime") <= pa.scalar(end.to_pydatetime(), type=datetime_type)
+        expression = end_expression if expression is None else expression & end_expression
+    if columns is not None and "Datetime" not in columns:
+        columns = list(columns) + ["Datetime"]
+    df = dataset.to_table(columns=columns, filter=expression).to_pandas()
+    return df.sort_values(by="Datetime", kind="stable").reset_index(drop=True)
+
+
+def partition_datasets(tweets_dir="tweets", parquet_dir=PARQUET_DIR, rebuild=False):
+    """ Writes a day-partitioned copy of every CSV under tweets_dir that does not have an up-to-date one. """
+    paths = {}
+    for root, _, filenames in os.walk(tweets_dir):
+        for filename in sorted(filenames):
+            if not filename.endswith(".csv"):
+                continue
+            file = os.path.join(root, filename)
+            out_dir = partitioned_path(file, tweets_dir, parquet_dir)
+            if not rebuild and is_fresh(out_dir, file):
+                print(f"Partitioned copy of {file} is up to date")
+                paths[file] = out_dir
+                continue
+            try:
+                paths[file] = write_day_partitioned(read_media(file), out_dir, source=file)
+            except (ValueError, KeyError) as e:
+                print(f"Skipping {file}: {e}")
+    return paths
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Write day-partitioned Parquet copies of the datasets under tweets/.")
+    parser.add_argument("--tweets-dir", default="tweets")
+    parser.add_argument("--parquet-dir", default=PARQUET_DIR)
+    parser.add_argument("--rebuild", action="store_true", help="Rewrite every dataset, not just new or stale ones")
+    args = parser.parse_args()
+    partition_datasets(args.tweets_dir, args.parquet_dir, rebuild=args.rebuild)
@@ -0,0 +1,66 @@
+import hashlib
+import re
+from types import SimpleNamespace
+
+import numpy as np
+
+
+class FakeTokenizer():
+    """ A fast tokenizer with one token per whitespace-separated word and two special tokens. """
+    is_fast = True
+
+    def num_special_tokens_to_add(self):
+        return 2
+
+
+    def __call__(self, texts, add_special_tokens=False, truncation=True, max_length=None, return_offsets_mapping=True):
+        offsets = [[match.span() for match in re.finditer(r"\S+", text)][:max_length] for text in texts]
+        return {"offset_mapping": offsets}
+
+
+class FakeEncoder():
+    """ Stands in for a SentenceTransformer: a fixed pseudo-random unit vector per text, no model download.
+    With max_seq_length it also has a FakeTokenizer, so encode_unique truncates and length-sorts for it. """
+    def __init__(self, dim=8, name="fake-encoder", max_seq_length=None):
+        self.dim = dim
+        self.model_card_data = SimpleNamespace(base_model=name)
+        self.calls = []
+        if max_seq_length:
+            self.max_seq_length = max_seq_length
+            self.tokenizer = FakeTokenizer()
+
+
+    def get_sentence_embedding_dimension(self):
+        return self.dim
+
+
+    def embed(self, text):
+        seed = int(hashlib.md5(str(text).encode("utf-8")).hexdigest()[:8], 16)
+        vector = np.random.default_rng(seed).normal(size=self.dim).astype(np.float32)
+        return vector / np.linalg.norm(vector)
+
+
+    def encode(self, texts, batch_size=64, convert_to_numpy=True, normalize_embeddings=False,
+               show_progress_bar=False, **kwargs):
+        single = isinstance(texts, str)
+        texts = [texts] if single else list(texts)
+        self.calls.append(texts)
+        embeddings = np.stack([self.embed(text) for text in texts]) if texts else np.empty((0, self.dim), dtype=np.float32)
+        return embeddings[0] if single else embeddings
+
+
+class FakePrompt():
+    """ The one method of a PromptTemplate that Narrative_Generator calls. """
+    def format(self, query):
+        return "Summarize these tweets:\n" + query
+
+
+class FakeChain():
+    """ Returns one narrative per call, numbered, and keeps the queries it was given. """
+    def __init__(self):
+        self.queries = []
+
+
+    def invoke(self, inputs):
+        self.queries.append(inputs["query"])
+        return [{"narrative_1": f"narrative {len(self.queries)}"}]
@@ -0,0 +1,23 @@
+import numpy as np
+
+from ann_index import IVFIndex, search
+
+
+def unit_rows(n, dim=8, seed=0):
+    rows = np.random.default_rng(seed).normal(size=(n, dim)).astype(np.float32)
+    return rows / np.linalg.norm(rows, axis=1, keepdims=True)
+
+
+def test_build_skips_empty_matrix():
+    assert IVFIndex.build(np.empty((0, 8), dtype=np.float32)) is None
+
+
+def test_exhaustive_probe_matches_brute_force():
+    embeddings = unit_rows(200)
+    query = embeddings[7]
+    ivf = IVFIndex.build(embeddings, n_lists=10)
+    positions, sims = search(embeddings, ivf, query, n_probe=ivf.n_lists, threshold=0.2, lo=20, hi=150)
+    brute = embeddings[20:150] @ query
+    expected = 20 + np.nonzero(brute >= 0.2)[0]
+    np.testing.assert_array_equal(positions, expected)
+    np.testing.assert_allclose(sims, brute[expected - 20], rtol=1e-6)
@@ -0,0 +1,41 @@
+import numpy as np
+import pytest
+
+from embedding_cache import EmbeddingCache
+from fakes import FakeEncoder
+from preprocess import embed_texts
+
+
+def test_embed_texts_only_encodes_uncached_texts(tmp_path):
+    cache, model = EmbeddingCache(str(tmp_path / "embeddings.sqlite")), FakeEncoder()
+    first = embed_texts(model, ["a", "b"], cache=cache)
+    second = embed_texts(model, ["b", "c", "a "], cache=cache)
+    assert model.calls == [["a", "b"], ["c"]]
+    np.testing.assert_array_equal(second, np.stack([first[1], model.embed("c"), first[0]]))
+    assert (cache.hits, cache.misses) == (2, 3)
+
+
+def test_models_do_not_share_entries(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "embeddings.sqlite"))
+    embed_texts(FakeEncoder(name="one"), ["a"], cache=cache)
+    other = FakeEncoder(name="two")
+    embed_texts(other, ["a"], cache=cache)
+    assert other.calls == [["a"]]
+
+
+def test_float16_entries_and_eviction(tmp_path):
+    cache = EmbeddingCache(str(tmp_path / "embeddings.sqlite"), max_bytes=2 * 8 * 2, dtype="float16")
+    vectors = FakeEncoder().encode(["a", "b", "c"])
+    cache.store("m", ["a", "b"], vectors[:2])
+    cache.lookup("m", ["a"])
+    cache.store("m", ["c"], vectors[2:])
+    a, b, c = cache.lookup("m", ["a", "b", "c"])
+    assert b is None
+    assert a.dtype == np.float32
+    np.testing.assert_allclose(a, vectors[0], atol=1e-3)
+    assert cache.stats()["evictions"] == 1
+
+
+def test_rejects_unknown_dtype(tmp_path):
+    with pytest.raises(ValueError):
+        EmbeddingCache(str(tmp_path / "embeddings.sqlite"), dtype="int8")
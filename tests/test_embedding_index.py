@@ -0,0 +1,53 @@
+import numpy as np
+import pandas as pd
+import pytest
+
+from fakes import FakeEncoder
+from embedding_index import DatasetIndex, build_index
+from graph_sims import trace_over_time
+from preprocess import read_media
+
+TIMEFRAME = ["2024-01-02", "2024-01-05"]
+
+
+def write_dataset(tmp_path, order):
+    days = ["2024-01-01", "2024-01-02", "2024-01-02", "2024-01-03", "2024-01-04", "2024-01-04", "2024-01-06"]
+    df = pd.DataFrame({"Tweet": [f"tweet number {i}" for i in range(len(days))],
+                       "Datetime": [f"{day} 12:00:00" for day in days],
+                       "ChannelName": ["CNN"] * len(days)})
+    if order == "descending":
+        df = df.iloc[::-1]
+    elif order == "shuffled":
+        df = df.sample(frac=1, random_state=1)
+    file = tmp_path / f"{order}.csv"
+    df.to_csv(file, index=False)
+    return str(file)
+
+
+@pytest.mark.parametrize("order,file_order", [("ascending", "ascending"), ("descending", "descending"), ("shuffled", None)])
+def test_trace_matches_trace_over_time(tmp_path, order, file_order):
+    file = write_dataset(tmp_path, order)
+    model = FakeEncoder()
+    index = build_index(file, model, str(tmp_path / "index"))
+    assert index.manifest.get("file_order") == file_order
+
+    expected, expected_embeddings = trace_over_time(read_media(file), model, "a narrative", TIMEFRAME,
+                                                    sim_threshold=-1.0, return_embeddings=True)
+    traced, embeddings = DatasetIndex(str(tmp_path / "index")).trace(model, "a narrative", TIMEFRAME,
+                                                                     sim_threshold=-1.0, return_embeddings=True)
+    assert len(traced) == 5
+    assert traced["Tweet"].tolist() == expected["Tweet"].tolist()
+    assert traced["index"].tolist() == expected["index"].tolist()
+    np.testing.assert_allclose(traced["Similarity"], expected["Similarity"], rtol=1e-6)
+    np.testing.assert_allclose(embeddings, expected_embeddings, rtol=1e-6)
+
+
+def test_trace_chunks_agrees_with_trace(tmp_path):
+    file = write_dataset(tmp_path, "shuffled")
+    model = FakeEncoder()
+    index = build_index(file, model, str(tmp_path / "index"))
+    traced = index.trace(model, "a narrative", TIMEFRAME, sim_threshold=0.0)
+    chunks = pd.concat(list(index.trace_chunks(model, "a narrative", TIMEFRAME, sim_threshold=0.0, chunksize=2)),
+                       ignore_index=True)
+    assert chunks["Tweet"].tolist() == traced["Tweet"].tolist()
+    assert chunks["index"].tolist() == traced["index"].tolist()
@@ -0,0 +1,32 @@
+import numpy as np
+
+from fakes import FakeEncoder
+from preprocess import EncodingStats, encode_unique
+
+
+def test_duplicates_are_encoded_once_and_returned_in_order():
+    model, stats = FakeEncoder(), EncodingStats()
+    texts = ["Same  tweet", "other tweet", "Same tweet ", "other tweet", "third"]
+    embeddings = encode_unique(model, texts, stats=stats)
+    assert model.calls == [["Same  tweet", "other tweet", "third"]]
+    np.testing.assert_array_equal(embeddings, np.stack([model.embed(text) for text in
+                                                        ["Same  tweet", "other tweet", "Same  tweet", "other tweet", "third"]]))
+    assert stats.report()["unique_texts"] == 3
+    assert stats.report()["texts"] == 5
+
+
+def test_batches_are_length_sorted_and_truncated():
+    model, stats = FakeEncoder(max_seq_length=6), EncodingStats()
+    texts = ["a b c d e f g", "a", "a b c", "a b", "a b c d"]
+    embeddings = encode_unique(model, texts, batch_size=2, stats=stats)
+    # Four words fit next to the two special tokens
+    assert model.calls == [["a", "a b"], ["a b c", "a b c d"], ["a b c d"]]
+    np.testing.assert_array_equal(embeddings, np.stack([model.embed(text) for text in
+                                                        ["a b c d", "a", "a b c", "a b", "a b c d"]]))
+    assert stats.report()["truncated"] == 1
+    assert stats.padded_tokens < stats.unsorted_padded_tokens
+
+
+def test_no_texts():
+    embeddings = encode_unique(FakeEncoder(dim=4), [], stats=EncodingStats())
+    assert embeddings.shape == (0, 4)
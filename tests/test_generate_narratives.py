@@ -0,0 +1,75 @@
+import pandas as pd
+import pytest
+
+pytest.importorskip("langchain_core")
+from generate_narratives import Narrative_Generator
+from fakes import FakeEncoder, FakePrompt, FakeChain
+
+
+def make_generator(df, num_narratives=3, **kwargs):
+    generator = Narrative_Generator(None, None, FakeEncoder(), df, num_narratives, **kwargs)
+    chain = FakeChain()
+    generator.make_chain = lambda: (FakePrompt(), chain)
+    return generator, chain
+
+
+def tweets_on(day, n):
+    return pd.DataFrame({"Tweet": [f"{day} tweet {i}" for i in range(n)], "Datetime": [day] * n})
+
+
+def test_hierarchical_windows_smaller_than_num_narratives(tmp_path):
+    df = pd.concat([tweets_on("2024-01-01", 8), tweets_on("2024-01-02", 2), tweets_on("2024-01-03", 1)],
+                   ignore_index=True)
+    generator, chain = make_generator(df, num_narratives=5)
+    merged, batches = generator.generate_hierarchical_narratives(window="D", checkpoint_dir=str(tmp_path))
+    assert [batch["batch"] for batch in batches] == ["2024-01-01", "2024-01-02", "2024-01-03"]
+    # Five clusters for the full day, one each for the one- and two-tweet days
+    assert [len(batch["narratives"]) for batch in batches] == [5, 1, 1]
+    assert merged
+
+
+def test_kmeans_labels_caps_clusters_at_tweet_count():
+    generator, _ = make_generator(tweets_on("2024-01-01", 4), num_narratives=10)
+    clusters = generator.cluster_embedded_tweets(generator.df["Tweet"])
+    assert len(clusters) == 4
+
+
+def test_minibatch_falls_back_when_no_chunk_is_big_enough():
+    generator, _ = make_generator(tweets_on("2024-01-01", 6), num_narratives=4, cluster_method="minibatch", chunk_size=3)
+    clusters = generator.cluster_embedded_tweets(generator.df["Tweet"])
+    assert len(clusters) == 4
+    assert sum(len(cluster) for cluster in clusters) == 6
+
+
+def test_cluster_stats_count_sampled_tweets():
+    df = pd.DataFrame({"Tweet": ["first line\nsecond line", "another tweet", "a third\n\ntweet"],
+                       "Datetime": ["2024-01-01"] * 3})
+    generator, chain = make_generator(df, num_narratives=1)
+    prompt, _ = generator.make_chain()
+    generator.summarize_clusters(df["Tweet"], prompt, chain)
+    assert [stats["n_samples"] for stats in generator.cluster_stats] == [3]
+    assert chain.queries[0].count("- ") == 3
+
+
+def narrative(text, support, batch):
+    return {"narrative": text, "support": support, "batch": batch}
+
+
+def test_merge_narratives_folds_duplicates_and_keeps_distinct_ones():
+    generator, _ = make_generator(tweets_on("2024-01-01", 2), num_narratives=3)
+    merged = generator.merge_narratives([narrative("Vaccines are unsafe", 4, "2024-01-01"),
+                                         narrative("The election was stolen", 2, "2024-01-01"),
+                                         narrative("Vaccines are unsafe", 3, "2024-01-02")])
+    assert [(n["narrative"], n["support"], n["variants"]) for n in merged] == [
+        ("Vaccines are unsafe", 7, 2), ("The election was stolen", 2, 1)]
+    assert merged[0]["batches"] == ["2024-01-01", "2024-01-02"]
+
+
+def test_merge_narratives_stops_at_num_narratives():
+    generator, _ = make_generator(tweets_on("2024-01-01", 2), num_narratives=2)
+    narratives = [narrative(f"narrative {i}", i + 1, "2024-01-01") for i in range(5)]
+    merged = generator.merge_narratives(narratives)
+    assert len(merged) == 2
+    assert sum(n["support"] for n in merged) == 15
+    assert sum(n["variants"] for n in merged) == 5
+    assert generator.merge_narratives([]) == []
@@ -0,0 +1,15 @@
+import pandas as pd
+
+from fakes import FakeEncoder
+from graph_sims import trace_over_time
+
+
+def test_trace_leaves_caller_frame_untouched():
+    df = pd.DataFrame({
+        "Tweet": ["first tweet", "second tweet", "third tweet"],
+        "Datetime": ["2020-11-02 10:00:00", "2020-11-03 10:00:00", "2020-12-05 10:00:00"],
+    })
+    before = df.copy()
+    filtered = trace_over_time(df, FakeEncoder(), "a narrative", ["2020-11-01", "2020-12-01"], sim_threshold=-1.0)
+    assert len(filtered) == 2
+    pd.testing.assert_frame_equal(df, before)
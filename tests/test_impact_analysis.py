@@ -0,0 +1,49 @@
+import pandas as pd
+import pytest
+
+pytest.importorskip("langchain_core")
+from impact_analysis import LABELS, PolarityTester
+from polarity_cache import PolarityCache
+from polarity_engine import make_polarity_engine
+
+
+def rule(tweet):
+    return "support" if "stolen" in tweet else "opposition" if "fair" in tweet else "neutral"
+
+
+def make_tester(tweets, mode="json", cache=None):
+    engine = make_polarity_engine("stub", rule=rule)
+    df = pd.DataFrame({"Tweet": tweets})
+    return PolarityTester(None, None, df, "The election was stolen", engine=engine, mode=mode, cache=cache), engine
+
+
+TWEETS = ["It was stolen!", "RT @someone: It was stolen!", "The vote was fair", "Nice weather today", "It was stolen!"]
+
+
+@pytest.mark.parametrize("mode", ["json", "labels"])
+def test_stub_engine_labels_every_row(mode):
+    tester, _ = make_tester(TWEETS, mode=mode)
+    tester.check_polarity()
+    assert tester.df["polarity"].tolist() == ["support", "support", "opposition", "neutral", "support"]
+    # Retweets and repeats share a canonical form and are classified once
+    assert tester.stats["unique_tweets"] == 3
+    assert tester.stats["inferred"] == 3
+    if mode == "labels":
+        assert [column for column in tester.df.columns if column.startswith("polarity_prob_")] == \
+            [f"polarity_prob_{label}" for label in LABELS]
+
+
+def test_cached_results_skip_the_engine(tmp_path):
+    cache = PolarityCache(str(tmp_path / "polarity.sqlite"))
+    first, _ = make_tester(TWEETS, mode="labels", cache=cache)
+    first.check_polarity()
+    second, _ = make_tester(TWEETS + ["Another sunny day"], mode="labels", cache=cache)
+    second.check_polarity()
+    assert second.stats["cache_hits"] == 3
+    assert second.stats["inferred"] == 1
+    assert second.df["polarity_source"].tolist() == ["cache"] * 5 + ["llm"]
+    assert second.df["polarity"].tolist()[-1] == "neutral"
+    # A json-mode run uses a different prompt version, so it does not reuse label-mode results
+    json_tester, _ = make_tester(TWEETS, mode="json", cache=cache)
+    json_tester.check_polarity()
+    assert json_tester.stats["cache_hits"] == 0
@@ -0,0 +1,111 @@
+import json
+import os
+import threading
+import time
+
+import pytest
+
+from jobs import JobQueue
+
+
+def make_queue(tmp_path, **kwargs):
+    return JobQueue(str(tmp_path / "jobs.sqlite"), **kwargs)
+
+
+def wait_for(queue, job_id, statuses=("done", "failed", "cancelled"), timeout=5):
+    deadline = time.monotonic() + timeout
+    while time.monotonic() < deadline:
+        job = queue.get(job_id)
+        if job["status"] in statuses:
+            return job
+        time.sleep(0.02)
+    raise AssertionError(f"Job {job_id} is still {queue.get(job_id)['status']}")
+
+
+def test_jobs_run_in_order_and_store_results(tmp_path):
+    queue = make_queue(tmp_path)
+    queue.register("double", lambda params, progress, owner: {"value": params["value"] * 2, "owner": owner})
+    first = queue.submit("double", {"value": 1}, owner="u1")
+    second = queue.submit("double", {"value": 2}, owner="u1")
+    assert queue.get(second)["queuePosition"] == 1
+    queue.start()
+    assert wait_for(queue, second)["status"] == "done"
+    assert json.loads(queue.result(first)) == {"value": 2, "owner": "u1"}
+    assert json.loads(queue.result(second)) == {"value": 4, "owner": "u1"}
+
+
+def test_unknown_kind_and_other_owner(tmp_path):
+    queue = make_queue(tmp_path)
+    queue.register("noop", lambda params, progress, owner: None)
+    with pytest.raises(ValueError):
+        queue.submit("missing", {})
+    job_id = queue.submit("noop", {}, owner="u1")
+    assert queue.get(job_id, owner="u2") is None
+    assert not queue.cancel(job_id, owner="u2")
+    assert [job["id"] for job in queue.list(owner="u1")] == [job_id]
+    assert queue.list(owner="u2") == []
+
+
+def test_cancel_queued_job_never_runs(tmp_path):
+    queue = make_queue(tmp_path)
+    ran = []
+    queue.register("noop", lambda params, progress, owner: ran.append(params))
+    job_id = queue.submit("noop", {})
+    assert queue.cancel(job_id)
+    assert not queue.cancel(job_id)
+    queue.start()
+    time.sleep(0.2)
+    assert ran == []
+    assert queue.get(job_id)["status"] == "cancelled"
+
+
+def test_cancel_running_job_stops_at_next_progress_update(tmp_path):
+    queue = make_queue(tmp_path)
+    started, steps = threading.Event(), []
+
+    def handler(params, progress, owner):
+        for step in progress.tqdm(range(1000)):
+            started.set()
+            steps.append(step)
+            time.sleep(0.01)
+
+    queue.register("slow", handler)
+    job_id = queue.submit("slow", {})
+    queue.start()
+    assert started.wait(5)
+    assert queue.cancel(job_id)
+    assert wait_for(queue, job_id)["status"] == "cancelled"
+    assert len(steps) < 1000
+    assert queue.result(job_id) is None
+
+
+def test_failed_job_records_error(tmp_path):
+    queue = make_queue(tmp_path)
+
+    def handler(params, progress, owner):
+        raise ValueError("Error: bad params")
+
+    queue.register("broken", handler)
+    job_id = queue.submit("broken", {})
+    queue.start()
+    job = wait_for(queue, job_id)
+    assert job["status"] == "failed"
+    assert job["error"] == "Error: bad params"
+
+
+def test_recover_requeues_only_the_dead_workers_jobs(tmp_path):
+    queue = make_queue(tmp_path)
+    queue.register("noop", lambda params, progress, owner: None)
+    mine, theirs = queue.submit("noop", {}), queue.submit("noop", {})
+    assert queue._next()[0] == mine
+    assert queue._next()[0] == theirs
+    queue._conn.execute("UPDATE jobs SET worker = ? WHERE id = ?", (os.getpid() + 1, theirs))
+    queue._conn.commit()
+
+    queue.recover(os.getpid() + 1)
+    assert queue.get(mine)["status"] == "running"
+    assert queue.get(theirs)["status"] == "queued"
+
+    # A restart requeues every job that was still running
+    restarted = make_queue(tmp_path)
+    assert restarted.get(mine)["status"] == "queued"
@@ -0,0 +1,66 @@
+import time
+
+import pytest
+
+from model_registry import ModelRegistry, ModelUnavailable
+
+
+def make_registry(ttl=60):
+    registry = ModelRegistry()
+    loads = []
+    registry.register("model", lambda: loads.append(len(loads)) or object(), ttl=ttl)
+    registry.register("pinned", object)
+    return registry, loads
+
+
+def go_idle(registry, name, seconds):
+    registry.last_used[name] = time.time() - seconds
+
+
+def test_loads_on_first_use_only():
+    registry, loads = make_registry()
+    assert not registry.is_loaded("model")
+    assert registry.peek("model") is None
+    first = registry.get("model")
+    assert registry.get("model") is first
+    assert loads == [0]
+    assert registry.report()["models"]["model"]["loads"] == 1
+
+
+def test_unload_idle_drops_models_past_their_ttl():
+    registry, loads = make_registry(ttl=60)
+    registry.get("model")
+    registry.get("pinned")
+    go_idle(registry, "model", 30)
+    registry.unload_idle()
+    assert registry.is_loaded("model")
+    go_idle(registry, "model", 120)
+    go_idle(registry, "pinned", 10 ** 6)
+    registry.unload_idle()
+    assert not registry.is_loaded("model")
+    # Models without a ttl stay loaded
+    assert registry.is_loaded("pinned")
+    registry.get("model")
+    assert loads == [0, 1]
+
+
+def test_model_in_use_is_not_unloaded():
+    registry, _ = make_registry(ttl=60)
+    with registry.using("model") as model:
+        go_idle(registry, "model", 120)
+        registry.unload_idle()
+        assert not registry.unload("model", idle_for=60)
+        assert registry.peek("model") is model
+    assert registry.in_use["model"] == 0
+    # Leaving the block counts as a use
+    registry.unload_idle()
+    assert registry.is_loaded("model")
+
+
+def test_disabled_model_is_unavailable():
+    registry, loads = make_registry()
+    registry.disable("model", "embeddings profile")
+    with pytest.raises(ModelUnavailable):
+        registry.get("model")
+    assert loads == []
+    assert registry.report()["models"]["model"]["disabled"] == "embeddings profile"
@@ -0,0 +1,37 @@
+from polarity_cache import PolarityCache
+
+
+def make_cache(tmp_path, **kwargs):
+    return PolarityCache(str(tmp_path / "polarity.sqlite"), **kwargs)
+
+
+def test_lookup_returns_stored_results_in_order(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.store("stub", "v1", "The election was stolen", ["a", "b"], [{"polarity": "support"}, {"polarity": "neutral"}])
+    # The narrative is compared after normalize_text
+    results = cache.lookup("stub", "v1", " The  election was stolen", ["b", "c", "a"])
+    assert results == [{"polarity": "neutral"}, None, {"polarity": "support"}]
+    assert cache.lookup("stub", "v2", "The election was stolen", ["a"]) == [None]
+    assert cache.lookup("other", "v1", "The election was stolen", ["a"]) == [None]
+    assert (cache.hits, cache.misses) == (2, 3)
+
+
+def test_least_recently_used_entries_are_evicted(tmp_path):
+    cache = make_cache(tmp_path, max_entries=2)
+    cache.store("stub", "v1", "n", ["a", "b"], [{"polarity": "support"}] * 2)
+    cache.lookup("stub", "v1", "n", ["a"])
+    cache.store("stub", "v1", "n", ["c"], [{"polarity": "neutral"}])
+    assert cache.lookup("stub", "v1", "n", ["a", "b", "c"]) == [{"polarity": "support"}, None, {"polarity": "neutral"}]
+    assert cache.stats()["entries"] == 2
+    assert cache.evictions == 1
+
+
+def test_labelled_examples_keep_prompt_versions_apart(tmp_path):
+    cache = make_cache(tmp_path)
+    cache.store("stub", "labels", "n", ["a", "b"], [{"polarity": "support"}, {"polarity": "opposition"}])
+    cache.store("stub", "json", "n", ["c"], [{"polarity": "neutral"}])
+    cache.store("other", "labels", "n", ["d"], [{"polarity": "neutral"}])
+    assert sorted(cache.labelled_examples("stub", prompt_version="labels")) == [("n", "a", "support"), ("n", "b", "opposition")]
+    assert cache.count("stub", "labels") == 2
+    assert cache.count("stub") == 3
+    assert cache.count() == 4
@@ -0,0 +1,48 @@
+import numpy as np
+
+from fakes import FakeEncoder
+from polarity_cache import PolarityCache
+from polarity_cascade import PolarityCascade
+
+NARRATIVE = "The election was stolen"
+
+
+def labelled(model, n):
+    """ Tweets labelled by a linear rule on their embedding, which the cascade can learn. """
+    tweets = [f"tweet {i}" for i in range(n)]
+    labels = ["support" if model.embed(tweet)[0] > 0 else "opposition" for tweet in tweets]
+    return tweets, labels
+
+
+def test_needs_min_examples_with_two_labels():
+    cascade = PolarityCascade(FakeEncoder(), min_examples=10)
+    assert not cascade.fit([NARRATIVE] * 5, [f"tweet {i}" for i in range(5)], ["support"] * 5)
+    assert not cascade.fit([NARRATIVE] * 20, [f"tweet {i}" for i in range(20)], ["support"] * 20)
+    assert not cascade.ready
+
+
+def test_decide_returns_the_classes_of_its_probabilities():
+    model = FakeEncoder()
+    tweets, labels = labelled(model, 300)
+    cascade = PolarityCascade(model, min_examples=50)
+    assert cascade.fit([NARRATIVE] * len(tweets), tweets, labels)
+    predicted, probs, confident, classes = cascade.decide(tweets[:50], NARRATIVE, confidence=0.0)
+    assert classes == ["opposition", "support"]
+    assert probs.shape == (50, 2)
+    assert confident.all()
+    assert list(predicted) == [classes[i] for i in probs.argmax(axis=1)]
+    assert np.mean(predicted == np.array(labels[:50])) > 0.9
+
+
+def test_fit_from_cache_uses_only_its_prompt_version(tmp_path):
+    model = FakeEncoder()
+    tweets, labels = labelled(model, 120)
+    cache = PolarityCache(str(tmp_path / "polarity.sqlite"))
+    cache.store("stub", "labels-v1", NARRATIVE, tweets[:80], [{"polarity": label} for label in labels[:80]])
+    cache.store("stub", "json-v1", NARRATIVE, tweets[80:], [{"polarity": "neutral"}] * 40)
+    cascade = PolarityCascade(model, min_examples=50, prompt_version="labels-v1")
+    assert cascade.maybe_refit(cache, "stub")
+    assert cascade.n_examples == 80
+    assert "neutral" not in cascade.classifier.classes_
+    # Nothing new under this prompt version, so no refit
+    assert not cascade.maybe_refit(cache, "stub")
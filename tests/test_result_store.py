@@ -0,0 +1,72 @@
+import os
+import time
+
+import numpy as np
+import pandas as pd
+import pytest
+
+from result_store import ResultStore
+
+
+def rows(n, start=0):
+    return pd.DataFrame({"Tweet": [f"tweet {i}" for i in range(start, start + n)], "Similarity": np.linspace(0.5, 1, n)})
+
+
+def test_save_and_load_round_trip(tmp_path):
+    store = ResultStore(str(tmp_path))
+    embeddings = np.random.default_rng(0).normal(size=(3, 8)).astype(np.float32)
+    handle = store.save(rows(3), embeddings, owner="u1", model="fake-encoder")
+    df, loaded, manifest = store.load(handle, owner="u1")
+    pd.testing.assert_frame_equal(df, rows(3))
+    np.testing.assert_array_equal(loaded, embeddings)
+    assert manifest["model"] == "fake-encoder"
+    assert manifest["n_rows"] == 3
+
+
+def test_writer_concatenates_parts_and_skips_empty_ones(tmp_path):
+    store = ResultStore(str(tmp_path))
+    writer = store.writer(owner="u1")
+    writer.add(rows(2), np.ones((2, 4)))
+    writer.add(rows(0), np.empty((0, 4)))
+    writer.add(rows(3, start=2), np.zeros((3, 4)))
+    with pytest.raises(ValueError):
+        writer.add(rows(2), np.ones((1, 4)))
+    df, embeddings, manifest = store.load(writer.close())
+    assert df["Tweet"].tolist() == [f"tweet {i}" for i in range(5)]
+    assert embeddings.shape == (5, 4)
+    assert manifest["parts"] == 2
+
+
+def test_empty_result_loads_as_empty_frame(tmp_path):
+    store = ResultStore(str(tmp_path))
+    df, embeddings, _ = store.load(store.writer().close())
+    assert len(df) == 0
+    assert len(embeddings) == 0
+
+
+def test_other_owners_cannot_read_or_delete(tmp_path):
+    store = ResultStore(str(tmp_path))
+    handle = store.save(rows(1), np.ones((1, 4)), owner="u1")
+    assert store.manifest(handle, owner="u2") is None
+    with pytest.raises(KeyError):
+        store.load(handle, owner="u2")
+    assert not store.delete(handle, owner="u2")
+    assert store.delete(handle, owner="u1")
+    assert store.manifest(handle) is None
+
+
+def test_handles_must_be_hex_ids(tmp_path):
+    store = ResultStore(str(tmp_path))
+    for handle in ["../jobs", "abc", "G" * 32]:
+        with pytest.raises(ValueError):
+            store.path(handle)
+
+
+def test_purge_deletes_old_results(tmp_path):
+    store = ResultStore(str(tmp_path), max_age_hours=1)
+    old = store.save(rows(1), np.ones((1, 4)))
+    hours_ago = time.time() - 2 * 3600
+    os.utime(store.path(old), (hours_ago, hours_ago))
+    new = store.save(rows(1), np.ones((1, 4)))
+    assert store.manifest(old) is None
+    assert store.manifest(new) is not None
@@ -0,0 +1,30 @@
+import pandas as pd
+
+from storage import read_date_range, read_parquet, write_day_partitioned, write_parquet
+
+
+def tweets():
+    return pd.DataFrame({
+        "Tweet": ["late", "early", "middle", "undated"],
+        "Datetime": ["2024-01-03 09:00:00", "2024-01-01 09:00:00", "2024-01-02 09:00:00", None],
+        # Ids parsed as a mix of ints and strings, which Arrow cannot store as is
+        "PostId": [1, "2", 3, "x4"],
+    })
+
+
+def test_write_parquet_sorts_and_filters_by_datetime(tmp_path):
+    df = tweets()
+    path = write_parquet(df, str(tmp_path / "tweets.parquet"), row_group_size=1)
+    assert df["Datetime"].tolist()[0] == "2024-01-03 09:00:00"
+    assert read_parquet(path)["Tweet"].tolist() == ["early", "middle", "late", "undated"]
+    assert read_parquet(path, start="2024-01-02", end="2024-01-02 23:59:59")["Tweet"].tolist() == ["middle"]
+    assert read_parquet(path, columns=["PostId"])["PostId"].tolist() == ["2", "3", "1", "x4"]
+
+
+def test_day_partitions_read_only_the_requested_days(tmp_path):
+    out_dir = write_day_partitioned(tweets(), str(tmp_path / "days"))
+    assert read_date_range(out_dir, "2024-01-02", "2024-01-03 23:59:59")["Tweet"].tolist() == ["middle", "late"]
+    assert len(read_date_range(out_dir)) == 4
+    empty = read_date_range(out_dir, "2025-01-01", "2025-01-02")
+    assert len(empty) == 0
+    assert "Tweet" in empty.columns